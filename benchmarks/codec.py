@@ -0,0 +1,70 @@
+"""Compare cache codecs on the Reddit listing fixtures.
+
+Reports the encoded size and the encode/decode time of one cache entry per
+fixture for the pickle codec and the compact codec, with and without zlib.
+
+    python benchmarks/codec.py
+"""
+import json
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import flock
+
+
+FIXTURES = [
+    'tests/futuregarage_hot_week_100.json',
+    'tests/futuregarage_top_week_100.json',
+]
+
+CODECS = [
+    ('pickle', flock.PickleCodec()),
+    ('compact', flock.CompactCodec(compress_threshold=sys.maxint)),
+    ('compact+zlib', flock.CompactCodec(compress_threshold=1024)),
+]
+
+
+def loadEntry(path):
+    with open(path) as fixture:
+        response = json.load(fixture)
+    links = flock.parseRedditResponse(response)
+    return flock.CacheEntry(links, 1384000000.0, response['data']['after'])
+
+
+def timePerCall(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+
+def run(number=1000):
+    results = {}
+    for path in FIXTURES:
+        entry = loadEntry(path)
+        for name, codec in CODECS:
+            value = codec.encodeEntry(entry)
+            results['%s %s' % (os.path.basename(path), name)] = {
+                'links': len(entry.links),
+                'bytes': len(value),
+                'encode_us': timePerCall(lambda: codec.encodeEntry(entry),
+                                         number) * 1e6,
+                'decode_us': timePerCall(lambda: codec.decodeEntry(value),
+                                         number) * 1e6,
+            }
+    return results
+
+
+if __name__ == '__main__':
+    results = run()
+    print '%-50s %6s %8s %11s %11s' % ('', 'links', 'bytes',
+                                       'encode (us)', 'decode (us)')
+    for name in sorted(results):
+        result = results[name]
+        print '%-50s %6d %8d %11.1f %11.1f' % (name,
+                                               result['links'],
+                                               result['bytes'],
+                                               result['encode_us'],
+                                               result['decode_us'])
@@ -0,0 +1,213 @@
+"""Load test playlist() against the stand-in Reddit and Kimono.
+
+For every combination of cache hit ratio and worker count, WORKERS threads
+request playlists as fast as they can for --duration seconds. A request
+is a hit when it asks for one of a set of pre-warmed subreddits; any
+other request asks for a subreddit nobody asked for before, so flock has
+to fetch it from the stand-in. Throughput and p50/p95/p99 latency are
+reported per combination.
+
+    python benchmarks/load.py --hit-ratios 0,0.9,1 --workers 1,4,16
+    python benchmarks/load.py --url http://127.0.0.1:5000 --standin-port 8001
+
+By default the app runs in this process behind the Flask test client and
+the stand-in on a random port. With --url the requests go to a running
+flock instead, which has to be configured to use the stand-in on
+--standin-port (see benchmarks/standin.py).
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import urllib2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from werkzeug.contrib.cache import SimpleCache
+
+import flock
+import standin
+
+
+WARM_SUBREDDITS = 20
+SORT = 'hot'
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = int(round(fraction * len(sorted_values) + 0.5)) - 1
+    return sorted_values[min(max(index, 0), len(sorted_values) - 1)]
+
+
+def playlistPath(subreddit):
+    return '/?subreddits=%s&sort=%s&t=week&limit=100' % (subreddit, SORT)
+
+
+class InProcessClient(object):
+    def __init__(self):
+        self.client = flock.app.test_client()
+
+    def get(self, path):
+        return self.client.get(path).status_code
+
+
+class HTTPClient(object):
+    def __init__(self, url):
+        self.url = url
+
+    def get(self, path):
+        try:
+            response = urllib2.urlopen(self.url + path)
+        except urllib2.HTTPError as e:
+            return e.code
+        response.read()
+        response.close()
+        return response.code
+
+
+class LoadRun(object):
+    """One combination of hit ratio and worker count."""
+
+    def __init__(self, make_client, hit_ratio, workers, duration, misses):
+        self.make_client = make_client
+        self.hit_ratio = hit_ratio
+        self.workers = workers
+        self.duration = duration
+        self.misses = misses
+        self.latencies = []
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def worker(self, seed, deadline):
+        client = self.make_client()
+        rng = random.Random(seed)
+        latencies = []
+        errors = 0
+        while time.time() < deadline:
+            if rng.random() < self.hit_ratio:
+                subreddit = 'warm%d' % rng.randrange(WARM_SUBREDDITS)
+            else:
+                subreddit = 'cold%d' % next(self.misses)
+            start = time.time()
+            status = client.get(playlistPath(subreddit))
+            latencies.append(time.time() - start)
+            errors += status != 200
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.errors += errors
+
+    def run(self):
+        deadline = time.time() + self.duration
+        threads = [threading.Thread(target=self.worker, args=(i, deadline))
+                   for i in xrange(self.workers)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        latencies = sorted(self.latencies)
+        return {
+            'requests': len(latencies),
+            'errors': self.errors,
+            'throughput_rps': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 0.50) * 1e3,
+            'p95_ms': percentile(latencies, 0.95) * 1e3,
+            'p99_ms': percentile(latencies, 0.99) * 1e3,
+        }
+
+
+def configureInProcess(server):
+    logging.getLogger().setLevel(logging.WARNING)
+    flock.REDDIT_URL = server.url
+    flock.KIMONO_URL = server.url + '/kimono'
+    flock.app.config['REDDIT_REQUEST_INTERVAL'] = 0.0
+    flock.cache = SimpleCache(threshold=100000)
+
+
+def run(hit_ratios, worker_counts, duration, url=None, standin_options=None,
+        standin_port=0):
+    server = standin.start(port=standin_port if url else 0,
+                           **(standin_options or {}))
+    if url:
+        make_client = lambda: HTTPClient(url)
+    else:
+        configureInProcess(server)
+        make_client = InProcessClient
+
+    client = make_client()
+    for i in xrange(WARM_SUBREDDITS):
+        client.get(playlistPath('warm%d' % i))
+
+    misses = itertools.count()
+    results = {}
+    for hit_ratio, workers in itertools.product(hit_ratios, worker_counts):
+        load_run = LoadRun(make_client, hit_ratio, workers, duration, misses)
+        results['hit %.2f workers %d' % (hit_ratio, workers)] = load_run.run()
+    results['standin'] = dict(server.stats)
+    server.shutdown()
+    server.server_close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test playlist() '
+                                                 'against the stand-in.')
+    parser.add_argument('--hit-ratios', default='0,0.5,0.9,1')
+    parser.add_argument('--workers', default='1,4,16')
+    parser.add_argument('--duration', type=float, default=5.0,
+                        help='seconds per combination')
+    parser.add_argument('--url', help='load test a running flock instead')
+    parser.add_argument('--standin-port', type=int, default=8001,
+                        help='stand-in port for a flock given with --url')
+    parser.add_argument('--latency', type=float, default=100.0,
+                        help='stand-in latency in milliseconds')
+    parser.add_argument('--jitter', type=float, default=20.0,
+                        help='stand-in latency deviation in milliseconds')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=int, default=0,
+                        help='stand-in requests per second before 429s')
+    parser.add_argument('--output', help='also write the results as JSON')
+    args = parser.parse_args(argv)
+
+    results = run([float(ratio) for ratio in args.hit_ratios.split(',')],
+                  [int(workers) for workers in args.workers.split(',')],
+                  args.duration, args.url,
+                  {'latency': args.latency / 1000.0,
+                   'jitter': args.jitter / 1000.0,
+                   'error_rate': args.error_rate,
+                   'rate_limit': args.rate_limit},
+                  args.standin_port)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+
+    standin_stats = results.pop('standin')
+    print '%-24s %8s %7s %9s %9s %9s %9s' % ('', 'requests', 'errors',
+                                             'req/s', 'p50 (ms)', 'p95 (ms)',
+                                             'p99 (ms)')
+    for name in sorted(results):
+        result = results[name]
+        print '%-24s %8d %7d %9.1f %9.1f %9.1f %9.1f' % (
+            name, result['requests'], result['errors'],
+            result['throughput_rps'], result['p50_ms'], result['p95_ms'],
+            result['p99_ms'])
+    print 'stand-in: %s' % ', '.join('%s %d' % item
+                                     for item in sorted(standin_stats.items()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+"""Compare parseRedditResponse with the deepcopy based parser it replaced.
+
+    python benchmarks/parse.py
+"""
+import copy
+import HTMLParser
+import json
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import flock
+
+
+FIXTURES = [
+    'tests/futuregarage_hot_week_100.json',
+    'tests/futuregarage_top_week_100.json',
+]
+
+
+def legacyParseRedditResponse(response_object):
+    response_copy = copy.deepcopy(response_object)
+    html_parser = HTMLParser.HTMLParser()
+
+    children = response_copy['data']['children']
+    children = [child['data'] for child in children]
+
+    links = []
+    for child in children:
+        url = flock.sanitiseURL(child.get('url'))
+        if not url:
+            continue
+        child['url'] = url
+        child['title'] = html_parser.unescape(child.get('title'))
+        child['permalink'] = '%s%s' % (flock.REDDIT_URL,
+                                       child.get('permalink'))
+        for key in child.keys():
+            if key not in flock.LINK_FIELDS:
+                del child[key]
+        links.append(child)
+
+    return links
+
+
+PARSERS = [
+    ('before', legacyParseRedditResponse),
+    ('after', flock.parseRedditResponse),
+]
+
+
+def timePerCall(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+
+def run(number=200):
+    results = {}
+    for path in FIXTURES:
+        with open(path) as fixture:
+            response = json.load(fixture)
+        for name, parse in PARSERS:
+            results['%s %s' % (os.path.basename(path), name)] = {
+                'links': len(parse(response)),
+                'parse_us': timePerCall(lambda: parse(response),
+                                        number) * 1e6,
+            }
+    return results
+
+
+if __name__ == '__main__':
+    results = run()
+    print '%-40s %6s %11s' % ('', 'links', 'parse (us)')
+    for name in sorted(results):
+        result = results[name]
+        print '%-40s %6d %11.1f' % (name, result['links'], result['parse_us'])
@@ -0,0 +1,150 @@
+"""Time the playlist pipeline on synthetically scaled Reddit listings.
+
+Each fixture listing is copied into several subreddits, half of the copies
+linking to the same videos so removeDuplicates has work to do. Stages are
+timed on their own, then getLinks against a pre-filled in-memory cache and
+a whole playlist request through the Flask test client.
+
+    python benchmarks/pipeline.py
+"""
+import json
+import logging
+import os
+import sys
+import time
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from werkzeug.contrib.cache import SimpleCache
+
+import flock
+
+
+FIXTURES = [
+    'tests/futuregarage_hot_week_100.json',
+    'tests/futuregarage_top_week_100.json',
+]
+
+SUBREDDIT_LIST = 'tests/subreddit_list_dump.json'
+
+SCALES = [1, 10, 50]
+LIMIT = 100
+
+
+def scaleListing(response, copies):
+    """One listing holding copies of response, each in its own subreddit."""
+    children = []
+    for copy in xrange(copies):
+        subreddit = 'FutureGarage%d' % copy if copy else 'FutureGarage'
+        for child in response['data']['children']:
+            data = dict(child['data'])
+            data['id'] = '%s_%d' % (data['id'], copy)
+            data['subreddit'] = subreddit
+            data['created_utc'] = data['created_utc'] - copy * 60
+            # odd copies repost the videos of the copy before them
+            tag = copy - copy % 2
+            if tag:
+                data['url'] = data['url'].replace('v=', 'v=%d' % tag, 1)
+            children.append({'kind': child['kind'], 'data': data})
+    listing = dict(response['data'], children=children)
+    return dict(response, data=listing)
+
+
+def scaledSubreddits(copies):
+    return ['FutureGarage%d' % copy if copy else 'FutureGarage'
+            for copy in xrange(copies)]
+
+
+def refuseNetwork(*args, **kwargs):
+    raise AssertionError('benchmarks must not reach the network')
+
+
+def fillCache(links, subreddits, sort, t):
+    flock.cache = SimpleCache(threshold=len(subreddits) * 4 + 100)
+    links_by_key = flock.partitionLinks(links, subreddits, sort, t)
+    cursor_key = flock.cursorCacheKey(subreddits, sort, t)
+    flock.setCachedLinks(links_by_key, t, {cursor_key: ([], None)})
+
+
+def timePerCall(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def timeStages(response, copies, sort):
+    results = {}
+    number = max(1, 200 / copies)
+    urls = [child['data']['url'] for child in response['data']['children']]
+    links = flock.parseRedditResponse(response)
+    unique = flock.removeDuplicates(links)
+    ranked = flock.selectLinks(unique, sort, LIMIT)
+    subreddits = scaledSubreddits(copies)
+
+    results['links'] = len(links)
+    results['parse_us'] = timePerCall(
+        lambda: flock.parseRedditResponse(response), number) * 1e6
+    results['sanitise_us'] = timePerCall(
+        lambda: [flock.sanitiseURL(url) for url in urls], number) * 1e6
+    results['dedupe_us'] = timePerCall(
+        lambda: flock.removeDuplicates(links), number) * 1e6
+    results['rank_us'] = timePerCall(
+        lambda: flock.selectLinks(unique, sort, LIMIT), number) * 1e6
+    results['youtube_url_us'] = timePerCall(
+        lambda: flock.generateYouTubeURL(ranked), number) * 1e6
+
+    fillCache(links, subreddits, sort, 'week')
+    results['get_links_us'] = timePerCall(
+        lambda: flock.getLinks(subreddits, sort, 'week', LIMIT), number) * 1e6
+
+    client = flock.app.test_client()
+    url = '/?subreddits=%s&sort=%s&t=week&limit=%d' % ('+'.join(subreddits),
+                                                      sort, LIMIT)
+    assert client.get(url).status_code == 200
+    results['playlist_us'] = timePerCall(lambda: client.get(url),
+                                         number) * 1e6
+    return results
+
+
+def run():
+    logging.getLogger().setLevel(logging.WARNING)
+    with open(SUBREDDIT_LIST) as fixture:
+        names = json.load(fixture)
+
+    original_cache = flock.cache
+    original_open = flock.http_opener.open
+    original_snapshot = flock.subreddit_snapshot
+    flock.http_opener.open = refuseNetwork
+    flock.subreddit_snapshot = flock.SubredditSnapshot(names,
+                                                       time.time() + 60 * 60)
+    try:
+        results = {}
+        for path in FIXTURES:
+            with open(path) as fixture:
+                response = json.load(fixture)
+            sort = os.path.basename(path).split('_')[1]
+            for copies in SCALES:
+                name = '%s x%d' % (os.path.basename(path), copies)
+                results[name] = timeStages(scaleListing(response, copies),
+                                           copies, sort)
+        return results
+    finally:
+        flock.cache = original_cache
+        flock.http_opener.open = original_open
+        flock.subreddit_snapshot = original_snapshot
+
+
+COLUMNS = ['parse_us', 'sanitise_us', 'dedupe_us', 'rank_us',
+           'youtube_url_us', 'get_links_us', 'playlist_us']
+
+
+if __name__ == '__main__':
+    results = run()
+    print '%-36s %6s %s' % ('', 'links',
+                            ' '.join('%12s' % column for column in COLUMNS))
+    for name in sorted(results):
+        result = results[name]
+        print '%-36s %6d %s' % (name, result['links'],
+                                ' '.join('%12.1f' % result[column]
+                                         for column in COLUMNS))
@@ -0,0 +1,124 @@
+"""Run the benchmark suite and compare it with a stored baseline.
+
+Every module listed in SUITES exposes run(), returning a dict of cases to
+dicts of measurements. Measurements whose name ends in _us or _ms are
+timings, anything else (link counts, sizes) is a property of the output
+and is expected to match the baseline exactly.
+
+    python benchmarks/run.py                      # compare with baseline.json
+    python benchmarks/run.py --only pipeline,parse
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --save-baseline      # after an intended change
+
+Exits with status 1 when a timing is more than --threshold slower than the
+baseline, or an output property changed. Baselines are only comparable on
+the machine and interpreter they were recorded with.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS)
+
+SUITES = ['codec', 'parse', 'stream', 'scoring', 'pipeline']
+
+BASELINE = os.path.join(BENCHMARKS, 'baseline.json')
+
+
+def isTiming(measurement):
+    return measurement.endswith('_us') or measurement.endswith('_ms')
+
+
+def runSuites(names):
+    results = {}
+    for name in names:
+        sys.stderr.write('running %s\n' % name)
+        results[name] = __import__(name).run()
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'recorded': datetime.datetime.utcnow().isoformat() + 'Z',
+        'results': results,
+    }
+
+
+def compare(current, baseline, threshold):
+    """Yield (suite, case, measurement, baseline, current, regressed) for
+    every measurement present in both runs."""
+    for suite, cases in sorted(current['results'].iteritems()):
+        baseline_cases = baseline['results'].get(suite, {})
+        for case, measurements in sorted(cases.iteritems()):
+            baseline_measurements = baseline_cases.get(case, {})
+            for measurement, value in sorted(measurements.iteritems()):
+                if measurement not in baseline_measurements:
+                    continue
+                before = baseline_measurements[measurement]
+                if isTiming(measurement):
+                    regressed = value > before * (1 + threshold)
+                else:
+                    regressed = value != before
+                yield suite, case, measurement, before, value, regressed
+
+
+def report(comparison):
+    regressions = 0
+    print '%-56s %-14s %12s %12s %8s' % ('', '', 'baseline', 'current',
+                                         'change')
+    for suite, case, measurement, before, value, regressed in comparison:
+        change = '%+.1f%%' % ((value - before) * 100.0 / before) \
+            if before else '-'
+        print '%-56s %-14s %12.1f %12.1f %8s%s' % (
+            '%s: %s' % (suite, case), measurement, before, value, change,
+            '  REGRESSED' if regressed else '')
+        regressions += regressed
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--only', help='comma separated suites to run')
+    parser.add_argument('--output', help='also write the results here')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='overwrite the baseline with this run')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed slowdown, as a fraction of the baseline')
+    args = parser.parse_args(argv)
+
+    names = args.only.split(',') if args.only else SUITES
+    current = runSuites(names)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(current, output, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+    if args.save_baseline:
+        if args.only and os.path.exists(args.baseline):
+            with open(args.baseline) as stored:
+                baseline = json.load(stored)
+            baseline['results'].update(current['results'])
+            current = dict(current, results=baseline['results'])
+        with open(args.baseline, 'w') as output:
+            json.dump(current, output, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+        return 0
+    if not os.path.exists(args.baseline):
+        print json.dumps(current, indent=2, sort_keys=True,
+                         separators=(',', ': '))
+        return 0
+
+    with open(args.baseline) as stored:
+        baseline = json.load(stored)
+    regressions = report(compare(current, baseline, args.threshold))
+    if regressions:
+        print '%d measurements regressed' % regressions
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
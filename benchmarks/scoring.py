@@ -0,0 +1,59 @@
+"""Compare the Python and NumPy scoring backends used to rank playlists.
+
+    python benchmarks/scoring.py
+"""
+import os
+import random
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import flock
+
+
+SIZES = [100, 10000, 100000]
+LIMIT = 100
+
+
+def makeCandidates(count, seed=14):
+    rng = random.Random(seed)
+    return [flock.Link(id=str(i),
+                       ups=rng.randint(0, 5000),
+                       downs=rng.randint(0, 500),
+                       created_utc=float(rng.randint(1384000000, 1384600000)))
+            for i in xrange(count)]
+
+
+def timeCall(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+
+def run():
+    results = {}
+    for size in SIZES:
+        links = makeCandidates(size)
+        number = max(1, 10000 / size)
+        for sort in ['hot', 'top']:
+            python = lambda: flock.rankLinks(links, flock.supported_sorts[sort],
+                                             LIMIT)
+            result = {'python_ms': timeCall(python, number) * 1e3}
+            if flock.numpy is not None:
+                vector = lambda: flock.vectorRankLinks(links, sort, LIMIT)
+                assert vector() == python()
+                result['numpy_ms'] = timeCall(vector, number) * 1e3
+            results['%s %d' % (sort, size)] = result
+    return results
+
+
+if __name__ == '__main__':
+    results = run()
+    print '%-12s %11s %11s' % ('', 'python (ms)', 'numpy (ms)')
+    for name in sorted(results, key=lambda n: (n.split()[0],
+                                               int(n.split()[1]))):
+        result = results[name]
+        print '%-12s %11.2f %11s' % (name, result['python_ms'],
+                                     '%.2f' % result['numpy_ms']
+                                     if 'numpy_ms' in result else '-')
@@ -0,0 +1,175 @@
+"""A stand-in for Reddit and Kimono that replays the fixtures in tests/.
+
+Listings for any subreddits are served from the futuregarage fixture for
+their sort, with the links dealt out between the requested subreddits so
+flock caches them as it would real listings. Any other path answers with
+tests/kimono.json. Latency, errors and rate limiting are configurable:
+
+    python benchmarks/standin.py --port 8001 --latency 150 --jitter 50 \\
+        --error-rate 0.01 --rate-limit 30
+
+Point flock at it with a FLOCK_SETTINGS file containing
+
+    REDDIT_URL = 'http://127.0.0.1:8001'
+    KIMONO_URL = 'http://127.0.0.1:8001/kimono'
+    REDDIT_REQUEST_INTERVAL = 0.0
+"""
+import BaseHTTPServer
+import SocketServer
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SORTS = ['hot', 'top']
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        delay = max(0.0, random.gauss(server.latency, server.jitter))
+        if delay:
+            time.sleep(delay)
+
+        if not server.admit():
+            server.count('throttled')
+            self.respond(429, '{"error": 429}',
+                         [('Retry-After', '%d' % max(1, server.window))])
+            return
+        if random.random() < server.error_rate:
+            server.count('errors')
+            self.respond(503, '{"error": 503}')
+            return
+
+        url = urlparse.urlparse(self.path)
+        path = url.path.strip('/').split('/')
+        if len(path) == 3 and path[0] == 'r' and path[2].endswith('.json'):
+            query = urlparse.parse_qs(url.query)
+            limit = int(query.get('limit', ['100'])[0])
+            body = server.listing(path[1].split('+'),
+                                  path[2][:-len('.json')], limit)
+        else:
+            body = server.kimono
+        server.count('requests')
+        self.respond(200, body)
+
+    def respond(self, code, body, headers=()):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves listings with latency and jitter in seconds, a fraction of
+    503 errors and at most rate_limit requests per window seconds, answering
+    429 beyond that. A rate_limit of 0 disables rate limiting."""
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, jitter=0.0, error_rate=0.0,
+                 rate_limit=0, window=1):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           StandInHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.window = window
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+
+        self.fixtures = {}
+        for sort in SORTS:
+            path = os.path.join(ROOT, 'tests',
+                                'futuregarage_%s_week_100.json' % sort)
+            with open(path) as fixture:
+                self.fixtures[sort] = json.load(fixture)
+        with open(os.path.join(ROOT, 'tests', 'kimono.json')) as fixture:
+            self.kimono = fixture.read()
+
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'errors': 0, 'throttled': 0}
+        self.window_start = 0
+        self.window_requests = 0
+
+    def admit(self):
+        if not self.rate_limit:
+            return True
+        with self.lock:
+            now = int(time.time() / self.window)
+            if now != self.window_start:
+                self.window_start = now
+                self.window_requests = 0
+            self.window_requests += 1
+            return self.window_requests <= self.rate_limit
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def listing(self, subreddits, sort, limit):
+        response = self.fixtures.get(sort, self.fixtures['hot'])
+        children = []
+        for i, child in enumerate(response['data']['children'][:limit]):
+            subreddit = subreddits[i % len(subreddits)]
+            data = dict(child['data'], subreddit=subreddit,
+                        id='%s_%s' % (subreddit, child['data']['id']))
+            children.append({'kind': child['kind'], 'data': data})
+        listing = dict(response['data'], children=children, after=None)
+        return json.dumps(dict(response, data=listing))
+
+
+def start(**options):
+    """Start a StandInServer on a daemon thread and return it."""
+    server = StandInServer(**options)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Reddit and Kimono '
+                                                 'stand-in for load tests.')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='mean response latency in milliseconds')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='standard deviation of the latency in '
+                             'milliseconds')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests answered with 503')
+    parser.add_argument('--rate-limit', type=int, default=0,
+                        help='requests per --window answered before 429s')
+    parser.add_argument('--window', type=int, default=1,
+                        help='rate limit window in seconds')
+    args = parser.parse_args(argv)
+
+    server = StandInServer(args.port, args.latency / 1000.0,
+                           args.jitter / 1000.0, args.error_rate,
+                           args.rate_limit, args.window)
+    print 'Serving fixtures on %s' % server.url
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print ', '.join('%s: %d' % item for item in sorted(server.stats.items()))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+"""Compare buffered and streamed decoding of Reddit listings.
+
+    python benchmarks/stream.py
+"""
+import io
+import json
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import flock
+
+
+FIXTURES = [
+    'tests/futuregarage_hot_week_100.json',
+    'tests/futuregarage_top_week_100.json',
+]
+
+
+def bufferedDecode(body):
+    return flock.parseRedditResponse(json.loads(body))
+
+
+def streamedDecode(body, chunk_size=16 * 1024):
+    listing = flock.StreamedListing(io.BytesIO(body), chunk_size)
+    links = [link for link in flock.iterStreamedLinks(listing)]
+    return links, listing.peak_buffer
+
+
+def timePerCall(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+
+def run(number=100):
+    results = {}
+    for path in FIXTURES:
+        with open(path) as fixture:
+            body = fixture.read()
+        name = os.path.basename(path)
+        links, peak_buffer = streamedDecode(body)
+        results['%s buffered' % name] = {
+            'links': len(bufferedDecode(body)),
+            'peak_bytes': len(body),
+            'decode_us': timePerCall(lambda: bufferedDecode(body),
+                                     number) * 1e6,
+        }
+        results['%s streamed' % name] = {
+            'links': len(links),
+            'peak_bytes': peak_buffer,
+            'decode_us': timePerCall(lambda: streamedDecode(body),
+                                     number) * 1e6,
+        }
+    return results
+
+
+if __name__ == '__main__':
+    results = run()
+    print '%-42s %6s %11s %11s' % ('', 'links', 'peak (B)', 'decode (us)')
+    for name in sorted(results):
+        result = results[name]
+        print '%-42s %6d %11d %11.1f' % (name, result['links'],
+                                         result['peak_bytes'],
+                                         result['decode_us'])
@@ -1,3 +1,48 @@
 DEBUG = True
 SECRET_KEY = 'skeleton_key'
 KIMONO_KEY = 'e2e08c447dc0504897bac7a7e0a0bb93'
+REDDIT_URL = 'http://www.reddit.com'
+KIMONO_URL = 'http://www.kimonolabs.com/api/6bl1t44o'
+REDDIT_REQUEST_INTERVAL = 2.0
+RATE_LIMIT_BURST = 1
+RATE_LIMIT_MAX_WAIT = 10.0
+RATE_LIMIT_SHARED = False
+SINGLE_FLIGHT_SHARED = False
+SINGLE_FLIGHT_LOCK_TIMEOUT = 15
+SINGLE_FLIGHT_POLL_INTERVAL = 0.1
+CACHE_WINDOWS = {
+    'day': (60 * 10, 60 * 60 * 2),
+    'week': (60 * 30, 60 * 60 * 6),
+    'month': (60 * 60 * 2, 60 * 60 * 24),
+    'year': (60 * 60 * 6, 60 * 60 * 24 * 3),
+    'all': (60 * 60 * 12, 60 * 60 * 24 * 7)
+}
+WARMER_FLUSH_INTERVAL = 60
+WARMER_TOP_N = 50
+WARMER_DECAY = 0.5
+MAX_PAGES = 3
+MAX_PLAYLIST_LIMIT = 300
+FETCH_MODE = 'combined'
+FETCH_GROUP_SIZE = 1
+FETCH_WORKERS = 4
+CACHE_CODEC = 'compact'
+CACHE_COMPRESS_THRESHOLD = 1024
+STREAM_DECODE = False
+STREAM_CHUNK_SIZE = 16 * 1024
+SCORING_BACKEND = 'python'
+PAGE_CACHE = False
+SUBREDDIT_LIST_MAX_AGE = 60 * 60 * 24
+SUBREDDIT_LIST_L1_TTL = 60
+SUBREDDIT_PREFIX_LIMIT = 50
+SUBREDDIT_PREFIX_MAX_AGE = 60 * 5
+GZIP_MIN_SIZE = 512
+HTTP_CONNECT_TIMEOUT = 5.0
+HTTP_READ_TIMEOUT = 10.0
+HTTP_MAX_IDLE = 4
+CONDITIONAL_GET = False
+LOG_LEVEL = 'DEBUG'
+PROFILE_ENABLED = False
+PROFILE_SECRET = None
+PROFILE_DIR = 'profiles'
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_SAMPLE_INTERVAL = 0.002
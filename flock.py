@@ -1,18 +1,40 @@
-import copy
 import HTMLParser
+import argparse
+import bisect
+import cProfile
+import collections
+import functools
+import gzip
+import hashlib
+import heapq
+import hmac
 import httplib
 import json
 import logging
+import marshal
 import math
 import os
 import pickle
+import random
+import re
+import socket
+import StringIO
+import sys
+import threading
 import time
 import urllib
 import urllib2
 import urlparse
-from datetime import datetime
+import uuid
+import zlib
+from multiprocessing.pool import ThreadPool
+try:
+    import numpy
+except ImportError:
+    numpy = None
 from werkzeug.contrib.cache import MemcachedCache, SimpleCache
-from flask import Flask, render_template, request, redirect, flash
+from flask import Flask, render_template, request, redirect, flash, g, \
+    has_request_context, session
 
 app = Flask(__name__, static_folder='static', static_url_path='')
 app.config.from_object('debug_config')
@@ -24,31 +46,195 @@ if app.debug:
 else:
     cache = MemcachedCache(['127.0.0.1:11211'])
 
-logging.getLogger().setLevel(logging.DEBUG)
+logging.getLogger().setLevel(app.config.get('LOG_LEVEL', logging.DEBUG))
 
-REDDIT_URL = 'http://www.reddit.com'
-KIMONO_URL = 'http://www.kimonolabs.com/api/6bl1t44o'
+# upstream base URLs, point them at a stand-in to load test without Reddit
+REDDIT_URL = app.config.get('REDDIT_URL', 'http://www.reddit.com')
+KIMONO_URL = app.config.get('KIMONO_URL',
+                            'http://www.kimonolabs.com/api/6bl1t44o')
 YOUTUBE_EMBED_URL = 'https://www.youtube.com/embed/'
 USER_AGENT = 'flock/0.1 by /u/rblstr'
 
 
+def formatMetricValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+def formatMetricLabels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = unicode(value).replace('\\', '\\\\').replace('"', '\\"')
+        pairs.append(u'%s="%s"' % (name, value.replace('\n', '\\n')))
+    return '{%s}' % ','.join(pairs)
+
+
+class Counter(object):
+    """A Prometheus counter, one series per combination of label values."""
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self.lock:
+            self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self.series.get(label_values, 0)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s counter' % self.name]
+        with self.lock:
+            series = sorted(self.series.items())
+        for label_values, value in series:
+            lines.append('%s%s %s' % (self.name,
+                                      formatMetricLabels(self.labels,
+                                                         label_values),
+                                      formatMetricValue(value)))
+        return lines
+
+
+class Histogram(object):
+    """A Prometheus histogram, one series per combination of label values.
+
+    observe() is a bisect and three additions under a lock, cheap enough to
+    leave on around every pipeline stage.
+    """
+
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.labels = labels
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self.series[label_values] = series
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, *label_values):
+        series = self.series.get(label_values)
+        return series[2] if series else 0
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s histogram' % self.name]
+        with self.lock:
+            series = sorted((label_values, list(counts), total, count)
+                            for label_values, (counts, total, count)
+                            in self.series.iteritems())
+        bucket_labels = self.labels + ('le',)
+        for label_values, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),),
+                                           counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket%s %d' % (
+                    self.name,
+                    formatMetricLabels(bucket_labels,
+                                       label_values + (formatMetricValue(bound),)),
+                    cumulative))
+            labels = formatMetricLabels(self.labels, label_values)
+            lines.append('%s_sum%s %s' % (self.name, labels,
+                                          formatMetricValue(total)))
+            lines.append('%s_count%s %d' % (self.name, labels, count))
+        return lines
+
+
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+stage_seconds = Histogram('flock_stage_seconds',
+                          'Time spent in each stage of the link pipeline.',
+                          latency_buckets, ('stage',))
+request_seconds = Histogram('flock_request_seconds',
+                            'Time spent handling each request.',
+                            latency_buckets, ('endpoint',))
+rate_limit_wait_seconds = Histogram('flock_rate_limit_wait_seconds',
+                                    'Time spent waiting for the rate limiter.',
+                                    (0.01, 0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0),
+                                    ('domain',))
+upstream_payload_bytes = Histogram('flock_upstream_payload_bytes',
+                                   'Size of upstream response bodies.',
+                                   (1024, 4096, 16384, 65536, 262144, 1048576,
+                                    4194304),
+                                   ('host',))
+upstream_responses = Counter('flock_upstream_responses_total',
+                             'Upstream responses by status code.',
+                             ('host', 'code'))
+cache_lookups = Counter('flock_cache_lookups_total',
+                        'Link cache lookups by result.', ('result',))
+page_cache_lookups = Counter('flock_page_cache_lookups_total',
+                             'Rendered page cache lookups by result.',
+                             ('result',))
+
+metrics = [stage_seconds, request_seconds, rate_limit_wait_seconds,
+           upstream_payload_bytes, upstream_responses, cache_lookups,
+           page_cache_lookups]
+
+
+class StageTimer(object):
+    """Context manager recording the time spent in a pipeline stage."""
+
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        stage_seconds.observe(time.time() - self.start, self.stage)
+
+
 def getSubredditList():
     subreddit_list = cache.get('subreddits')
 
     if subreddit_list:
-        subreddit_list = pickle.loads(subreddit_list)
+        subreddit_list = getDecoder(subreddit_list).loads(subreddit_list)
     else:
         query = {
             'apikey': app.config['KIMONO_KEY']
         }
         query_string = urllib.urlencode(query)
 
+        # a copy outliving 'subreddits', to revalidate with Kimono
+        conditional = app.config.get('CONDITIONAL_GET', False)
+        stale = cache.get('subreddits+stale') if conditional else None
+        validators, stale_list = stale or (None, None)
+
         try:
-            response = makeRequest('%s?%s' % (KIMONO_URL, query_string))
+            response = makeRequest('%s?%s' % (KIMONO_URL, query_string),
+                                   conditionalHeaders(validators))
+            opened = time.time()
 
             response_obj = json.load(response)
 
             response.close()
+        except urllib2.HTTPError as e:
+            if e.code != 304 or not stale_list:
+                return []
+            recordNotModified(KIMONO_URL, validators)
+            cache.set('subreddits', stale_list, timeout=60 * 60 * 24 * 7)
+            return getDecoder(stale_list).loads(stale_list)
         except:
             return []
 
@@ -73,42 +259,492 @@ def getSubredditList():
         subreddit_list = sorted(subreddit_list, key=len)
 
         timeout = 60 * 60 * 24 * 7
-        cache.set('subreddits', pickle.dumps(subreddit_list), timeout=timeout)
+        encoded_list = getCacheCodec().dumps(subreddit_list)
+        cache.set('subreddits', encoded_list, timeout=timeout)
+
+        validators = conditional and responseValidators(response)
+        if validators:
+            validators['parse_seconds'] = time.time() - opened
+            cache.set('subreddits+stale', (validators, encoded_list),
+                      timeout=timeout * 4)
 
     return subreddit_list
 
 
-def makeRequest(url):
-    headers = {
-        'User-Agent': USER_AGENT
-    }
+class SubredditSnapshot(object):
+    """An immutable copy of the subreddit list with a lower-case index.
+
+    Requests never add to it; subreddits that aren't listed are carried
+    alongside it for the request that asked for them.
+    """
+
+    __slots__ = ('names', 'index', 'body', 'etag', 'expires')
+
+    def __init__(self, names, expires):
+        self.names = tuple(names)
+        self.index = dict((name.lower(), name) for name in reversed(self.names))
+        self.body = json.dumps(self.names)
+        self.etag = hashlib.md5(self.body).hexdigest()
+        self.expires = expires
+
+    def __contains__(self, subreddit):
+        return subreddit.lower() in self.index
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def canonical(self, subreddit):
+        return self.index.get(subreddit.lower(), subreddit)
+
+
+subreddit_snapshot = None
+
+
+def getSubredditSnapshot():
+    """Return the process-local subreddit snapshot, rebuilding it from
+    getSubredditList() once it is older than SUBREDDIT_LIST_L1_TTL."""
+    global subreddit_snapshot
+    snapshot = subreddit_snapshot
+    now = time.time()
+    if snapshot is None or snapshot.expires <= now:
+        snapshot = SubredditSnapshot(getSubredditList(),
+                                     now + app.config.get('SUBREDDIT_LIST_L1_TTL', 60))
+        # an empty list means Kimono failed, so try again next time
+        if snapshot.names:
+            subreddit_snapshot = snapshot
+    return snapshot
+
+
+class SubredditCompleter(object):
+    """Finds the subreddits of one snapshot that start with a prefix.
+
+    The lower-cased names are kept sorted so a prefix is found with bisect.
+    Matches are ranked by how often they are requested, and the results
+    for each (prefix, limit) are kept until the snapshot is replaced.
+    """
+
+    def __init__(self, snapshot, popularity, max_results=1024):
+        pairs = sorted(snapshot.index.iteritems())
+        self.snapshot = snapshot
+        self.keys = [key for key, name in pairs]
+        self.names = [name for key, name in pairs]
+        self.popularity = popularity
+        self.max_results = max_results
+        self.results = {}
+
+    def rank(self, index):
+        key = self.keys[index]
+        return -self.popularity.get(key, 0), len(key), key
+
+    def complete(self, prefix, limit=10):
+        prefix = prefix.lower()
+        names = self.results.get((prefix, limit))
+        if names is None:
+            start = bisect.bisect_left(self.keys, prefix)
+            end = bisect.bisect_left(self.keys, prefix + u'\uffff', start)
+            best = heapq.nsmallest(limit, xrange(start, end), key=self.rank)
+            names = [self.names[index] for index in best]
+            if len(self.results) >= self.max_results:
+                self.results = {}
+            self.results[(prefix, limit)] = names
+        return names
+
+
+subreddit_completer = None
+
+
+def getSubredditCompleter():
+    global subreddit_completer
+    snapshot = getSubredditSnapshot()
+    completer = subreddit_completer
+    if completer is None or completer.snapshot is not snapshot:
+        completer = SubredditCompleter(snapshot,
+                                       request_frequency.subredditCounts())
+        if snapshot is subreddit_snapshot:
+            subreddit_completer = completer
+    return completer
+
+
+class PooledResponse(object):
+    """File-like body of a pooled response.
+
+    A gzipped body is decoded as it is read. The connection goes back to
+    its pool once the body has been read to the end; closing the response
+    early closes the connection instead.
+    """
+
+    def __init__(self, pool, key, connection, response):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.decoder = None
+        if response.getheader('content-encoding', '').lower() == 'gzip':
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = ''
+        self.done = False
+        if response.length == 0:
+            # nothing to read (a 304 say), so the connection is free again
+            response.read()
+            self.finish()
+
+    def readRaw(self, amt):
+        if self.done:
+            return ''
+        data = self.response.read(amt) if amt else self.response.read()
+        if not data or self.response.isclosed():
+            self.finish()
+        if self.decoder is not None:
+            data = self.decoder.decompress(data)
+            if self.done:
+                data += self.decoder.flush()
+        return data
+
+    def read(self, amt=None):
+        if not amt:
+            data = self.buffer + self.readRaw(None)
+            self.buffer = ''
+            return data
+        # a gzip chunk can decode to nothing, which callers would take for EOF
+        while len(self.buffer) < amt and not self.done:
+            self.buffer += self.readRaw(amt)
+        data, self.buffer = self.buffer[:amt], self.buffer[amt:]
+        return data
+
+    def readline(self):
+        while '\n' not in self.buffer and not self.done:
+            self.buffer += self.readRaw(8192)
+        end = self.buffer.find('\n') + 1 or len(self.buffer)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+    def finish(self):
+        if self.done:
+            return
+        self.done = True
+        if self.response.will_close:
+            self.connection.close()
+        else:
+            self.pool.release(self.key, self.connection)
+
+    def close(self):
+        if not self.done:
+            self.done = True
+            self.connection.close()
+        self.buffer = ''
+
+
+class PooledHTTPHandler(urllib2.BaseHandler):
+    """urllib2 handler that keeps idle connections open per host.
+
+    Asks for gzip and decodes it, and applies separate connect and read
+    timeouts. Runs ahead of urllib2's own HTTP(S)Handler, which only open
+    a connection per request.
+    """
+
+    handler_order = 400
+
+    def __init__(self, connect_timeout=5.0, read_timeout=10.0, max_idle=4):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, key):
+        with self.lock:
+            connections = self.idle.get(key)
+            if connections:
+                return connections.pop()
+        return None
+
+    def release(self, key, connection):
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def connect(self, connection_class, host):
+        connection = connection_class(host, timeout=self.connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(self.read_timeout)
+        return connection
+
+    def request(self, connection, req):
+        headers = dict(req.unredirected_hdrs)
+        headers.update(req.headers)
+        headers.setdefault('Accept-Encoding', 'gzip')
+        headers = dict((name.title(), value)
+                       for name, value in headers.iteritems())
+        connection.request(req.get_method(), req.get_selector(),
+                           req.get_data(), headers)
+        return connection.getresponse()
+
+    def open(self, connection_class, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        key = (connection_class, host)
+
+        connection = self.acquire(key)
+        try:
+            if connection is not None:
+                try:
+                    response = self.request(connection, req)
+                except socket.timeout:
+                    raise
+                except (httplib.HTTPException, socket.error):
+                    # the server closed the idle connection, start over
+                    connection.close()
+                    connection = None
+            if connection is None:
+                connection = self.connect(connection_class, host)
+                response = self.request(connection, req)
+        except (httplib.HTTPException, socket.error) as e:
+            if connection is not None:
+                connection.close()
+            raise urllib2.URLError(e)
+
+        result = urllib2.addinfourl(PooledResponse(self, key, connection,
+                                                   response),
+                                    response.msg,
+                                    req.get_full_url())
+        result.code = response.status
+        result.msg = response.reason
+        return result
+
+    def http_open(self, req):
+        return self.open(httplib.HTTPConnection, req)
+
+    def https_open(self, req):
+        return self.open(httplib.HTTPSConnection, req)
+
+
+http_pool = PooledHTTPHandler(app.config.get('HTTP_CONNECT_TIMEOUT', 5.0),
+                              app.config.get('HTTP_READ_TIMEOUT', 10.0),
+                              app.config.get('HTTP_MAX_IDLE', 4))
+# only makeRequest goes through the pool, urllib2.urlopen is left alone
+http_opener = urllib2.build_opener(http_pool)
+
+
+def makeRequest(url, headers=None):
+    headers = dict(headers or {})
+    headers['User-Agent'] = USER_AGENT
     request = urllib2.Request(url, headers=headers)
-    result = urllib2.urlopen(request)
+    host = urlparse.urlparse(url).netloc
+    try:
+        with StageTimer('upstream_request'):
+            result = http_opener.open(request)
+    except urllib2.HTTPError as e:
+        upstream_responses.inc(1, host, str(e.code))
+        raise
+    except Exception:
+        upstream_responses.inc(1, host, 'error')
+        raise
+    code = getattr(result, 'code', None)
+    upstream_responses.inc(1, host, str(code if isinstance(code, int) else 200))
     return result
 
 
+class RateLimitExceeded(Exception):
+    pass
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket that hands out request slots in FIFO order.
+
+    reserve() books the next free slot and returns how long the caller has
+    to wait for it, so concurrent callers queue up one interval apart instead
+    of all sleeping for the same amount of time and then racing each other.
+    """
+
+    def __init__(self, interval, burst=1):
+        self.interval = float(interval)
+        self.burst = max(int(burst), 1)
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def reserve(self, max_wait=None):
+        with self.lock:
+            now = time.time()
+            burst_window = (self.burst - 1) * self.interval
+            wait = max(0.0, self.next_slot - burst_window - now)
+            if max_wait is not None and wait > max_wait:
+                raise RateLimitExceeded('%.2fs wait exceeds %.2fs' % (wait,
+                                                                     max_wait))
+            self.next_slot = max(self.next_slot, now) + self.interval
+            return wait
+
+    def record(self, wait):
+        with self.lock:
+            self.requests += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+
+def claimSharedSlot(domain, interval, earliest, max_wait=None):
+    """Claim a request slot for domain in the shared cache.
+
+    Time is cut into interval-long slots and a slot belongs to whichever
+    process manages to add its key first, which caps the aggregate request
+    rate of every worker sharing the cache at one request per interval.
+    Returns the start time of the claimed slot.
+    """
+    token = uuid.uuid4().hex
+    first_slot = int(math.ceil(earliest / interval))
+    attempts = 1
+    if max_wait is not None:
+        attempts += int(max_wait / interval)
+
+    for slot in xrange(first_slot, first_slot + attempts):
+        key = 'ratelimit+%s+%d' % (domain, slot)
+        cache.add(key, token, timeout=int(math.ceil(interval)) + 1)
+        if cache.get(key) == token:
+            return slot * interval
+
+    raise RateLimitExceeded('No free shared slot for %s' % domain)
+
+
 rate_limited_requests = {}
+rate_limited_requests_lock = threading.Lock()
 
 
-def rateLimitedRequest(url, timeout):
-    global rate_limited_requests
+def getTokenBucket(domain, interval):
+    with rate_limited_requests_lock:
+        bucket = rate_limited_requests.get(domain)
+        if bucket is None:
+            bucket = TokenBucket(interval,
+                                 app.config.get('RATE_LIMIT_BURST', 1))
+            rate_limited_requests[domain] = bucket
+        return bucket
+
+
+def recordRateLimitWait(wait):
+    if not has_request_context():
+        return
+    g.rate_limit_wait = getattr(g, 'rate_limit_wait', 0.0) + wait
+
+
+def rateLimitedRequest(url, timeout, headers=None):
     domain = urlparse.urlparse(url).netloc
-    last_request_time = rate_limited_requests.get(domain, datetime(1979, 1, 1, 1))
-    request_time = datetime.now()
-    delta = request_time - last_request_time
-    if delta.seconds < timeout:
-        time.sleep(timeout-delta.seconds)
-    response = makeRequest(url)
-    request_time = datetime.now()
-    rate_limited_requests[domain] = request_time
-    return response
+    bucket = getTokenBucket(domain, timeout)
+    max_wait = app.config.get('RATE_LIMIT_MAX_WAIT', None)
+
+    request_time = time.time()
+    start_time = request_time + bucket.reserve(max_wait)
+    if app.config.get('RATE_LIMIT_SHARED', False):
+        start_time = claimSharedSlot(domain, bucket.interval, start_time,
+                                     max_wait)
+
+    wait = max(0.0, start_time - time.time())
+    if wait:
+        time.sleep(wait)
+
+    wait = time.time() - request_time
+    bucket.record(wait)
+    recordRateLimitWait(wait)
+    rate_limit_wait_seconds.observe(wait, domain)
+    logging.debug('Waited %.3fs for %s rate limit', wait, domain)
+
+    return makeRequest(url, headers)
+
+
+def rateLimitStats():
+    with rate_limited_requests_lock:
+        buckets = rate_limited_requests.items()
+
+    stats = {}
+    for domain, bucket in buckets:
+        with bucket.lock:
+            stats[domain] = {
+                'requests': bucket.requests,
+                'total_wait': bucket.total_wait,
+                'max_wait': bucket.max_wait
+            }
+    return stats
+
+
+class NotModified(Exception):
+    """A conditional request found the cached copy still current."""
+    pass
+
+
+conditional_stats = {
+    'not_modified': 0,
+    'bytes_saved': 0,
+    'parse_seconds_saved': 0.0
+}
+conditional_stats_lock = threading.Lock()
+listing_fetch = threading.local()
+
+
+def responseValidators(response):
+    """ETag, Last-Modified and size of response, for a later conditional
+    request, or None if it has no validators."""
+    headers = response.info()
+    validators = {
+        'etag': headers.getheader('ETag'),
+        'last_modified': headers.getheader('Last-Modified'),
+        'bytes': int(headers.getheader('Content-Length') or 0),
+        'parse_seconds': 0.0
+    }
+    if not validators['etag'] and not validators['last_modified']:
+        return None
+    return validators
+
+
+def conditionalHeaders(validators):
+    headers = {}
+    if validators and validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators and validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
 
+def recordNotModified(url, validators):
+    with conditional_stats_lock:
+        conditional_stats['not_modified'] += 1
+        conditional_stats['bytes_saved'] += validators['bytes']
+        conditional_stats['parse_seconds_saved'] += validators['parse_seconds']
+    logging.info('%s not modified, saved %d bytes and %.1fms parsing', url,
+                 validators['bytes'], validators['parse_seconds'] * 1000)
 
-def getRedditResponse(subreddits, sort='top', t='week', limit=100):
+
+def listingValidatorKey(url):
+    return 'validators+%s' % hashlib.md5(url).hexdigest()
+
+
+def storeListingValidators():
+    """Remember the validators of the listing this thread just parsed.
+
+    They are kept as long as the entries made from the listing, a 304 is
+    no use once those are gone.
+    """
+    pending = getattr(listing_fetch, 'pending', None)
+    listing_fetch.pending = None
+    if pending is None:
+        return
+    key, validators, opened, timeout = pending
+    validators['parse_seconds'] = time.time() - opened
+    cache.set(key, validators, timeout=timeout)
+
+
+def openRedditListing(subreddits, sort, t, limit, after):
     query = {
         't': t,
         'limit': limit
     }
+    if after:
+        query['after'] = after
     query_string = urllib.urlencode(query)
 
     request_url = '%s/r/%s/%s.json?%s' % (REDDIT_URL,
@@ -116,18 +752,52 @@ def getRedditResponse(subreddits, sort='top', t='week', limit=100):
                                           sort,
                                           query_string)
 
+    headers = {}
+    validators = None
+    listing_fetch.pending = None
+    conditional = app.config.get('CONDITIONAL_GET', False)
+    if conditional:
+        validators = cache.get(listingValidatorKey(request_url))
+        headers = conditionalHeaders(validators)
+
     try:
-        response = rateLimitedRequest(request_url, 2.0)
-    except urllib2.HTTPError:
+        response = rateLimitedRequest(
+            request_url, app.config.get('REDDIT_REQUEST_INTERVAL', 2.0),
+            headers)
+    except urllib2.HTTPError as e:
+        if e.code == 304 and validators:
+            recordNotModified(request_url, validators)
+            # the entries are about to be extended, so are the validators
+            cache.set(listingValidatorKey(request_url), validators,
+                      timeout=getCacheWindow(t)[1])
+            raise NotModified(listingValidatorKey(request_url))
+        return None
+    except RateLimitExceeded:
+        logging.warning('Rate limit budget exceeded for %s', request_url)
         return None
 
+    if conditional and response:
+        new_validators = responseValidators(response)
+        if new_validators:
+            listing_fetch.pending = (listingValidatorKey(request_url),
+                                     new_validators, time.time(),
+                                     getCacheWindow(t)[1])
+    return response
+
+
+def getRedditResponse(subreddits, sort='top', t='week', limit=100, after=None):
+    response = openRedditListing(subreddits, sort, t, limit, after)
     if not response:
         return None
 
-    body = response.read()
-    response.close()
+    with StageTimer('reddit_read'):
+        body = response.read()
+        response.close()
+    upstream_payload_bytes.observe(len(body),
+                                   urlparse.urlparse(REDDIT_URL).netloc)
     try:
-        response_object = json.loads(body)
+        with StageTimer('json_decode'):
+            response_object = json.loads(body)
     except ValueError:
         return None
     if response_object.get('error') is not None:
@@ -136,6 +806,188 @@ def getRedditResponse(subreddits, sort='top', t='week', limit=100):
     return response_object
 
 
+class StreamedListing(object):
+    """Decodes the children of a Reddit listing while it is being read.
+
+    Iterating yields the data dict of one child at a time. Only the current
+    child and the unread part of the last chunk are held in memory, rather
+    than the whole body and its decoded object. Once iteration is over,
+    after holds the listing's cursor and valid tells whether a listing was
+    found at all; error responses and invalid JSON leave it False.
+    """
+
+    children_pattern = re.compile(r'"children"\s*:\s*\[')
+    after_pattern = re.compile(r'"after"\s*:\s*("(?:[^"\\]|\\.)*"|null)')
+    token_pattern = re.compile(r'[{}\[\]"]')
+    string_pattern = re.compile(r'\\.|"')
+    value_pattern = re.compile(r'[^\s,]')
+
+    def __init__(self, response, chunk_size=16 * 1024):
+        self.response = response
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.eof = False
+        self.after = None
+        self.valid = False
+        self.peak_buffer = 0
+        self.bytes_read = 0
+
+    def readChunk(self, keep_from):
+        chunk = self.response.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.bytes_read += len(chunk)
+        self.buffer = self.buffer[keep_from:] + chunk
+        self.peak_buffer = max(self.peak_buffer, len(self.buffer))
+        return True
+
+    def findAfter(self, text):
+        match = self.after_pattern.search(text)
+        if match:
+            self.after = json.loads(match.group(1))
+
+    def findChildren(self):
+        while True:
+            match = self.children_pattern.search(self.buffer)
+            if match:
+                self.findAfter(self.buffer[:match.start()])
+                return match.end()
+            # keep enough of the tail to match a key split between chunks
+            if not self.readChunk(max(len(self.buffer) - 64, 0)):
+                return None
+
+    def findObjectEnd(self, start):
+        depth = 0
+        pos = start
+        in_string = False
+        while True:
+            if in_string:
+                match = self.string_pattern.search(self.buffer, pos)
+                if match and match.group() == '"':
+                    in_string = False
+            else:
+                match = self.token_pattern.search(self.buffer, pos)
+                if match:
+                    token = match.group()
+                    if token == '"':
+                        in_string = True
+                    elif token in '{[':
+                        depth += 1
+                    elif depth == 0:
+                        # the children array closed before an object began
+                        return None, start
+                    else:
+                        depth -= 1
+                        if depth == 0:
+                            return match.end(), start
+            if match:
+                pos = match.end()
+                continue
+
+            # the object continues in the next chunk
+            offset = start
+            if not self.readChunk(offset):
+                return None, start
+            pos -= offset
+            start = 0
+
+    def __iter__(self):
+        pos = self.findChildren()
+        if pos is None:
+            self.valid = self.validateBody()
+            return
+
+        while True:
+            while True:
+                match = self.value_pattern.search(self.buffer, pos)
+                if match:
+                    break
+                if not self.readChunk(len(self.buffer)):
+                    return
+                pos = 0
+
+            if match.group() != '{':
+                pos = match.end()
+                break
+
+            end, start = self.findObjectEnd(match.start())
+            if end is None:
+                return
+            child = json.loads(self.buffer[start:end])
+            self.buffer = self.buffer[end:]
+            pos = 0
+            yield child.get('data', {})
+
+        rest = self.buffer[pos:]
+        while self.readChunk(0):
+            pass
+        self.findAfter(rest + self.buffer)
+        self.valid = True
+
+    def validateBody(self):
+        try:
+            response_object = json.loads(self.buffer)
+        except ValueError:
+            return False
+        return response_object.get('error') is None
+
+
+def streamRedditLinks(subreddits, sort, t, limit=100, after=None):
+    response = openRedditListing(subreddits, sort, t, limit, after)
+    if not response:
+        return None
+
+    listing = StreamedListing(response,
+                              app.config.get('STREAM_CHUNK_SIZE', 16 * 1024))
+    try:
+        with StageTimer('stream_decode'):
+            links = [link for link in iterStreamedLinks(listing)]
+    except ValueError:
+        return None
+    finally:
+        response.close()
+    upstream_payload_bytes.observe(listing.bytes_read,
+                                   urlparse.urlparse(REDDIT_URL).netloc)
+
+    if not listing.valid:
+        return None
+    return links, listing.after
+
+
+def iterStreamedLinks(listing):
+    for child in listing:
+        link = parseChild(child)
+        if link is not None:
+            yield link
+
+
+def getRedditLinks(subreddits, sort, t, after=None):
+    """Fetch and parse one listing page, returning (links, after) or None.
+
+    With STREAM_DECODE the page is decoded child by child as it arrives,
+    otherwise it is read and decoded in one go by getRedditResponse. With
+    CONDITIONAL_GET, raises NotModified if Reddit answers 304 to a repeat
+    request for the page.
+    """
+    if app.config.get('STREAM_DECODE', False):
+        page = streamRedditLinks(subreddits, sort, t, 100, after)
+    else:
+        if after:
+            reddit_response = getRedditResponse(subreddits, sort, t, 100, after)
+        else:
+            reddit_response = getRedditResponse(subreddits, sort, t, 100)
+        if not reddit_response:
+            return None
+        with StageTimer('parse'):
+            page = (parseRedditResponse(reddit_response),
+                    reddit_response['data'].get('after'))
+
+    if page is not None:
+        storeListingValidators()
+    return page
+
+
 def sanitiseShortYouTubeURL(url):
     if not 'youtu.be' in url:
         return None
@@ -171,67 +1023,187 @@ def sanitiseURL(url):
         return None
 
 
-def parseChild(child):
-    accepted_keys = [
-        'id',
-        'title',
-        'url',
-        'permalink',
-        'num_comments',
-        'ups',
-        'downs',
-        'author',
-        'subreddits',
-        'created_utc',
-    ]
-
-    for key in child.keys():
-        if key not in accepted_keys:
-            del child[key]
-
-    return child
+LINK_FIELDS = (
+    'id',
+    'title',
+    'url',
+    'permalink',
+    'num_comments',
+    'ups',
+    'downs',
+    'author',
+    'subreddit',
+    'created_utc',
+)
 
 
-def parseRedditResponse(response_object):
-    response_copy = copy.deepcopy(response_object)
-    html_parser = HTMLParser.HTMLParser()
+class Link(object):
+    """A parsed Reddit link holding only the fields the playlist uses.
+
+    Links are read like the dicts they replace, with get() and item access,
+    so the templates and sort functions work with either. video_id is the
+    YouTube video id, extracted once while parsing.
+    """
+
+    __slots__ = LINK_FIELDS + ('video_id',)
+    fields = frozenset(__slots__)
+
+    def __init__(self, **fields):
+        for field in self.__slots__:
+            setattr(self, field, fields.get(field))
+
+    def get(self, field, default=None):
+        if field not in self.fields:
+            return default
+        value = getattr(self, field)
+        if value is None:
+            return default
+        return value
+
+    def __getitem__(self, field):
+        value = self.get(field)
+        if value is None:
+            raise KeyError(field)
+        return value
+
+    def __setitem__(self, field, value):
+        if field not in self.fields:
+            raise KeyError(field)
+        setattr(self, field, value)
+
+    def __contains__(self, field):
+        return self.get(field) is not None
+
+    def __eq__(self, other):
+        if not isinstance(other, Link):
+            return NotImplemented
+        return self.__getstate__() == other.__getstate__()
 
-    children = response_copy['data']['children']
-    children = [child['data'] for child in children]
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
 
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def __setstate__(self, state):
+        for field, value in zip(self.__slots__, state):
+            setattr(self, field, value)
+
+    def __repr__(self):
+        return 'Link(%r)' % self.asDict()
+
+    def asDict(self):
+        return dict((field, getattr(self, field))
+                    for field in self.__slots__
+                    if getattr(self, field) is not None)
+
+    def copy(self):
+        return Link(**self.asDict())
+
+
+html_parser = HTMLParser.HTMLParser()
+
+
+def parseChild(child):
+    """Build a Link from the data of a listing child.
+
+    Only the LINK_FIELDS are read, the child itself is left untouched.
+    Returns None for children that don't link to a YouTube video.
+    """
+    url = child.get('url')
+    if url:
+        url = sanitiseURL(url)
+    if not url:
+        return None
+
+    return Link(id=child.get('id'),
+                title=html_parser.unescape(child.get('title')),
+                url=url,
+                permalink='%s%s' % (REDDIT_URL, child.get('permalink')),
+                num_comments=child.get('num_comments'),
+                ups=child.get('ups'),
+                downs=child.get('downs'),
+                author=child.get('author'),
+                subreddit=child.get('subreddit'),
+                created_utc=child.get('created_utc'),
+                video_id=youTubeVideoId(url))
+
+
+def parseRedditResponse(response_object):
     links = []
-    for child in children:
-        url = sanitiseURL(child.get('url'))
-        if not url:
-            continue
-        child['url'] = url
-        child['title'] = html_parser.unescape(child.get('title'))
-        child['permalink'] = '%s%s' % (REDDIT_URL,
-                                       child.get('permalink'))
-        child = parseChild(child)
-        links.append(child)
+    for child in response_object['data']['children']:
+        link = parseChild(child['data'])
+        if link is not None:
+            links.append(link)
 
     return links
 
 
+def youTubeVideoId(url):
+    if not url:
+        return None
+    v_id = urlparse.parse_qs(urlparse.urlparse(url).query).get('v')
+    if not v_id:
+        return None
+    return v_id[0]
+
+
+def linkVideoId(link):
+    return getattr(link, 'video_id', None) or youTubeVideoId(link.get('url'))
+
+
+def linkKey(link):
+    return linkVideoId(link) or link.get('url')
+
+
+merged_fields = ('ups', 'downs', 'num_comments')
+
+
+def mergeLinks(link, duplicate):
+    # copy rather than update in place, cached links are shared by requests
+    merged = link.copy()
+    for field in merged_fields:
+        if field in duplicate:
+            merged[field] = merged.get(field, 0) + duplicate[field]
+    return merged
+
+
 def removeDuplicates(links):
-    urls = []
+    """Drop links to videos that are already in the list, keeping order.
+
+    Links are matched on their YouTube video id, so the same video posted
+    with different URLs counts as one. The votes and comment counts of
+    later posts are added to the first one. A post that is in the list
+    twice, say from overlapping listing pages, is only counted once.
+    """
+    seen = {}
+    seen_posts = set()
     new_links = []
     for link in links:
-        if link.get('url') not in urls:
+        post_id = link.get('id')
+        if post_id is not None:
+            if post_id in seen_posts:
+                continue
+            seen_posts.add(post_id)
+        key = linkKey(link)
+        index = seen.get(key)
+        if index is None:
+            seen[key] = len(new_links)
             new_links.append(link)
-            urls.append(link.get('url'))
+        else:
+            new_links[index] = mergeLinks(new_links[index], link)
     return new_links
 
 
 def generateYouTubeURL(links):
     youtube_ids = []
     for entry in links:
-        link_url = entry.get('url')
-        v_id = urlparse.parse_qs(urlparse.urlparse(link_url).query).get("v")
+        v_id = linkVideoId(entry)
         if not v_id:
             continue
-        v_id = v_id[0]
         youtube_ids.append(v_id)
 
     first_id = youtube_ids[0]
@@ -255,39 +1227,639 @@ def generateYouTubeURL(links):
     return youtube_url
 
 
-def getLinks(subreddits, sort, t):
-    subreddits_to_get = []
-    links = []
+def recordCacheLookup(hits, misses):
+    cache_lookups.inc(hits, 'hit')
+    cache_lookups.inc(misses, 'miss')
+    if not has_request_context():
+        return
+    g.cache_hits = getattr(g, 'cache_hits', 0) + hits
+    g.cache_misses = getattr(g, 'cache_misses', 0) + misses
+
+
+def recordRedditFailure():
+    if not has_request_context():
+        return
+    g.reddit_failed = True
+
+
+default_cache_windows = {
+    'day': (60 * 10, 60 * 60 * 2),
+    'week': (60 * 30, 60 * 60 * 6),
+    'month': (60 * 60 * 2, 60 * 60 * 24),
+    'year': (60 * 60 * 6, 60 * 60 * 24 * 3),
+    'all': (60 * 60 * 12, 60 * 60 * 24 * 7)
+}
+
+
+def getCacheWindow(t):
+    """Return the (soft, hard) expiry in seconds for link lists of range t.
+
+    Entries are served as-is until the soft expiry, served stale while being
+    refreshed in the background until the hard expiry, and dropped by the
+    cache after that.
+    """
+    cache_windows = app.config.get('CACHE_WINDOWS', default_cache_windows)
+    return cache_windows.get(t, default_cache_windows['week'])
+
+
+CacheEntry = collections.namedtuple('CacheEntry',
+                                    ['links', 'soft_expires', 'after'])
+
+
+class PickleCodec(object):
+    """Stores values as protocol 0 pickles.
+
+    Links are pickled as Link records, whose state is the tuple of their
+    field values in __slots__ order.
+    """
+
+    def dumps(self, value):
+        return pickle.dumps(value)
+
+    def loads(self, value):
+        return pickle.loads(value)
+
+    def encodeEntry(self, entry):
+        return self.dumps((entry.soft_expires, entry.links, entry.after))
+
+    def decodeEntry(self, value):
+        soft_expires, links, after = self.loads(value)
+        return CacheEntry(links, soft_expires, after)
+
+
+class CompactCodec(object):
+    """Stores values with marshal, zlib compressed above a size threshold.
+
+    Link lists are stored as one tuple of field values per link, so field
+    names are written once per entry rather than once per link.
+    Encoded values start with 'c' and a compression flag, which is how they
+    are told apart from pickles.
+    """
+
+    tag = 'c'
+
+    def __init__(self, compress_threshold=1024):
+        self.compress_threshold = compress_threshold
+
+    def dumps(self, value):
+        payload = marshal.dumps(value)
+        if len(payload) >= self.compress_threshold:
+            return self.tag + 'z' + zlib.compress(payload)
+        return self.tag + '-' + payload
+
+    def loads(self, value):
+        payload = value[2:]
+        if value[1] == 'z':
+            payload = zlib.decompress(payload)
+        return marshal.loads(payload)
+
+    def encodeEntry(self, entry):
+        rows = [tuple(link.get(field) for field in Link.__slots__)
+                for link in entry.links]
+        return self.dumps((Link.__slots__, entry.soft_expires, entry.after,
+                           rows))
+
+    def decodeEntry(self, value):
+        fields, soft_expires, after, rows = self.loads(value)
+        links = [Link(**dict(zip(fields, row))) for row in rows]
+        return CacheEntry(links, soft_expires, after)
+
+
+def getCacheCodec():
+    if app.config.get('CACHE_CODEC', 'pickle') == 'compact':
+        return CompactCodec(app.config.get('CACHE_COMPRESS_THRESHOLD', 1024))
+    return PickleCodec()
+
+
+def getDecoder(value):
+    if value[:1] == CompactCodec.tag:
+        return CompactCodec()
+    return PickleCodec()
+
+
+def encodeCacheEntry(links, soft_expires, after=None):
+    return getCacheCodec().encodeEntry(CacheEntry(links, soft_expires, after))
+
+
+# what decoding a value written in another format can raise
+cache_decode_errors = (ValueError, TypeError, KeyError, IndexError, EOFError,
+                       AttributeError, pickle.UnpicklingError, zlib.error)
+
+
+def decodeCacheEntry(value):
+    """Decode a cache entry, raising ValueError for values stored in an
+    older format."""
+    entry = getDecoder(value).decodeEntry(value)
+    if not isinstance(entry.soft_expires, (int, long, float)) or \
+            not isinstance(entry.links, list):
+        raise ValueError('Not a cache entry')
+    return entry
+
+
+def isStale(entry):
+    return entry.soft_expires <= time.time()
+
+
+def getCachedLinks(keys, extra_keys=()):
+    """Look up several cache entries in one cache round trip.
+
+    Returns a dict mapping each key that was found to its CacheEntry.
+    extra_keys, such as cursors, are looked up in the same round trip but
+    left out of the cache hit and miss counts.
+    Values that can't be decoded, such as entries written by an older
+    version, count as missing and are overwritten by the next fetch.
+    """
+    if not keys:
+        return {}
+
+    all_keys = list(keys) + list(extra_keys)
+    with StageTimer('cache_get'):
+        values = cache.get_many(*all_keys)
+
+    entries = {}
+    for key, value in zip(all_keys, values):
+        if not value:
+            continue
+        try:
+            entries[key] = decodeCacheEntry(value)
+        except cache_decode_errors:
+            logging.warning('Ignoring undecodable cache entry %s', key)
+
+    hits = sum(1 for key in keys if key in entries)
+    recordCacheLookup(hits, len(keys) - hits)
+    return entries
+
+
+def setCachedLinks(links_by_key, t, pages=None):
+    """Store link lists, and optionally listing pages, in one round trip.
+
+    pages maps page keys to (links, after) tuples, after being the cursor of
+    the page that follows.
+    """
+    if not links_by_key and not pages:
+        return
+
+    soft_timeout, hard_timeout = getCacheWindow(t)
+    soft_expires = time.time() + soft_timeout
+
+    mapping = {}
+    for key, links in links_by_key.iteritems():
+        mapping[key] = encodeCacheEntry(links, soft_expires)
+        mapping[generationCacheKey(key)] = repr(soft_expires)
+    for key, (links, after) in (pages or {}).iteritems():
+        mapping[key] = encodeCacheEntry(links, soft_expires, after)
+    with StageTimer('cache_set'):
+        cache.set_many(mapping, timeout=hard_timeout)
+
+    logging.debug('Cached %d entries in %d bytes', len(mapping),
+                  sum(len(value) for value in mapping.itervalues()))
+
+
+def selectionCacheKey(subreddits, sort, t):
+    # selections are hashed, memcached refuses keys longer than 250 bytes
+    subreddits = '+'.join(sorted(subreddit.lower() for subreddit in subreddits))
+    return linkCacheKey(hashlib.md5(subreddits.encode('utf-8')).hexdigest(),
+                        sort, t)
+
+
+def pageCacheKey(subreddits, sort, t, after):
+    return 'page+%s+%s' % (selectionCacheKey(subreddits, sort, t),
+                           after or 'first')
+
+
+def cursorCacheKey(subreddits, sort, t):
+    return 'cursor+%s' % selectionCacheKey(subreddits, sort, t)
+
+
+def flightCacheKey(subreddits, sort, t):
+    return 'flight+%s' % selectionCacheKey(subreddits, sort, t)
+
+
+def generationCacheKey(key):
+    return 'generation+%s' % key
+
+
+def renderedPageKey(subreddits, sort, t, limit):
+    subreddits = set(subreddit.lower() for subreddit in subreddits)
+    return 'render+%s+%d' % (selectionCacheKey(subreddits, sort, t), limit)
+
+
+def pageGenerationKeys(subreddits, sort, t):
+    subreddits = sorted(set(subreddit.lower() for subreddit in subreddits))
+    return [generationCacheKey(linkCacheKey(subreddit, sort, t))
+            for subreddit in subreddits]
+
+
+def getRenderedPage(key, subreddits, sort, t):
+    """Return the cached page for key, unless any of the link entries it
+    was rendered from has been written since."""
+    values = cache.get_many(key, *pageGenerationKeys(subreddits, sort, t))
+    if values[0] is None:
+        return None
+    generations, page = values[0]
+    if list(generations) != list(values[1:]):
+        return None
+    return page
+
+
+def setRenderedPage(key, subreddits, sort, t, page):
+    """Cache page until the first of its link entries goes stale, so stale
+    entries still get refreshed by the next request that renders it."""
+    generations = cache.get_many(*pageGenerationKeys(subreddits, sort, t))
+    if None in generations:
+        return
+    timeout = int(min(float(generation) for generation in generations)
+                  - time.time())
+    if timeout <= 0:
+        return
+    cache.set(key, (list(generations), page), timeout=timeout)
+
+
+class InFlightCall(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Collapses concurrent calls that share a key into a single call.
+
+    The first caller for a key runs the function, every caller that arrives
+    while it is still running waits for it and gets the same result (or the
+    same exception) back.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = InFlightCall()
+                self.calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+        return call.result
+
+
+in_flight_fetches = SingleFlight()
+
+
+def linkCacheKey(subreddit, sort, t):
+    return "%s+%s+%s" % (subreddit.lower(), sort, t)
+
+
+def acquireSharedFlight(flight_key):
+    token = uuid.uuid4().hex
+    timeout = app.config.get('SINGLE_FLIGHT_LOCK_TIMEOUT', 15)
+    cache.add(flight_key, token, timeout=timeout)
+    if cache.get(flight_key) == token:
+        return token
+    return None
+
+
+def waitForSharedFlight(flight_key, subreddits, sort, t):
+    """Wait for another worker's fetch of subreddits to land in the cache.
+
+    Returns the cached links and the cursor of the next page once that worker
+    marks the flight as done, or None if it gave up, the wait timed out or
+    the entries are gone, in which case the caller should fetch the links
+    itself.
+    """
+    timeout = app.config.get('SINGLE_FLIGHT_LOCK_TIMEOUT', 15)
+    poll_interval = app.config.get('SINGLE_FLIGHT_POLL_INTERVAL', 0.1)
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        state = cache.get(flight_key)
+        if state is None:
+            return None
+        if state == 'done':
+            keys = [linkCacheKey(subreddit, sort, t)
+                    for subreddit in subreddits]
+            cursor_key = cursorCacheKey(subreddits, sort, t)
+            entries = getCachedLinks(keys, [cursor_key])
+            if cursor_key not in entries:
+                return None
+            links = []
+            for key in keys:
+                if key in entries:
+                    links.extend(entries[key].links)
+            return links, entries[cursor_key].after
+        time.sleep(poll_interval)
+
+    return None
+
+
+def partitionLinks(links, subreddits, sort, t):
+    """Split a combined listing into one cache entry per subreddit.
+
+    Links are indexed by their own subreddit field in a single pass, so each
+    entry only holds that subreddit's links. Requested subreddits without
+    any links get an empty entry, which saves refetching them until the
+    entry goes stale.
+    """
+    links_by_subreddit = {}
+    for link in links:
+        subreddit = (link.get('subreddit') or '').lower()
+        links_by_subreddit.setdefault(subreddit, []).append(link)
+
+    links_to_cache = {}
     for subreddit in subreddits:
-        key = "%s+%s+%s" % (subreddit, sort, t)
-        subreddit_links = cache.get(key)
-        if not subreddit_links:
-            subreddits_to_get.append(subreddit)
-        else:
-            links.extend(pickle.loads(subreddit_links))
+        key = linkCacheKey(subreddit, sort, t)
+        links_to_cache[key] = links_by_subreddit.get(subreddit.lower(), [])
+    return links_to_cache
 
-    if subreddits_to_get:
-        reddit_response = getRedditResponse(subreddits_to_get, sort, t, 100)
-        if not reddit_response:
-            flash('No Reddit response', 'error')
+
+def fetchLinks(subreddits, sort, t):
+    """Fetch the first listing page for subreddits and cache it.
+
+    Returns the parsed links together with the cursor of the next page, or
+    None if Reddit could not be reached.
+    """
+    try:
+        page = getRedditLinks(subreddits, sort, t)
+    except NotModified as e:
+        page = extendCachedLinks(subreddits, sort, t)
+        if page is not None:
+            return page
+        # the entries are gone, so the validators are no use either
+        cache.delete(e.args[0])
+        page = getRedditLinks(subreddits, sort, t)
+    if page is None:
+        return None
+
+    response_links, after = page
+
+    links_to_cache = partitionLinks(response_links, subreddits, sort, t)
+    # the page's links are already in the per-subreddit entries, so only
+    # remember where the next page starts
+    cursor_key = cursorCacheKey(subreddits, sort, t)
+    setCachedLinks(links_to_cache, t, {cursor_key: ([], after)})
+
+    return response_links, after
+
+
+def extendCachedLinks(subreddits, sort, t):
+    """Rewrite the cached first page of subreddits with a new expiry.
+
+    Returns its links and cursor, or None if any part of it is no longer
+    cached.
+    """
+    keys = [linkCacheKey(subreddit, sort, t) for subreddit in subreddits]
+    cursor_key = cursorCacheKey(subreddits, sort, t)
+    entries = getCachedLinks(keys, [cursor_key])
+    if len(entries) < len(set(keys)) + 1:
+        return None
+
+    links_by_key = dict((key, entries[key].links) for key in keys)
+    after = entries[cursor_key].after
+    setCachedLinks(links_by_key, t, {cursor_key: ([], after)})
+
+    links = []
+    for key in keys:
+        links.extend(entries[key].links)
+    return links, after
+
+
+def fetchLinksOnce(subreddits, sort, t):
+    if not app.config.get('SINGLE_FLIGHT_SHARED', False):
+        return fetchLinks(subreddits, sort, t)
+
+    flight_key = flightCacheKey(subreddits, sort, t)
+    token = acquireSharedFlight(flight_key)
+    if token is None:
+        links = waitForSharedFlight(flight_key, subreddits, sort, t)
+        if links is not None:
             return links
+        return fetchLinks(subreddits, sort, t)
+
+    try:
+        links = fetchLinks(subreddits, sort, t)
+    except Exception:
+        cache.delete(flight_key)
+        raise
+
+    if links is None:
+        cache.delete(flight_key)
+    else:
+        cache.set(flight_key, 'done',
+                  timeout=app.config.get('SINGLE_FLIGHT_LOCK_TIMEOUT', 15))
+    return links
+
+
+fetch_pool = None
+fetch_pool_lock = threading.Lock()
+
+
+def getFetchPool():
+    global fetch_pool
+    with fetch_pool_lock:
+        if fetch_pool is None:
+            fetch_pool = ThreadPool(app.config.get('FETCH_WORKERS', 4))
+        return fetch_pool
+
+
+def groupSubreddits(subreddits):
+    """Split the subreddits to fetch into the listings to request.
+
+    In the default 'combined' FETCH_MODE every subreddit goes into a single
+    listing. In 'split' mode they are fetched in groups of FETCH_GROUP_SIZE,
+    so one busy subreddit can't crowd the others out of a 100 link page.
+    """
+    if app.config.get('FETCH_MODE', 'combined') != 'split':
+        return [subreddits]
+    size = max(app.config.get('FETCH_GROUP_SIZE', 1), 1)
+    return [subreddits[i:i + size] for i in xrange(0, len(subreddits), size)]
+
+
+def fetchGroup(subreddits, sort, t):
+    fetch_key = linkCacheKey('+'.join(subreddits).lower(), sort, t)
+    return in_flight_fetches.do(fetch_key, fetchLinksOnce, subreddits, sort, t)
+
 
-        response_links = parseRedditResponse(reddit_response)
+def fetchGroups(groups, sort, t):
+    """Fetch the first page of each group, in parallel if there are several.
+
+    Groups run on a pool of FETCH_WORKERS threads. Each fetch still waits for
+    its slot from the rate limiter, so RATE_LIMIT_BURST bounds how many of
+    them reach Reddit at once. Returns one (links, after) tuple, or None for
+    a failed fetch, per group.
+    """
+    if len(groups) == 1:
+        return [fetchGroup(groups[0], sort, t)]
+
+    pool = getFetchPool()
+    results = [pool.apply_async(fetchGroup, (group, sort, t))
+               for group in groups]
+    return [result.get() for result in results]
+
+
+refreshing_keys = set()
+refreshing_keys_lock = threading.Lock()
+
+
+def refreshLinks(fetch_key, subreddits, sort, t):
+    try:
+        fetchGroups(groupSubreddits(subreddits), sort, t)
+    except Exception:
+        logging.exception('Background refresh of %s failed', fetch_key)
+    finally:
+        with refreshing_keys_lock:
+            refreshing_keys.discard(fetch_key)
+
+
+def refreshLinksInBackground(subreddits, sort, t):
+    fetch_key = linkCacheKey('+'.join(subreddits).lower(), sort, t)
+    with refreshing_keys_lock:
+        if fetch_key in refreshing_keys:
+            return None
+        refreshing_keys.add(fetch_key)
+
+    thread = threading.Thread(target=refreshLinks,
+                              args=(fetch_key, subreddits, sort, t))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def getRedditPage(subreddits, sort, t, after):
+    key = pageCacheKey(subreddits, sort, t, after)
+    entry = getCachedLinks([key]).get(key)
+    if entry is not None and not isStale(entry):
+        return entry.links, entry.after
+
+    try:
+        page = getRedditLinks(subreddits, sort, t, after)
+    except NotModified as e:
+        if entry is None:
+            cache.delete(e.args[0])
+            page = getRedditLinks(subreddits, sort, t, after)
+        else:
+            page = entry.links, entry.after
+    if page is None:
+        return None
 
-        for subreddit in subreddits_to_get:
-            subreddit_links = filter(lambda link:
-                                     link.get('subreddits') != subreddit,
-                                     response_links)
-            if subreddit_links:
-                key = "%s+%s+%s" % (subreddit, sort, t)
-                cache.set(key, pickle.dumps(subreddit_links))
+    links, next_after = page
+    setCachedLinks({}, t, {key: (links, next_after)})
+    return links, next_after
 
-        links.extend(response_links)
+
+def iterRedditPages(subreddits, sort, t, after=None):
+    """Lazily yield the links of successive listing pages.
+
+    Follows Reddit's after cursor one page at a time, starting at after, so
+    pages are only fetched while the caller keeps iterating. Stops at the end
+    of the listing, on a failed fetch, or after MAX_PAGES pages.
+    """
+    for page_number in xrange(app.config.get('MAX_PAGES', 3)):
+        page = getRedditPage(subreddits, sort, t, after)
+        if page is None:
+            return
+        links, after = page
+        yield links
+        if not after:
+            return
+
+
+def paginateLinks(links, subreddits, sort, t, limit, after=None):
+    seen = set(linkKey(link) for link in links)
+    if len(seen) >= limit:
+        return links
+
+    for page_links in iterRedditPages(subreddits, sort, t, after):
+        links.extend(page_links)
+        seen.update(linkKey(link) for link in page_links)
+        if len(seen) >= limit:
+            break
 
     return links
 
 
-def hot(entry):
+def getLinks(subreddits, sort, t, limit=100):
+    """Collect at least limit links for subreddits, where Reddit has them.
+
+    The first page of each subreddit comes from its own cache entry, missing
+    subreddits are fetched together in one listing. Further pages are only
+    followed while there are fewer than limit links, for each group the
+    whole selection is fetched in by groupSubreddits(). They continue from
+    the cursor of the group's first page, just fetched or cached. Where
+    that cursor is unknown, because its subreddits were cached by other
+    selections, the cached links are served as they are and the group's
+    first page is fetched in the background, so later requests paginate
+    the selection like a cold one.
+    """
+    keys = [linkCacheKey(subreddit, sort, t) for subreddit in subreddits]
+    groups = groupSubreddits(subreddits)
+    cursor_keys = [cursorCacheKey(group, sort, t) for group in groups]
+    entries = getCachedLinks(keys, cursor_keys)
+
+    subreddits_to_get = []
+    subreddits_to_refresh = []
+    links = []
+    for subreddit, key in zip(subreddits, keys):
+        entry = entries.get(key)
+        if entry is None:
+            subreddits_to_get.append(subreddit)
+        else:
+            links.extend(entry.links)
+            if isStale(entry):
+                subreddits_to_refresh.append(subreddit)
+
+    if subreddits_to_refresh:
+        refreshLinksInBackground(subreddits_to_refresh, sort, t)
+
+    cursors = dict((key, entry.after) for key, entry in entries.iteritems()
+                   if key in cursor_keys)
+    failed = set()
+    if subreddits_to_get:
+        fetched_groups = groupSubreddits(subreddits_to_get)
+        first_pages = fetchGroups(fetched_groups, sort, t)
+        if None in first_pages:
+            recordRedditFailure()
+
+        for group, first_page in zip(fetched_groups, first_pages):
+            if first_page is None:
+                failed.update(group)
+                continue
+            response_links, after = first_page
+            links.extend(response_links)
+            cursors[cursorCacheKey(group, sort, t)] = after
+
+    for group, cursor_key in zip(groups, cursor_keys):
+        if failed.intersection(group):
+            continue
+        if cursor_key not in cursors:
+            if len(set(linkKey(link) for link in links)) < limit:
+                refreshLinksInBackground(group, sort, t)
+            continue
+        # a cursor of None marks the end of the listing
+        if cursors[cursor_key]:
+            links = paginateLinks(links, group, sort, t, limit,
+                                  cursors[cursor_key])
+    return links
+
+
+def decayedScore(entry, period):
     ups = entry.get('ups')
     downs = entry.get('downs')
     date = entry.get("created_utc")
@@ -300,18 +1872,136 @@ def hot(entry):
     else:
         sign = 0
     seconds = date - 1134028003
-    return round(sign * order + seconds / 45000, 7)
+    return round(sign * order + seconds / period, 7)
+
+
+def hot(entry):
+    return decayedScore(entry, 45000)
+
+
+def rising(entry):
+    """Like hot, but age outweighs votes much sooner, favouring links that
+    are picking up votes right now."""
+    return decayedScore(entry, 7200)
 
 
 def top(entry):
     return entry.get('ups') - entry.get('downs')
 
 
+def new(entry):
+    return entry.get('created_utc')
+
+
+def controversial(entry):
+    ups = entry.get('ups')
+    downs = entry.get('downs')
+    if ups <= 0 or downs <= 0:
+        return 0
+    magnitude = ups + downs
+    if ups > downs:
+        balance = float(downs) / ups
+    else:
+        balance = float(ups) / downs
+    return magnitude ** balance
+
+
 supported_sorts = {
     'top': top,
-    'hot': hot
+    'hot': hot,
+    'new': new,
+    'rising': rising,
+    'controversial': controversial
+}
+
+
+def linkColumns(links):
+    count = len(links)
+    return {
+        'ups': numpy.fromiter((link.ups for link in links),
+                              numpy.int64, count),
+        'downs': numpy.fromiter((link.downs for link in links),
+                                numpy.int64, count),
+        'created_utc': numpy.fromiter((link.created_utc for link in links),
+                                      numpy.float64, count)
+    }
+
+
+def roundScores(scores, ndigits):
+    """numpy.round rounds halves to even, round() rounds them away from
+    zero. Round away from zero here and hand the few values that sit too
+    close to a half to tell apart back to round()."""
+    scale = 10.0 ** ndigits
+    scaled = numpy.abs(scores) * scale
+    rounded = numpy.copysign(numpy.floor(scaled + 0.5) / scale, scores)
+    fraction = scaled - numpy.floor(scaled)
+    for i in numpy.flatnonzero(numpy.abs(fraction - 0.5) < 1e-4):
+        rounded[i] = round(scores[i], ndigits)
+    return rounded
+
+
+def vectorDecayedScore(columns, period):
+    s = columns['ups'] - columns['downs']
+    order = numpy.log10(numpy.maximum(numpy.abs(s), 1))
+    seconds = columns['created_utc'] - 1134028003
+    return roundScores(numpy.sign(s) * order + seconds / period, 7)
+
+
+def vectorControversial(columns):
+    ups = columns['ups'].astype(numpy.float64)
+    downs = columns['downs'].astype(numpy.float64)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        balance = numpy.where(ups > downs, downs / ups, ups / downs)
+        scores = (ups + downs) ** balance
+    return numpy.where((ups > 0) & (downs > 0), scores, 0)
+
+
+vector_sorts = {
+    'top': lambda columns: columns['ups'] - columns['downs'],
+    'hot': lambda columns: vectorDecayedScore(columns, 45000),
+    'new': lambda columns: columns['created_utc'],
+    'rising': lambda columns: vectorDecayedScore(columns, 7200),
+    'controversial': vectorControversial
 }
 
+
+def rankLinks(links, sort_func, limit):
+    """Return the best limit links under sort_func, best first.
+
+    Ties on the score fall back to the newest link and then to the
+    original order, matching a stable sort on created_utc followed by a
+    stable sort on sort_func, but selecting with a heap instead of
+    sorting the whole list twice.
+    """
+    ranked = heapq.nlargest(limit, ((sort_func(link), link['created_utc'],
+                                     -index, link)
+                                    for index, link in enumerate(links)))
+    return [entry[-1] for entry in ranked]
+
+
+def vectorRankLinks(links, sort, limit):
+    """rankLinks for a sort in vector_sorts, scoring the whole candidate
+    pool in one batch with NumPy."""
+    columns = linkColumns(links)
+    scores = vector_sorts[sort](columns)
+    candidates = numpy.arange(len(links))
+    if limit < len(links):
+        # only links scoring at least the limit-th best can make the cut
+        cutoff = numpy.partition(scores, len(links) - limit)[-limit]
+        candidates = numpy.flatnonzero(scores >= cutoff)
+    order = numpy.lexsort((candidates,
+                           -columns['created_utc'][candidates],
+                           -scores[candidates]))
+    return [links[candidates[i]] for i in order[:limit]]
+
+
+def selectLinks(links, sort, limit):
+    if (app.config.get('SCORING_BACKEND', 'python') == 'numpy'
+            and numpy is not None and sort in vector_sorts):
+        return vectorRankLinks(links, sort, limit)
+    return rankLinks(links, supported_sorts[sort], limit)
+
+
 supported_times = [
     'day',
     'week',
@@ -321,64 +2011,595 @@ supported_times = [
 ]
 
 
-@app.route('/', methods=['GET'])
-def playlist():
-    subreddit_list = getSubredditList()
+def selectedOptions(selected_subreddits, snapshot):
+    """The selected subreddits, once each regardless of case, in the order
+    they were given and spelt as in the subreddit list where they are in
+    it. The rest of the list is loaded from /api/subreddits."""
+    seen = set()
+    options = []
+    for subreddit in selected_subreddits:
+        if subreddit.lower() not in seen:
+            seen.add(subreddit.lower())
+            options.append(snapshot.canonical(subreddit))
+    return options
+
 
-    subreddits_str = request.args.get('subreddits')
+class InvalidPlaylistRequest(ValueError):
+    pass
+
+
+def parsePlaylistArgs(args):
+    """Validate the playlist arguments of a request.
+
+    Returns (subreddits, sort, t, limit) or raises InvalidPlaylistRequest
+    with a message for the visitor.
+    """
+    subreddits_str = args.get('subreddits')
     if not subreddits_str:
-        return render_template('front.html', subreddit_list=subreddit_list)
+        raise InvalidPlaylistRequest('No subreddits given')
 
-    sort = request.args.get('sort', 'hot')
+    sort = args.get('sort', 'hot')
     if not sort in supported_sorts.keys():
-        flash('Invalid sort type: %s' % sort, 'error')
-        return redirect('/')
+        raise InvalidPlaylistRequest('Invalid sort type: %s' % sort)
 
-    t = request.args.get('t', 'week')
+    t = args.get('t', 'week')
     if not t in supported_times:
-        flash('Invalid time type: %s' % t, 'error')
-        return redirect('/')
+        raise InvalidPlaylistRequest('Invalid time type: %s' % t)
 
-    limit = request.args.get('limit', '100')
+    limit = args.get('limit', '100')
     try:
         limit = int(limit)
     except ValueError:
-        flash('Invalid limit: %s' % limit, 'error')
-        return redirect('/')
-    if not (limit > 0 and limit <= 100):
-        flash('Invalid limit: %d' % limit, 'error')
+        raise InvalidPlaylistRequest('Invalid limit: %s' % limit)
+    if not (limit > 0 and limit <= app.config.get('MAX_PLAYLIST_LIMIT', 100)):
+        raise InvalidPlaylistRequest('Invalid limit: %d' % limit)
+
+    return subreddits_str.split(), sort, t, limit
+
+
+def buildPlaylist(subreddits, sort, t, limit):
+    """The best limit links for subreddits, de-duplicated and ranked."""
+    request_frequency.record(subreddits, sort, t)
+    with StageTimer('get_links'):
+        links = getLinks(subreddits, sort, t, limit)
+    if not links:
+        return links
+    with StageTimer('dedupe'):
+        links = removeDuplicates(links)
+    with StageTimer('rank'):
+        return selectLinks(links, sort, limit)
+
+
+def collapseStack(frame):
+    """frame and its callers as one line of a collapsed stack file, the
+    outermost call first, as read by flamegraph.pl."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s:%s:%d' % (os.path.basename(code.co_filename),
+                                   code.co_name, code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler(object):
+    """Counts the stacks of one thread, sampled every interval seconds from
+    a background thread.
+
+    Unlike cProfile it adds nothing to each call in the thread it watches.
+    Taking a sample still holds the GIL while it walks the stacks, so the
+    watched thread is slowed down by an amount that grows as the interval
+    shrinks. That is little enough to leave on for a fraction of live
+    requests.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapseStack(frame)] += 1
+
+
+profile_write_lock = threading.Lock()
+
+
+def writeCollapsed(directory, name, stacks, mode='w'):
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    path = os.path.join(directory, name)
+    with profile_write_lock:
+        with open(path, mode) as collapsed:
+            for stack, count in stacks.iteritems():
+                collapsed.write('%s %d\n' % (stack, count))
+    return path
+
+
+def startSampler():
+    return StackSampler(threading.current_thread().ident,
+                        app.config.get('PROFILE_SAMPLE_INTERVAL', 0.002)).start()
+
+
+def profileRequested():
+    secret = app.config.get('PROFILE_SECRET')
+    given = request.headers.get('X-Flock-Profile')
+    if not secret or not given:
+        return False
+    return hmac.compare_digest(str(given), str(secret))
+
+
+def profileCall(func, args, kwargs):
+    """Run one view call under cProfile and the stack sampler.
+
+    Writes <name>.pstats and <name>.collapsed into PROFILE_DIR and names
+    them in the X-Flock-Profile response header. With
+    X-Flock-Profile-Mode: sample only the sampler runs.
+    """
+    name = '%s-%d-%s' % (func.__name__, time.time(), uuid.uuid4().hex[:8])
+    profiler = None
+    if request.headers.get('X-Flock-Profile-Mode') != 'sample':
+        profiler = cProfile.Profile()
+
+    sampler = startSampler()
+    try:
+        if profiler is None:
+            response = func(*args, **kwargs)
+        else:
+            response = profiler.runcall(func, *args, **kwargs)
+    finally:
+        sampler.stop()
+
+    response = app.make_response(response)
+    try:
+        path = writeCollapsed(app.config.get('PROFILE_DIR', 'profiles'),
+                              name + '.collapsed', sampler.stacks)
+        if profiler is not None:
+            profiler.dump_stats(os.path.join(os.path.dirname(path),
+                                             name + '.pstats'))
+    except (IOError, OSError):
+        logging.exception('Could not write profile %s', name)
+        return response
+    logging.info('Profiled %s as %s', request.full_path, name)
+
+    response.headers['X-Flock-Profile'] = name
+    return response
+
+
+def writeLiveStacks(directory, stacks):
+    try:
+        writeCollapsed(directory, 'live-%d.collapsed' % os.getpid(), stacks,
+                       'a')
+    except (IOError, OSError):
+        logging.exception('Could not write sampled stacks')
+
+
+def sampleCall(func, args, kwargs):
+    """Run one view call under the stack sampler, adding its stacks to the
+    collapsed file of this process.
+
+    The file is written from another thread, so a slow or failing disk
+    never holds up or breaks the sampled request.
+    """
+    sampler = startSampler()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        sampler.stop()
+        writer = threading.Thread(
+            target=writeLiveStacks,
+            args=(app.config.get('PROFILE_DIR', 'profiles'), sampler.stacks))
+        writer.daemon = True
+        writer.start()
+
+
+def profiled(func):
+    """Profile a view on request, or a fraction of its calls.
+
+    Nothing is profiled unless PROFILE_ENABLED is set. Requests whose
+    X-Flock-Profile header matches PROFILE_SECRET are profiled with
+    profileCall(), PROFILE_SAMPLE_RATE of the others with sampleCall().
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not app.config.get('PROFILE_ENABLED', False):
+            return func(*args, **kwargs)
+        if profileRequested():
+            return profileCall(func, args, kwargs)
+        if random.random() < app.config.get('PROFILE_SAMPLE_RATE', 0.0):
+            return sampleCall(func, args, kwargs)
+        return func(*args, **kwargs)
+    return wrapper
+
+
+@app.route('/', methods=['GET'])
+@profiled
+def playlist():
+    if not request.args.get('subreddits'):
+        return render_template('front.html')
+
+    try:
+        selected_subreddits, sort, t, limit = parsePlaylistArgs(request.args)
+    except InvalidPlaylistRequest as e:
+        flash(e.args[0], 'error')
         return redirect('/')
 
-    selected_subreddits = subreddits_str.split()
-    lower_subreddit_list = [sub.lower() for sub in subreddit_list]
-    for subreddit in selected_subreddits:
-        if not subreddit.lower() in lower_subreddit_list:
-            subreddit_list.append(subreddit)
+    # pages showing flashed messages are specific to this visitor
+    page_key = None
+    if app.config.get('PAGE_CACHE', False) and '_flashes' not in session:
+        page_key = renderedPageKey(selected_subreddits, sort, t, limit)
+        page = getRenderedPage(page_key, selected_subreddits, sort, t)
+        page_cache_lookups.inc(1, 'miss' if page is None else 'hit')
+        if page is not None:
+            request_frequency.record(selected_subreddits, sort, t)
+            return page
 
-    links = getLinks(selected_subreddits, sort, t)
+    links = buildPlaylist(selected_subreddits, sort, t, limit)
+    if getattr(g, 'reddit_failed', False):
+        flash('No Reddit response', 'error')
 
     if not links:
         flash('No links found', 'error')
         return redirect('/')
 
-    links = removeDuplicates(links)
+    youtube_url = generateYouTubeURL(links)
 
-    sort_func = supported_sorts[sort]
-    links = sorted(links, reverse=True, key=lambda l: l['created_utc'])
-    links = sorted(links, reverse=True, key=lambda l: sort_func(l))
+    cacheable = page_key is not None and '_flashes' not in session
+    with StageTimer('render'):
+        page = render_template('front.html',
+                               selected_subreddits=selected_subreddits,
+                               youtube_url=youtube_url,
+                               links=links,
+                               sort=sort,
+                               time=t,
+                               selected_options=selectedOptions(
+                                   selected_subreddits,
+                                   getSubredditSnapshot()))
+    if cacheable:
+        setRenderedPage(page_key, selected_subreddits, sort, t, page)
+    return page
+
+
+def jsonResponse(obj, status=200):
+    """Compact JSON, gzipped when the client accepts it and it's worth it."""
+    with StageTimer('json_encode'):
+        body = json.dumps(obj, separators=(',', ':'))
+    response = app.response_class(body, status=status,
+                                  mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if (request.accept_encodings['gzip'] > 0
+            and len(body) >= app.config.get('GZIP_MIN_SIZE', 512)):
+        buf = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as gzip_file:
+            gzip_file.write(body)
+        response.data = buf.getvalue()
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
 
-    links = links[0:limit]
 
-    youtube_url = generateYouTubeURL(links)
+api_link_fields = {
+    'video_id': linkVideoId,
+    'title': lambda link: link['title'],
+    'permalink': lambda link: link['permalink'],
+    'url': lambda link: link['url'],
+    'score': top,
+    'num_comments': lambda link: link['num_comments'],
+    'author': lambda link: link['author'],
+    'subreddit': lambda link: link['subreddit'],
+    'created_utc': lambda link: link['created_utc']
+}
+
+default_api_fields = ['video_id', 'title', 'permalink', 'score']
 
-    return render_template('front.html',
-                           selected_subreddits=selected_subreddits,
-                           youtube_url=youtube_url,
-                           links=links,
-                           sort=sort,
-                           time=t,
-                           subreddit_list=subreddit_list)
+
+@app.route('/api/playlist', methods=['GET'])
+@profiled
+def playlistApi():
+    """The playlist for the same arguments as / as JSON.
+
+    fields picks the link fields to return, as a comma separated list of
+    api_link_fields. Errors are returned as {"error": message} with a 4xx
+    or 5xx status rather than flashed.
+    """
+    try:
+        subreddits, sort, t, limit = parsePlaylistArgs(request.args)
+    except InvalidPlaylistRequest as e:
+        return jsonResponse({'error': e.args[0]}, 400)
+
+    fields = request.args.get('fields')
+    fields = fields.split(',') if fields else default_api_fields
+    for field in fields:
+        if field not in api_link_fields:
+            return jsonResponse({'error': 'Invalid field: %s' % field}, 400)
+
+    links = buildPlaylist(subreddits, sort, t, limit)
+    reddit_failed = getattr(g, 'reddit_failed', False)
+    if not links:
+        if reddit_failed:
+            return jsonResponse({'error': 'No Reddit response'}, 502)
+        return jsonResponse({'error': 'No links found'}, 404)
+
+    playlist = {
+        'subreddits': subreddits,
+        'sort': sort,
+        't': t,
+        'youtube_url': generateYouTubeURL(links),
+        'links': [dict((field, api_link_fields[field](link))
+                       for field in fields)
+                  for link in links]
+    }
+    if reddit_failed:
+        playlist['error'] = 'No Reddit response'
+    return jsonResponse(playlist)
+
+
+@app.route('/api/subreddits', methods=['GET'])
+def subredditList():
+    """The subreddit list as JSON, for the subreddit picker.
+
+    Without a prefix argument this is the whole list. With one, it is the
+    limit most requested subreddits starting with prefix.
+    """
+    prefix = request.args.get('prefix')
+    if prefix is None:
+        snapshot = getSubredditSnapshot()
+        response = app.response_class(snapshot.body,
+                                      mimetype='application/json')
+        response.cache_control.max_age = app.config.get(
+            'SUBREDDIT_LIST_MAX_AGE', 60 * 60 * 24)
+        response.set_etag(snapshot.etag)
+    else:
+        try:
+            limit = int(request.args.get('limit', 10))
+        except ValueError:
+            limit = 10
+        limit = min(max(limit, 1), app.config.get('SUBREDDIT_PREFIX_LIMIT', 50))
+        names = getSubredditCompleter().complete(prefix, limit)
+        response = app.response_class(json.dumps(names),
+                                      mimetype='application/json')
+        response.cache_control.max_age = app.config.get(
+            'SUBREDDIT_PREFIX_MAX_AGE', 60 * 5)
+        response.add_etag()
+    response.cache_control.public = True
+    return response.make_conditional(request)
+
+
+@app.before_request
+def startRequestTimer():
+    g.request_start = time.time()
+
+
+@app.after_request
+def observeRequest(response):
+    start = getattr(g, 'request_start', None)
+    if start is not None:
+        request_seconds.observe(time.time() - start,
+                                request.endpoint or 'unknown')
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def metricsEndpoint():
+    """Prometheus text exposition of the in-process metrics."""
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+
+    hits = cache_lookups.value('hit')
+    lookups = hits + cache_lookups.value('miss')
+    lines.extend(['# HELP flock_cache_hit_ratio Link cache hits per lookup.',
+                  '# TYPE flock_cache_hit_ratio gauge',
+                  'flock_cache_hit_ratio %s' % formatMetricValue(
+                      float(hits) / lookups if lookups else 0.0)])
+
+    with conditional_stats_lock:
+        stats = dict(conditional_stats)
+    for name, help in [('not_modified', 'Conditional requests answered 304.'),
+                       ('bytes_saved', 'Bytes not downloaded thanks to 304s.'),
+                       ('parse_seconds_saved',
+                        'Parse time saved thanks to 304s.')]:
+        lines.extend(['# HELP flock_conditional_%s_total %s' % (name, help),
+                      '# TYPE flock_conditional_%s_total counter' % name,
+                      'flock_conditional_%s_total %s' % (
+                          name, formatMetricValue(stats[name]))])
+
+    return app.response_class('\n'.join(lines) + '\n',
+                              content_type='text/plain; version=0.0.4')
+
+
+@app.after_request
+def reportCacheStats(response):
+    hits = getattr(g, 'cache_hits', None)
+    if hits is None:
+        return response
+    misses = getattr(g, 'cache_misses', 0)
+    logging.info('%s cache hits: %d, misses: %d', request.path, hits, misses)
+    response.headers['X-Flock-Cache'] = 'hits=%d; misses=%d' % (hits, misses)
+    return response
+
+
+@app.after_request
+def reportRateLimitWait(response):
+    wait = getattr(g, 'rate_limit_wait', None)
+    if wait is None:
+        return response
+    response.headers['X-Flock-Rate-Limit-Wait'] = '%.3f' % wait
+    return response
+
+
+class RequestFrequency(object):
+    """Counts how often each (subreddit, sort, t) combination is requested.
+
+    Counts are gathered in-process and merged into a shared counter in the
+    cache every flush_interval seconds, so the warmer can see the traffic of
+    every worker. The shared counter is capped at max_keys entries.
+    """
+
+    cache_key = 'warmer+frequency'
+    timeout = 60 * 60 * 24 * 7
+
+    def __init__(self, flush_interval=60, max_keys=1000):
+        self.flush_interval = flush_interval
+        self.max_keys = max_keys
+        self.counts = {}
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, subreddits, sort, t):
+        with self.lock:
+            for subreddit in subreddits:
+                key = (subreddit.lower(), sort, t)
+                self.counts[key] = self.counts.get(key, 0) + 1
+            flush = time.time() - self.last_flush >= self.flush_interval
+
+        if flush:
+            self.flush()
+
+    def getSharedCounts(self):
+        counts = cache.get(self.cache_key)
+        if not counts:
+            return {}
+        return pickle.loads(counts)
+
+    def setSharedCounts(self, counts):
+        if len(counts) > self.max_keys:
+            top_keys = sorted(counts, key=counts.get, reverse=True)
+            counts = dict((key, counts[key])
+                          for key in top_keys[:self.max_keys])
+        cache.set(self.cache_key, pickle.dumps(counts), timeout=self.timeout)
+
+    def flush(self):
+        with self.lock:
+            local_counts = self.counts
+            self.counts = {}
+            self.last_flush = time.time()
+
+        if not local_counts:
+            return
+
+        counts = self.getSharedCounts()
+        for key, count in local_counts.iteritems():
+            counts[key] = counts.get(key, 0) + count
+        self.setSharedCounts(counts)
+
+    def subredditCounts(self):
+        subreddit_counts = {}
+        for (subreddit, sort, t), count in self.getSharedCounts().iteritems():
+            subreddit_counts[subreddit] = (subreddit_counts.get(subreddit, 0)
+                                           + count)
+        return subreddit_counts
+
+    def top(self, n):
+        counts = self.getSharedCounts()
+        return sorted(counts, key=counts.get, reverse=True)[:n]
+
+    def decay(self, factor):
+        counts = self.getSharedCounts()
+        decayed = {}
+        for key, count in counts.iteritems():
+            count = count * factor
+            if count >= 1:
+                decayed[key] = count
+        self.setSharedCounts(decayed)
+
+
+request_frequency = RequestFrequency(
+    app.config.get('WARMER_FLUSH_INTERVAL', 60))
+
+
+def getSuggestedPlaylists(template='front.html'):
+    """Return the subreddit lists linked from the front page suggestions."""
+    path = os.path.join(app.root_path, app.template_folder, template)
+    with open(path) as template_file:
+        contents = template_file.read()
+
+    suggestions = []
+    for subreddits_str in re.findall(r'href="/\?subreddits=([^"&]+)"',
+                                     contents):
+        suggestions.append(urllib.unquote_plus(subreddits_str).split())
+    return suggestions
+
+
+def warmLinks(subreddits, sort, t):
+    keys = [linkCacheKey(subreddit, sort, t) for subreddit in subreddits]
+    entries = getCachedLinks(keys)
+
+    subreddits_to_get = []
+    for subreddit, key in zip(subreddits, keys):
+        if key not in entries or isStale(entries[key]):
+            subreddits_to_get.append(subreddit)
+
+    if not subreddits_to_get:
+        return True
+
+    logging.info('Warming %s', linkCacheKey('+'.join(subreddits_to_get),
+                                            sort,
+                                            t))
+    first_pages = fetchGroups(groupSubreddits(subreddits_to_get), sort, t)
+    return None not in first_pages
+
+
+def warmCache(top_n):
+    """Pre-fetch the top_n most requested link lists and the suggestions.
+
+    Entries that are still fresh are skipped. Every fetch goes through the
+    usual rate limiter, so a run stops being useful once RATE_LIMIT_MAX_WAIT
+    is exceeded; those entries are simply left for the next run.
+    """
+    playlists = [(subreddits, 'hot', 'week')
+                 for subreddits in getSuggestedPlaylists()]
+    playlists.extend(([subreddit], sort, t)
+                     for subreddit, sort, t in request_frequency.top(top_n))
+
+    warmed = 0
+    for subreddits, sort, t in playlists:
+        if warmLinks(subreddits, sort, t):
+            warmed += 1
+
+    logging.info('Warmed %d of %d playlists', warmed, len(playlists))
+    return warmed
+
+
+def warmMain(args):
+    parser = argparse.ArgumentParser(prog='flock.py warm',
+                                     description='Pre-fetch popular '
+                                                 'playlists into the cache.')
+    parser.add_argument('--top', type=int,
+                        default=app.config.get('WARMER_TOP_N', 50),
+                        help='number of most requested combinations to warm')
+    parser.add_argument('--loop', type=float, metavar='SECONDS',
+                        help='keep warming every SECONDS instead of once')
+    args = parser.parse_args(args)
+
+    decay = app.config.get('WARMER_DECAY', 0.5)
+    while True:
+        warmCache(args.top)
+        request_frequency.decay(decay)
+        if not args.loop:
+            break
+        time.sleep(args.loop)
 
 
 if __name__ == '__main__':
-    app.run()
+    if sys.argv[1:2] == ['warm']:
+        warmMain(sys.argv[2:])
+    else:
+        app.run()
@@ -1 +1 @@
-function onYTError(e){$(".errors").html($(".errors").html()+'<div class="alert alert-danger">'+'<button type="button" class="close" data-dismiss="alert" aria-hidden="true">&times;</button>'+"<strong>Error!</strong> Having difficulty connecting to the YouTube API. The player controls will still work, but certain functions will not. This is most likely due to network problems. Thanks for your patience!"+"</div>")}function onPlayerReady(){player.playVideoAt(0)}function updateNowPlaying(){if(player){var e=player.getPlaylistIndex(),t=$(".track.nowPlaying"),n=$(".track[data-playnum = '"+e+"']");t.removeClass("nowPlaying");n.addClass("nowPlaying");document.title="flock - "+n.find(".playTitle").html()}}function onPlayerStateChange(){updateNowPlaying()}function onYouTubeIframeAPIReady(){player=new YT.Player("player",{events:{onError:onYTError,onReady:onPlayerReady,onStateChange:onPlayerStateChange}})}function getParameterByName(e){var t=(new RegExp("[?&]"+e+"=([^&]*)")).exec(window.location.search);return t&&decodeURIComponent(t[1].replace(/\+/g," "))}function addArg(e,t){var n="";for(var r=0;r<e.length;r++)n+="&"+e[r]+"="+t[r];window.location.search="?subreddits="+getParameterByName("subreddits")+n}var tag=document.createElement("script"),first_script_tag,player;tag.src="http://www.youtube.com/iframe_api";first_script_tag=document.getElementsByTagName("script")[0];first_script_tag.parentNode.insertBefore(tag,first_script_tag);$(document).ready(function(){$(".playTrack").on("click",function(){player.playVideoAt($(this).parent().data("playnum"));updateNowPlaying()});$(".commentNum").on("click",function(e){e.stopPropagation()});$(".chosen-select").chosen({no_results_text:"Oops, that one's too hip for us - add it to your search with space or enter",search_contains:!0}).change(function(e,t){var n=$("#subredditsParam").val();t.selected&&(n+=" "+t.selected);if(t.deselected){n=n.replace(t.deselected,"");n=n.replace("  "," ")}n[0]===" "&&(n=n.slice(1));n[n.length-1]===" "&&(n=n.slice(0,n.length-2));$("#subredditsParam").val(n)}).css("height","34")});
\ No newline at end of file
+function onYTError(e){$(".errors").html($(".errors").html()+'<div class="alert alert-danger">'+'<button type="button" class="close" data-dismiss="alert" aria-hidden="true">&times;</button>'+"<strong>Error!</strong> Having difficulty connecting to the YouTube API. The player controls will still work, but certain functions will not. This is most likely due to network problems. Thanks for your patience!"+"</div>")}function onPlayerReady(){player.playVideoAt(0)}function updateNowPlaying(){if(player){var e=player.getPlaylistIndex(),t=$(".track.nowPlaying"),n=$(".track[data-playnum = '"+e+"']");t.removeClass("nowPlaying");n.addClass("nowPlaying");document.title="flock - "+n.find(".playTitle").html()}}function onPlayerStateChange(){updateNowPlaying()}function onYouTubeIframeAPIReady(){player=new YT.Player("player",{events:{onError:onYTError,onReady:onPlayerReady,onStateChange:onPlayerStateChange}})}function getParameterByName(e){var t=(new RegExp("[?&]"+e+"=([^&]*)")).exec(window.location.search);return t&&decodeURIComponent(t[1].replace(/\+/g," "))}function loadSubreddits(e,t){$.getJSON(e.data("source"),{prefix:t},function(t){var n={},r=document.createDocumentFragment(),i=e.next(".chosen-container").find(".search-field input"),s=i.val();e.find("option").each(function(){n[this.value.toLowerCase()]=!0});for(var o=0;o<t.length;o++)if(!n[t[o].toLowerCase()]){var u=document.createElement("option");u.value=u.text=t[o];r.appendChild(u)}if(r.childNodes.length){e.append(r).trigger("chosen:updated");i.val(s);e.data("chosen").winnow_results()}})}function addArg(e,t){var n="";for(var r=0;r<e.length;r++)n+="&"+e[r]+"="+t[r];window.location.search="?subreddits="+getParameterByName("subreddits")+n}var tag=document.createElement("script"),first_script_tag,player;tag.src="http://www.youtube.com/iframe_api";first_script_tag=document.getElementsByTagName("script")[0];first_script_tag.parentNode.insertBefore(tag,first_script_tag);$(document).ready(function(){$(".playTrack").on("click",function(){player.playVideoAt($(this).parent().data("playnum"));updateNowPlaying()});$(".commentNum").on("click",function(e){e.stopPropagation()});$(".chosen-select").chosen({no_results_text:"Oops, that one's too hip for us - add it to your search with space or enter",search_contains:!0}).change(function(e,t){var n=$("#subredditsParam").val();t.selected&&(n+=" "+t.selected);if(t.deselected){n=n.replace(t.deselected,"");n=n.replace("  "," ")}n[0]===" "&&(n=n.slice(1));n[n.length-1]===" "&&(n=n.slice(0,n.length-2));$("#subredditsParam").val(n)}).css("height","34");var e=$(".chosen-select"),t;e.next(".chosen-container").find(".search-field input").on("keyup",function(){var n=$(this).val();clearTimeout(t);n&&(t=setTimeout(function(){loadSubreddits(e,n)},100))});loadSubreddits(e,"")});
\ No newline at end of file
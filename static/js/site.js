@@ -69,6 +69,38 @@ function addArg(key, value)
   window.location.search = '?subreddits=' + getParameterByName('subreddits') + newParams;
 }
 
+function loadSubreddits(select, prefix)
+{
+  $.getJSON(select.data('source'), {prefix: prefix}, function(subreddits) {
+    var present = {},
+      options = document.createDocumentFragment(),
+      search = select.next('.chosen-container').find('.search-field input'),
+      typed = search.val();
+
+    select.find('option').each(function() {
+      present[this.value.toLowerCase()] = true;
+    });
+
+    for(var i = 0; i < subreddits.length; i ++)
+    {
+      if(!present[subreddits[i].toLowerCase()])
+      {
+        var option = document.createElement('option');
+        option.value = option.text = subreddits[i];
+        options.appendChild(option);
+      }
+    }
+
+    if(options.childNodes.length)
+    {
+      // chosen clears the search field when it rebuilds its results
+      select.append(options).trigger('chosen:updated');
+      search.val(typed);
+      select.data('chosen').winnow_results();
+    }
+  });
+}
+
 $(document).ready(function() {
   $('.playTrack').on('click', function() {
     player.playVideoAt($(this).parent().data('playnum'));
@@ -107,4 +139,19 @@ $(document).ready(function() {
 
       $('#subredditsParam').val(subreddits);
     }).css('height', '34');
+
+  var select = $('.chosen-select'),
+    lookup;
+
+  select.next('.chosen-container').find('.search-field input').on('keyup', function() {
+    var prefix = $(this).val();
+
+    clearTimeout(lookup);
+    if(prefix)
+    {
+      lookup = setTimeout(function() { loadSubreddits(select, prefix); }, 100);
+    }
+  });
+
+  loadSubreddits(select, '');
 });
\ No newline at end of file
@@ -1,15 +1,30 @@
 import mock
+import BaseHTTPServer
+import SocketServer
+import gzip
 import datetime
+import hashlib
+import flask
 import HTMLParser
 import httplib
 import io
 import json
 import logging
 import pickle
+import pstats
 import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
 import time
 import unittest
+import urllib
 import urllib2
+import urlparse
+import zlib
 
 os.environ['FLOCK_SETTINGS'] = 'debug_config.py'
 
@@ -19,7 +34,8 @@ import flock
 flock.app.testing = True
 logging.disable(logging.CRITICAL)
 
-urllib2.urlopen = mock.MagicMock()
+real_open = flock.http_opener.open
+flock.http_opener.open = mock.MagicMock()
 
 
 class DuplicateSubredditTestCase(unittest.TestCase):
@@ -52,6 +68,9 @@ class DuplicateSubredditTestCase(unittest.TestCase):
         flock.cache.get = mock.MagicMock()
         flock.cache.get.return_value = None
 
+        flock.subreddit_snapshot = None
+        flock.subreddit_completer = None
+
     def tearDown(self):
         flock.getSubredditList = self.getSubredditList
         flock.getRedditResponse = self.getRedditResponse
@@ -61,10 +80,14 @@ class DuplicateSubredditTestCase(unittest.TestCase):
     def test_subreddit_list_contains_no_duplicates(self):
         flock.getSubredditList.return_value = self.subreddit_list[:]
         flock.getRedditResponse.return_value = self.reddit_response_dump
-        response = self.app.get('/?subreddits=futuregarage+futurebeats')
+        response = self.app.get('/?subreddits=futuregarage+futurebeats+FutureGarage')
         self.assertEqual(response.status_code, 200)
         args,kwargs = flock.render_template.call_args
-        self.assertItemsEqual(kwargs.get('subreddit_list'), self.subreddit_list)
+        self.assertEqual(kwargs.get('selected_options'), ['FutureGarage', 'futurebeats'])
+        self.assertEqual(response.data.lower().count('<option value="futuregarage" selected>'), 1)
+
+        response = self.app.get('/api/subreddits')
+        self.assertItemsEqual(json.loads(response.data), self.subreddit_list)
 
     def test_subreddit_list_contains_non_music_subreddits_when_requested(self):
         flock.getSubredditList.return_value = self.subreddit_list[:]
@@ -72,9 +95,123 @@ class DuplicateSubredditTestCase(unittest.TestCase):
         response = self.app.get('/?subreddits=youtubehaiku')
         self.assertEqual(response.status_code, 200)
         args,kwargs = flock.render_template.call_args
-        subreddit_list = self.subreddit_list[:]
-        subreddit_list.append('youtubehaiku')
-        self.assertItemsEqual(kwargs.get('subreddit_list'), subreddit_list)
+        self.assertEqual(kwargs.get('selected_options'), ['youtubehaiku'])
+        self.assertIn('<option value="youtubehaiku" selected>', response.data)
+
+    def test_subreddit_list_is_not_rendered_inline(self):
+        flock.getSubredditList.return_value = self.subreddit_list[:]
+        flock.getRedditResponse.return_value = self.reddit_response_dump
+        response = self.app.get('/?subreddits=futuregarage')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.count('<option value="'), 2)
+
+    def test_subreddit_list_is_read_once_per_snapshot(self):
+        flock.getSubredditList.return_value = self.subreddit_list[:]
+        flock.getRedditResponse.return_value = self.reddit_response_dump
+        self.app.get('/?subreddits=futuregarage')
+        self.app.get('/?subreddits=youtubehaiku')
+        self.app.get('/api/subreddits')
+        self.assertEqual(flock.getSubredditList.call_count, 1)
+
+        flock.subreddit_snapshot.expires = time.time() - 1
+        self.app.get('/api/subreddits')
+        self.assertEqual(flock.getSubredditList.call_count, 2)
+
+    def test_unknown_subreddits_are_not_added_to_snapshot(self):
+        flock.getSubredditList.return_value = self.subreddit_list[:]
+        flock.getRedditResponse.return_value = self.reddit_response_dump
+        self.app.get('/?subreddits=youtubehaiku')
+        self.assertNotIn('youtubehaiku', flock.subreddit_snapshot)
+        self.assertEqual(list(flock.subreddit_snapshot), self.subreddit_list)
+
+    def test_snapshot_lookup_ignores_case(self):
+        snapshot = flock.SubredditSnapshot(['FutureGarage', 'dubstep'], 0)
+        self.assertIn('futuregarage', snapshot)
+        self.assertIn('DUBSTEP', snapshot)
+        self.assertNotIn('youtubehaiku', snapshot)
+        self.assertEqual(snapshot.canonical('futureGARAGE'), 'FutureGarage')
+        self.assertEqual(snapshot.canonical('youtubehaiku'), 'youtubehaiku')
+
+    def test_empty_subreddit_list_is_not_kept(self):
+        flock.getSubredditList.return_value = []
+        flock.getSubredditSnapshot()
+        flock.getSubredditSnapshot()
+        self.assertEqual(flock.getSubredditList.call_count, 2)
+
+    def test_subreddit_list_endpoint_is_cacheable(self):
+        flock.getSubredditList.return_value = self.subreddit_list[:]
+        response = self.app.get('/api/subreddits')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual(response.cache_control.max_age,
+                         flock.app.config['SUBREDDIT_LIST_MAX_AGE'])
+        etag = response.headers['ETag']
+
+        response = self.app.get('/api/subreddits',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, '')
+
+
+class SubredditCompleterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = flock.app.test_client()
+        with open('tests/subreddit_list_dump.json') as f:
+            self.subreddit_list = json.load(f)
+
+        self.getSubredditList = flock.getSubredditList
+        flock.getSubredditList = mock.MagicMock(return_value=self.subreddit_list[:])
+        self.subredditCounts = flock.request_frequency.subredditCounts
+        flock.request_frequency.subredditCounts = mock.MagicMock(
+            return_value={'futurebeats': 5, 'futuregarage': 9})
+        flock.subreddit_snapshot = None
+        flock.subreddit_completer = None
+
+    def tearDown(self):
+        flock.getSubredditList = self.getSubredditList
+        flock.request_frequency.subredditCounts = self.subredditCounts
+        flock.subreddit_snapshot = None
+        flock.subreddit_completer = None
+
+    def test_completions_start_with_prefix(self):
+        names = flock.getSubredditCompleter().complete('Dub', 50)
+        expected = [name for name in self.subreddit_list
+                    if name.lower().startswith('dub')]
+        self.assertTrue(expected)
+        self.assertItemsEqual(names, expected)
+
+    def test_completions_are_ranked_by_requests(self):
+        names = flock.getSubredditCompleter().complete('future', 3)
+        self.assertEqual(names[:2], ['FutureGarage', 'futurebeats'])
+        self.assertEqual(len(names), 3)
+
+    def test_unknown_prefix_has_no_completions(self):
+        self.assertEqual(flock.getSubredditCompleter().complete('zzzz'), [])
+
+    def test_completions_are_cached_per_prefix(self):
+        completer = flock.getSubredditCompleter()
+        first = completer.complete('future', 3)
+        self.assertIs(completer.complete('FUTURE', 3), first)
+        self.assertIs(flock.getSubredditCompleter(), completer)
+
+    def test_completer_is_rebuilt_with_snapshot(self):
+        completer = flock.getSubredditCompleter()
+        flock.subreddit_snapshot.expires = time.time() - 1
+        self.assertIsNot(flock.getSubredditCompleter(), completer)
+
+    def test_prefix_endpoint(self):
+        response = self.app.get('/api/subreddits?prefix=Future&limit=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), ['FutureGarage', 'futurebeats'])
+        self.assertEqual(response.cache_control.max_age,
+                         flock.app.config['SUBREDDIT_PREFIX_MAX_AGE'])
+
+    def test_prefix_endpoint_bounds_limit(self):
+        response = self.app.get('/api/subreddits?prefix=&limit=1000')
+        self.assertEqual(len(json.loads(response.data)),
+                         flock.app.config['SUBREDDIT_PREFIX_LIMIT'])
+        response = self.app.get('/api/subreddits?prefix=&limit=many')
+        self.assertEqual(len(json.loads(response.data)), 10)
 
 
 class FlockBaseTestCase(unittest.TestCase):
@@ -102,23 +239,33 @@ class FlockBaseTestCase(unittest.TestCase):
         flock.getSubredditList = mock.MagicMock(return_value=[])
 
         self.original_getRedditResponse = flock.getRedditResponse
+        self.original_getCachedLinks = flock.getCachedLinks
+        self.original_fetchLinksOnce = flock.fetchLinksOnce
         self.original_cache_get = flock.cache.get
         self.original_cache_set = flock.cache.set
-        self.original_urlopen = flock.urllib2.urlopen
+        self.original_cache_get_many = flock.cache.get_many
+        self.original_cache_set_many = flock.cache.set_many
+        self.original_open = flock.http_opener.open
 
         """ We never want to make an actual HTTP request """
-        flock.urllib2.urlopen = mock.MagicMock()
+        flock.http_opener.open = mock.MagicMock()
         """ Ensure we don't hit the cache by default """
         flock.cache.get = mock.MagicMock(name='get', return_value=None)
     
     def tearDown(self):
         flock.getRedditResponse = self.original_getRedditResponse
+        flock.getCachedLinks = self.original_getCachedLinks
+        flock.fetchLinksOnce = self.original_fetchLinksOnce
         flock.cache.get = self.original_cache_get
         flock.cache.set = self.original_cache_set
-        flock.urllib2.urlopen = self.original_urlopen
+        flock.cache.get_many = self.original_cache_get_many
+        flock.cache.set_many = self.original_cache_set_many
+        flock.http_opener.open = self.original_open
         flock.getSubredditList = self.original_getSubredditList
 
         flock.rate_limited_requests = {}
+        flock.subreddit_snapshot = None
+        flock.subreddit_completer = None
 
 
 class FrontpageTestCase(FlockBaseTestCase):
@@ -128,7 +275,7 @@ class FrontpageTestCase(FlockBaseTestCase):
 
     def test_frontpage_subreddits_no_response(self):
         flock.cache.get = mock.MagicMock(name='get', return_value=None)
-        flock.urllib2.urlopen = mock.MagicMock(return_value=None)
+        flock.http_opener.open = mock.MagicMock(return_value=None)
 
         response = self.app.get('/?subreddits=futuregarage',
                                 content_type='text/html',
@@ -141,7 +288,7 @@ class FrontpageTestCase(FlockBaseTestCase):
         flock.cache.get = mock.MagicMock(name='get', return_value=None)
         def throw_404(url):
             raise urllib2.HTTPError(url, 404, 'Not found', None, None)
-        flock.urllib2.urlopen = mock.MagicMock(side_effect=throw_404)
+        flock.http_opener.open = mock.MagicMock(side_effect=throw_404)
 
         response = self.app.get('/?subreddits=futuregarage',
                                 content_type='text/html',
@@ -153,7 +300,7 @@ class FrontpageTestCase(FlockBaseTestCase):
     def test_frontpage_subreddits_reddit_error(self):
         response_string = u'{ "error" : {} }'
         flock.cache.get = mock.MagicMock(name='get', return_value=None)
-        flock.urllib2.urlopen = mock.MagicMock(return_value=io.StringIO(response_string))
+        flock.http_opener.open = mock.MagicMock(return_value=io.StringIO(response_string))
 
         response = self.app.get('/?subreddits=futuregarage',
                                 content_type='text/html',
@@ -165,7 +312,7 @@ class FrontpageTestCase(FlockBaseTestCase):
     def test_frontpage_subreddits_invalid_json(self):
         return_value = io.StringIO(u'<html></html>')
         flock.cache.get = mock.MagicMock(name='get', return_value=None)
-        flock.urllib2.urlopen = mock.MagicMock(return_value=return_value)
+        flock.http_opener.open = mock.MagicMock(return_value=return_value)
 
         response = self.app.get('/?subreddits=futuregarage',
                                 content_type='text/html',
@@ -176,7 +323,7 @@ class FrontpageTestCase(FlockBaseTestCase):
 
     def test_frontpage_subreddits_no_youtube_links(self):
         return_value = io.StringIO(json.dumps(self.futuregarage_top, ensure_ascii=False))
-        flock.urllib2.urlopen = mock.MagicMock(return_value=return_value)
+        flock.http_opener.open = mock.MagicMock(return_value=return_value)
 
         flock.cache.get = mock.MagicMock(name='get', return_value=None)
 
@@ -204,7 +351,7 @@ class FrontpageTestCase(FlockBaseTestCase):
         futuregarage_links = flock.parseRedditResponse(self.futuregarage_top)
 
         return_value = io.StringIO(json.dumps(self.futuregarage_top, ensure_ascii=False))
-        flock.urllib2.urlopen = mock.MagicMock(return_value=return_value)
+        flock.http_opener.open = mock.MagicMock(return_value=return_value)
     
         flock.cache.get = mock.MagicMock(name='get', return_value=None)
 
@@ -220,6 +367,26 @@ class FrontpageTestCase(FlockBaseTestCase):
             self.assertIn(child['url'], unescaped_response)
             self.assertIn(child['permalink'], unescaped_response)
 
+    def test_parse_reddit_response_leaves_response_untouched(self):
+        response = json.loads(json.dumps(self.futuregarage_top))
+        flock.parseRedditResponse(response)
+        self.assertEqual(response, self.futuregarage_top)
+
+    def test_parsed_links_carry_video_id(self):
+        for link in flock.parseRedditResponse(self.futuregarage_top):
+            self.assertTrue(link.video_id)
+            self.assertEqual(link['url'], 'http://www.youtube.com/watch?v=%s' % link.video_id)
+
+    def test_links_behave_like_dicts(self):
+        link = flock.parseRedditResponse(self.futuregarage_top)[0]
+        self.assertEqual(link.get('author'), link.author)
+        self.assertEqual(link.get('domain', 'missing'), 'missing')
+        self.assertRaises(KeyError, lambda: link['domain'])
+        self.assertIn('ups', link)
+        self.assertEqual(link.copy(), link)
+        self.assertEqual(pickle.loads(pickle.dumps(link)), link)
+
+
 class SanitiseURLCase(unittest.TestCase):
     def test_sanitise_short_youtube_url(self):
         url = 'http://youtu.be/wRpHf4X7FNM'
@@ -382,6 +549,285 @@ class DuplicatesTestCase(unittest.TestCase):
         del links[2]
         self.assertEquals(new_links, links)
 
+    def test_remove_duplicates_matches_video_ids(self):
+        links = [
+                {
+                    'url' : 'http://www.youtube.com/watch?v=wRpHf4X7FNM'
+                    },
+                {
+                    'url' : 'http://www.youtube.com/watch?feature=share&v=wRpHf4X7FNM'
+                    }
+                ]
+        new_links = flock.removeDuplicates(links)
+        self.assertEquals(new_links, links[:1])
+
+    def test_remove_duplicates_merges_votes_and_comments(self):
+        links = [
+                {
+                    'url' : 'http://www.youtube.com/watch?v=wRpHf4X7FNM',
+                    'ups' : 10,
+                    'downs' : 2,
+                    'num_comments' : 3
+                    },
+                {
+                    'url' : 'http://www.youtube.com/watch?v=eAUaOTLvBIM',
+                    'ups' : 1,
+                    'downs' : 0,
+                    'num_comments' : 0
+                    },
+                {
+                    'url' : 'http://www.youtube.com/watch?v=wRpHf4X7FNM',
+                    'ups' : 5,
+                    'downs' : 1,
+                    'num_comments' : 4
+                    }
+                ]
+        new_links = flock.removeDuplicates(links)
+        self.assertEquals(len(new_links), 2)
+        self.assertEquals(new_links[0]['ups'], 15)
+        self.assertEquals(new_links[0]['downs'], 3)
+        self.assertEquals(new_links[0]['num_comments'], 7)
+        self.assertEquals(links[0]['ups'], 10)
+
+    def test_remove_duplicates_counts_a_repeated_post_once(self):
+        url = 'http://www.youtube.com/watch?v=wRpHf4X7FNM'
+        links = [flock.Link(id='abc', url=url, ups=100, num_comments=10),
+                 flock.Link(id='abc', url=url, ups=101, num_comments=10),
+                 flock.Link(id='def', url=url, ups=5, num_comments=1)]
+        new_links = flock.removeDuplicates(links)
+        self.assertEquals(len(new_links), 1)
+        self.assertEquals(new_links[0]['ups'], 105)
+        self.assertEquals(new_links[0]['num_comments'], 11)
+
+    def test_remove_duplicates_scales_linearly(self):
+        links = [{'url': 'http://www.youtube.com/watch?v=%d' % (i % 5000)}
+                 for i in range(20000)]
+        before_call = time.time()
+        new_links = flock.removeDuplicates(links)
+        self.assertLess(time.time() - before_call, 1.0)
+        self.assertEquals(new_links, links[:5000])
+
+
+class PlaylistApiTestCase(FlockBaseTestCase):
+    def setUp(self):
+        FlockBaseTestCase.setUp(self)
+        flock.getRedditResponse = mock.MagicMock(name='getRedditResponse',
+                                                 return_value=self.futuregarage_top)
+        self.render_template = flock.render_template
+        flock.render_template = mock.MagicMock(name='render_template')
+
+    def tearDown(self):
+        flock.render_template = self.render_template
+        FlockBaseTestCase.tearDown(self)
+
+    def test_playlist_matches_html_route(self):
+        response = self.app.get('/api/playlist?subreddits=futuregarage&sort=top&limit=5')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertFalse(flock.render_template.called)
+        playlist = json.loads(response.data)
+
+        links = flock.selectLinks(
+            flock.removeDuplicates(flock.parseRedditResponse(self.futuregarage_top)),
+            'top', 5)
+        self.assertEqual([link['video_id'] for link in playlist['links']],
+                         [flock.linkVideoId(link) for link in links])
+        self.assertEqual(playlist['youtube_url'], flock.generateYouTubeURL(links))
+        self.assertEqual(sorted(playlist['links'][0].keys()),
+                         sorted(flock.default_api_fields))
+        self.assertEqual(playlist['links'][0]['score'], flock.top(links[0]))
+
+    def test_fields_projection(self):
+        response = self.app.get('/api/playlist?subreddits=futuregarage&fields=video_id,author')
+        self.assertEqual(response.status_code, 200)
+        for link in json.loads(response.data)['links']:
+            self.assertEqual(sorted(link.keys()), ['author', 'video_id'])
+
+    def test_invalid_arguments_are_client_errors(self):
+        for query in ['', 'subreddits=futuregarage&sort=error',
+                      'subreddits=futuregarage&t=never',
+                      'subreddits=futuregarage&limit=1000',
+                      'subreddits=futuregarage&fields=video_id,secret']:
+            response = self.app.get('/api/playlist?' + query)
+            self.assertEqual(response.status_code, 400, query)
+            self.assertIn('error', json.loads(response.data))
+        self.assertFalse(flock.getRedditResponse.called)
+
+    def test_reddit_failure_is_a_bad_gateway(self):
+        flock.getRedditResponse.return_value = None
+        response = self.app.get('/api/playlist?subreddits=futuregarage')
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(json.loads(response.data), {'error': 'No Reddit response'})
+        self.assertNotIn('Set-Cookie', response.headers)
+
+    def test_no_links_is_not_found(self):
+        flock.getRedditResponse.return_value = makeListing('a', 0)
+        response = self.app.get('/api/playlist?subreddits=futuregarage')
+        self.assertEqual(response.status_code, 404)
+
+    def test_response_is_gzipped_when_accepted(self):
+        plain = self.app.get('/api/playlist?subreddits=futuregarage')
+        self.assertNotIn('Content-Encoding', plain.headers)
+
+        response = self.app.get('/api/playlist?subreddits=futuregarage',
+                                headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertLess(len(response.data), len(plain.data))
+        self.assertEqual(zlib.decompress(response.data, 16 + zlib.MAX_WBITS),
+                         plain.data)
+
+
+class MetricsTestCase(FlockBaseTestCase):
+    def setUp(self):
+        FlockBaseTestCase.setUp(self)
+        flock.getRedditResponse = mock.MagicMock(name='getRedditResponse',
+                                                 return_value=self.futuregarage_top)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = flock.Histogram('test_seconds', 'Test.', (0.1, 1.0),
+                                    ('stage',))
+        for value in [0.05, 0.1, 0.5, 2.0]:
+            histogram.observe(value, 'a')
+        self.assertEqual(histogram.render()[2:], [
+            'test_seconds_bucket{stage="a",le="0.1"} 2',
+            'test_seconds_bucket{stage="a",le="1.0"} 3',
+            'test_seconds_bucket{stage="a",le="+Inf"} 4',
+            'test_seconds_sum{stage="a"} 2.65',
+            'test_seconds_count{stage="a"} 4'])
+
+    def test_labels_are_escaped(self):
+        self.assertEqual(flock.formatMetricLabels(('a',), ('x"\\y\n',)),
+                         '{a="x\\"\\\\y\\n"}')
+
+    def test_stages_are_timed(self):
+        stages = ['get_links', 'dedupe', 'rank', 'json_encode', 'cache_get']
+        before = [flock.stage_seconds.count(stage) for stage in stages]
+        misses = flock.cache_lookups.value('miss')
+        self.app.get('/api/playlist?subreddits=futuregarage')
+        self.assertEqual([flock.stage_seconds.count(stage) for stage in stages],
+                         [count + 1 for count in before])
+        self.assertGreater(flock.cache_lookups.value('miss'), misses)
+
+    def test_metrics_endpoint(self):
+        self.app.get('/api/playlist?subreddits=futuregarage')
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/plain')
+        lines = response.data.splitlines()
+        self.assertIn('# TYPE flock_stage_seconds histogram', lines)
+        self.assertIn('# TYPE flock_cache_hit_ratio gauge', lines)
+        self.assertTrue(any(line.startswith(
+            'flock_stage_seconds_count{stage="rank"} ') for line in lines))
+        self.assertTrue(any(line.startswith(
+            'flock_request_seconds_count{endpoint="playlistApi"} ')
+            for line in lines))
+        self.assertTrue(any(line.startswith('flock_conditional_not_modified_total ')
+                            for line in lines))
+
+    def test_upstream_status_codes_are_counted(self):
+        host = urlparse.urlparse(flock.REDDIT_URL).netloc
+        ok = flock.upstream_responses.value(host, '200')
+        failed = flock.upstream_responses.value(host, '503')
+        flock.makeRequest(flock.REDDIT_URL + '/r/a.json')
+        flock.http_opener.open.side_effect = urllib2.HTTPError(
+            flock.REDDIT_URL, 503, 'Service Unavailable', {}, None)
+        self.assertRaises(urllib2.HTTPError, flock.makeRequest,
+                          flock.REDDIT_URL + '/r/a.json')
+        self.assertEqual(flock.upstream_responses.value(host, '200'), ok + 1)
+        self.assertEqual(flock.upstream_responses.value(host, '503'), failed + 1)
+
+
+class ProfilingTestCase(FlockBaseTestCase):
+    def setUp(self):
+        FlockBaseTestCase.setUp(self)
+        flock.getRedditResponse = mock.MagicMock(name='getRedditResponse',
+                                                 return_value=self.futuregarage_top)
+        self.profile_dir = tempfile.mkdtemp()
+        self.original_config = dict(flock.app.config)
+        flock.app.config.update(PROFILE_ENABLED=True,
+                                PROFILE_SECRET='s3cret',
+                                PROFILE_DIR=self.profile_dir,
+                                PROFILE_SAMPLE_INTERVAL=0.0005)
+
+    def tearDown(self):
+        flock.app.config.clear()
+        flock.app.config.update(self.original_config)
+        shutil.rmtree(self.profile_dir)
+        FlockBaseTestCase.tearDown(self)
+
+    def get(self, headers=None):
+        return self.app.get('/?subreddits=futuregarage', headers=headers)
+
+    def test_profile_needs_the_secret(self):
+        for headers in [None, {'X-Flock-Profile': 'guess'}]:
+            response = self.get(headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('X-Flock-Profile', response.headers)
+        self.assertEqual(os.listdir(self.profile_dir), [])
+
+    def test_profile_needs_to_be_enabled(self):
+        flock.app.config['PROFILE_ENABLED'] = False
+        response = self.get({'X-Flock-Profile': 's3cret'})
+        self.assertNotIn('X-Flock-Profile', response.headers)
+        self.assertEqual(os.listdir(self.profile_dir), [])
+
+    def test_profiled_request_writes_pstats_and_collapsed_stacks(self):
+        plain = self.get()
+        response = self.get({'X-Flock-Profile': 's3cret'})
+        self.assertEqual(response.data, plain.data)
+        name = response.headers['X-Flock-Profile']
+        self.assertTrue(name.startswith('playlist-'))
+        self.assertEqual(sorted(os.listdir(self.profile_dir)),
+                         [name + '.collapsed', name + '.pstats'])
+
+        stats = pstats.Stats(os.path.join(self.profile_dir, name + '.pstats'))
+        functions = [function for filename, line, function in stats.stats]
+        self.assertIn('buildPlaylist', functions)
+        with open(os.path.join(self.profile_dir, name + '.collapsed')) as f:
+            for line in f:
+                stack, count = line.rsplit(' ', 1)
+                self.assertGreater(int(count), 0)
+
+    def test_sample_mode_skips_cprofile(self):
+        response = self.get({'X-Flock-Profile': 's3cret',
+                             'X-Flock-Profile-Mode': 'sample'})
+        name = response.headers['X-Flock-Profile']
+        self.assertEqual(os.listdir(self.profile_dir), [name + '.collapsed'])
+
+    def test_live_traffic_is_sampled(self):
+        flock.app.config['PROFILE_SAMPLE_RATE'] = 1.0
+        self.get()
+        self.get()
+        # written in the background
+        for i in range(100):
+            if os.listdir(self.profile_dir):
+                break
+            time.sleep(0.01)
+        self.assertEqual(os.listdir(self.profile_dir),
+                         ['live-%d.collapsed' % os.getpid()])
+
+    def test_write_failures_keep_the_response(self):
+        unwritable = os.path.join(self.profile_dir, 'file')
+        open(unwritable, 'w').close()
+        flock.app.config['PROFILE_DIR'] = unwritable
+        plain = self.get()
+        flock.app.config['PROFILE_SAMPLE_RATE'] = 1.0
+        sampled = self.get()
+        profiled = self.get({'X-Flock-Profile': 's3cret'})
+        for response in [sampled, profiled]:
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, plain.data)
+        self.assertNotIn('X-Flock-Profile', profiled.headers)
+
+    def test_collapsed_stacks_start_at_the_outermost_call(self):
+        def inner():
+            return flock.collapseStack(sys._getframe())
+        frames = inner().split(';')
+        self.assertTrue(frames[-1].startswith('tests.py:inner:'))
+        self.assertIn('tests.py:test_collapsed_stacks_start_at_the_outermost_call:',
+                      frames[-2])
+
 
 class OptionalPlaylistOptionsTestCase(FlockBaseTestCase):
     def test_accepts_valid_optional_arguments(self):
@@ -407,6 +853,19 @@ class OptionalPlaylistOptionsTestCase(FlockBaseTestCase):
         flock.getRedditResponse.assert_called_once_with(['futuregarage'], 'hot', 'month', 100)
         self.assertEqual(response.data.count('"track"'), 2)
 
+    def test_accepts_additional_sorts(self):
+        flock.getRedditResponse = mock.MagicMock(name='getRedditResponse',
+                                                 return_value=self.futuregarage_top)
+
+        for sort in ['new', 'rising', 'controversial']:
+            response = self.app.get('/?subreddits=futuregarage&sort=%s' % sort,
+                                    content_type='text/html',
+                                    follow_redirects=True)
+
+            self.assertEqual(response.status_code, 200)
+            flock.getRedditResponse.assert_called_with(['futuregarage'], sort, 'week', 100)
+            self.assertNotIn('Invalid sort type', response.data)
+
     def test_unsupported_sort_argument(self):
         flock.getRedditResponse = mock.MagicMock(name='getRedditResponse',
                                                  return_value=self.futuregarage_top)
@@ -457,6 +916,21 @@ class OptionalPlaylistOptionsTestCase(FlockBaseTestCase):
 
 
 class CacheTestCase(FlockBaseTestCase):
+    def setUp(self):
+        FlockBaseTestCase.setUp(self)
+        self.original_refreshLinksInBackground = flock.refreshLinksInBackground
+        flock.refreshLinksInBackground = mock.MagicMock(name='refreshLinksInBackground')
+
+    def tearDown(self):
+        flock.refreshLinksInBackground = self.original_refreshLinksInBackground
+        FlockBaseTestCase.tearDown(self)
+
+    def assertCachedLinks(self, set_many, key, links):
+        args, kwargs = set_many.call_args
+        self.assertIn(key, args[0])
+        cached_links, soft_expires, after = flock.decodeCacheEntry(args[0][key])
+        self.assertEqual(cached_links, links)
+
     def test_frontpage_hits_memcached(self):
         flock.getRedditResponse = mock.MagicMock(name='getRedditResponse',              
                                                  return_value=self.futuregarage_top)
@@ -467,7 +941,7 @@ class CacheTestCase(FlockBaseTestCase):
 
         self.assertEquals(response.status_code, 200)
         flock.getRedditResponse.assert_called_once_with(['futuregarage'], 'hot', 'week', 100)
-        flock.cache.get.assert_called_once_with('futuregarage+hot+week')
+        flock.cache.get.assert_any_call('futuregarage+hot+week')
 
     def test_frontpage_hits_memcached_same_number_of_times_as_subreddits(self):
         flock.getRedditResponse = mock.MagicMock(name='getRedditResponse',
@@ -479,7 +953,8 @@ class CacheTestCase(FlockBaseTestCase):
 
         self.assertEquals(response.status_code, 200)
         flock.getRedditResponse.assert_called_once_with(['1', '2', '3', '4', '5'], 'hot', 'week', 100)
-        self.assertEquals(flock.cache.get.call_count, 5)
+        # one per subreddit, plus the first listing page of the selection
+        self.assertEquals(flock.cache.get.call_count, 6)
 
 
     def test_frontpage_hits_memcached_same_number_of_times_as_subreddits_with_names(self):
@@ -487,7 +962,7 @@ class CacheTestCase(FlockBaseTestCase):
 
         flock.getRedditResponse = mock.MagicMock(name='getRedditResponse', return_value=None)
 
-        flock.cache.get = mock.MagicMock(name='get', return_value=pickle.dumps(return_value))
+        flock.cache.get = mock.MagicMock(name='get', return_value=flock.encodeCacheEntry(return_value, time.time() + 60))
 
         response = self.app.get('/?subreddits=1+2+3+4+5', follow_redirects=True)
 
@@ -518,7 +993,7 @@ class CacheTestCase(FlockBaseTestCase):
 
         def cache_side_effect(*args, **kwargs):
             if args[0] == 'futuregarage+top+week':
-                return pickle.dumps(cache_value)
+                return flock.encodeCacheEntry(cache_value, time.time() + 60)
             return None
 
         flock.cache.get = mock.MagicMock(name='get')
@@ -570,7 +1045,7 @@ class CacheTestCase(FlockBaseTestCase):
 
         def cache_side_effect(*args, **kwargs):
             if args[0] == 'futuregarage+hot+week':
-                return pickle.dumps(cache_value)
+                return flock.encodeCacheEntry(cache_value, time.time() + 60)
             return None
 
         flock.cache.get = mock.MagicMock(name='get')
@@ -607,7 +1082,7 @@ class CacheTestCase(FlockBaseTestCase):
     def test_cache_is_heated_with_parsed_links(self):
         cache_value = flock.parseRedditResponse(self.futuregarage_top)
         
-        flock.cache.set = mock.MagicMock(name='set')
+        flock.cache.set_many = mock.MagicMock(name='set_many')
         flock.cache.get = mock.MagicMock(name='get', return_value=None)
 
         flock.getRedditResponse = mock.MagicMock(name='getRedditResponse',
@@ -615,12 +1090,13 @@ class CacheTestCase(FlockBaseTestCase):
 
         self.app.get('/?subreddits=futuregarage', follow_redirects=True)
 
-        flock.cache.set.assert_called_with('futuregarage+hot+week', pickle.dumps(cache_value))
+        self.assertEqual(flock.cache.set_many.call_count, 1)
+        self.assertCachedLinks(flock.cache.set_many, 'futuregarage+hot+week', cache_value)
 
     def test_cache_is_hit_after_cache_is_warmed(self):
         cache_value = flock.parseRedditResponse(self.futuregarage_top)
 
-        flock.cache.set = mock.MagicMock(name='set')
+        flock.cache.set_many = mock.MagicMock(name='set_many')
         flock.cache.get = mock.MagicMock(name='get', return_value=None)
 
         flock.getRedditResponse = mock.MagicMock(name='getRedditResponse',
@@ -629,17 +1105,736 @@ class CacheTestCase(FlockBaseTestCase):
         self.app.get('/?subreddits=futuregarage', follow_redirects=True)
 
         flock.getRedditResponse.assert_called_with(['futuregarage'], 'hot', 'week', 100)
-        flock.cache.set.assert_called_with('futuregarage+hot+week', pickle.dumps(cache_value))
+        self.assertCachedLinks(flock.cache.set_many, 'futuregarage+hot+week', cache_value)
 
-        flock.cache.get = mock.MagicMock(name='get', return_value=pickle.dumps(cache_value))
-        flock.cache.set = mock.MagicMock(name='set')
+        flock.cache.get = mock.MagicMock(name='get', return_value=flock.encodeCacheEntry(cache_value, time.time() + 60))
+        flock.cache.set_many = mock.MagicMock(name='set_many')
         flock.getRedditResponse = mock.MagicMock(name='getRedditResponse')
 
         self.app.get('/?subreddits=futuregarage', follow_redirects=True)
 
-        flock.cache.get.assert_called_with('futuregarage+hot+week')
+        flock.cache.get.assert_any_call('futuregarage+hot+week')
         self.assertEqual(flock.getRedditResponse.call_count, 0)
-        self.assertEqual(flock.cache.set.call_count, 0)
+        self.assertEqual(flock.cache.set_many.call_count, 0)
+
+    def test_cache_is_read_in_one_round_trip(self):
+        flock.getRedditResponse = mock.MagicMock(name='getRedditResponse',
+                                                 return_value=self.futuregarage_top)
+        flock.cache.get_many = mock.MagicMock(name='get_many',
+                                              return_value=[None] * 4)
+        flock.cache.set_many = mock.MagicMock(name='set_many')
+
+        self.app.get('/?subreddits=1+2+3', follow_redirects=True)
+
+        flock.cache.get_many.assert_called_once_with('1+hot+week',
+                                                     '2+hot+week',
+                                                     '3+hot+week',
+                                                     flock.cursorCacheKey(['1', '2', '3'], 'hot', 'week'))
+        self.assertEqual(flock.cache.set_many.call_count, 1)
+
+    def test_cache_hits_and_misses_are_reported(self):
+        cache_value = flock.encodeCacheEntry(flock.parseRedditResponse(self.futuregarage_top),
+                                             time.time() + 60)
+        flock.getRedditResponse = mock.MagicMock(name='getRedditResponse',
+                                                 return_value=self.futuregarage_top)
+        flock.cache.get_many = mock.MagicMock(name='get_many',
+                                              return_value=[cache_value, None, None, None])
+        flock.cache.set_many = mock.MagicMock(name='set_many')
+
+        response = self.app.get('/?subreddits=1+2+3&limit=10')
+
+        self.assertEqual(response.headers.get('X-Flock-Cache'), 'hits=1; misses=2')
+        flock.getRedditResponse.assert_called_once_with(['2', '3'], 'hot', 'week', 100)
+
+
+class RankLinksTestCase(unittest.TestCase):
+    def setUp(self):
+        with open('tests/futuregarage_hot_week_100.json') as f:
+            self.links = flock.parseRedditResponse(json.load(f))
+
+    def sortTwice(self, links, sort_func):
+        links = sorted(links, reverse=True, key=lambda l: l['created_utc'])
+        return sorted(links, reverse=True, key=sort_func)
+
+    def test_rank_matches_full_sort(self):
+        for sort_func in flock.supported_sorts.values():
+            expected = self.sortTwice(self.links, sort_func)
+            for limit in [1, 10, len(self.links), len(self.links) + 10]:
+                self.assertEqual(flock.rankLinks(self.links, sort_func, limit),
+                                 expected[:limit])
+
+    def test_rank_ties_keep_newest_then_original_order(self):
+        links = [flock.Link(id=str(i), ups=1, downs=0, created_utc=date)
+                 for i, date in enumerate([5, 7, 5, 7, 6])]
+        ranked = flock.rankLinks(links, flock.top, 5)
+        self.assertEqual([link['id'] for link in ranked],
+                         ['1', '3', '4', '0', '2'])
+        self.assertEqual(ranked, self.sortTwice(links, flock.top))
+
+    def test_rank_with_custom_sort(self):
+        comments = lambda link: link['num_comments']
+        self.assertEqual(flock.rankLinks(self.links, comments, 5),
+                         self.sortTwice(self.links, comments)[:5])
+
+
+@unittest.skipIf(flock.numpy is None, 'numpy is not installed')
+class VectorScoringTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pools = []
+        for path in ['tests/futuregarage_hot_week_100.json',
+                     'tests/futuregarage_top_week_100.json']:
+            with open(path) as f:
+                self.pools.append(flock.parseRedditResponse(json.load(f)))
+
+        random = flock.numpy.random.RandomState(14)
+        self.pools.append([flock.Link(id=str(i),
+                                      ups=int(random.randint(0, 50)),
+                                      downs=int(random.randint(0, 50)),
+                                      created_utc=float(
+                                          random.randint(1384000000,
+                                                         1384000100)))
+                           for i in range(2000)])
+
+    def test_vector_rank_matches_python_rank(self):
+        for links in self.pools:
+            for sort in flock.vector_sorts:
+                for limit in [1, 25, len(links)]:
+                    self.assertEqual(
+                        flock.vectorRankLinks(links, sort, limit),
+                        flock.rankLinks(links, flock.supported_sorts[sort],
+                                        limit),
+                        sort)
+
+    def test_vector_scores_match_python_scores(self):
+        for links in self.pools:
+            columns = flock.linkColumns(links)
+            for sort in flock.vector_sorts:
+                scores = flock.vector_sorts[sort](columns).tolist()
+                self.assertEqual(scores,
+                                 [flock.supported_sorts[sort](link)
+                                  for link in links], sort)
+
+    def test_round_scores_rounds_halves_away_from_zero(self):
+        values = [0.5, 1.5, 2.5, -0.5, -2.5, 0.125, 2.675, 1.0000000499999]
+        rounded = flock.roundScores(flock.numpy.array(values), 2).tolist()
+        self.assertEqual(rounded, [round(value, 2) for value in values])
+        rounded = flock.roundScores(flock.numpy.array(values), 0).tolist()
+        self.assertEqual(rounded, [round(value, 0) for value in values])
+
+    def test_select_links_uses_configured_backend(self):
+        links = self.pools[0]
+        original_backend = flock.app.config.get('SCORING_BACKEND')
+        flock.app.config['SCORING_BACKEND'] = 'numpy'
+        original_vectorRankLinks = flock.vectorRankLinks
+        flock.vectorRankLinks = mock.MagicMock(wraps=flock.vectorRankLinks)
+        try:
+            ranked = flock.selectLinks(links, 'hot', 10)
+            flock.vectorRankLinks.assert_called_once_with(links, 'hot', 10)
+        finally:
+            flock.vectorRankLinks = original_vectorRankLinks
+            flock.app.config['SCORING_BACKEND'] = original_backend
+        self.assertEqual(ranked, flock.selectLinks(links, 'hot', 10))
+
+
+class RenderedPageCacheTestCase(FlockBaseTestCase):
+    def setUp(self):
+        FlockBaseTestCase.setUp(self)
+        flock.cache.clear()
+        flock.cache.get = self.original_cache_get
+        self.original_page_cache = flock.app.config.get('PAGE_CACHE')
+        flock.app.config['PAGE_CACHE'] = True
+        flock.getRedditResponse = mock.MagicMock(name='getRedditResponse',
+                                                 return_value=self.futuregarage_top)
+        self.original_getLinks = flock.getLinks
+        flock.getLinks = mock.MagicMock(name='getLinks',
+                                        wraps=flock.getLinks)
+
+    def tearDown(self):
+        flock.getLinks = self.original_getLinks
+        flock.app.config['PAGE_CACHE'] = self.original_page_cache
+        flock.cache.clear()
+        FlockBaseTestCase.tearDown(self)
+
+    def test_page_key_is_normalized(self):
+        self.assertEqual(
+            flock.renderedPageKey(['FutureGarage', 'dubstep', 'futuregarage'],
+                                  'hot', 'week', 100),
+            flock.renderedPageKey(['dubstep', 'futuregarage'],
+                                  'hot', 'week', 100))
+        self.assertNotEqual(
+            flock.renderedPageKey(['dubstep'], 'hot', 'week', 100),
+            flock.renderedPageKey(['dubstep'], 'hot', 'week', 50))
+
+    def test_long_selections_fit_in_page_keys(self):
+        original_cache = flock.cache
+        # the client checks key lengths before it connects
+        flock.cache = flock.MemcachedCache(['127.0.0.1:1'])
+        flock.cache.get_many = mock.MagicMock(name='get_many', side_effect=
+            lambda *keys: [repr(time.time() + 60)] * len(keys))
+        subreddits = ['subreddit_number_%02d' % i for i in range(25)]
+        try:
+            key = flock.renderedPageKey(subreddits, 'hot', 'week', 100)
+            flock.setRenderedPage(key, subreddits, 'hot', 'week', 'page')
+        finally:
+            flock.cache = original_cache
+
+    def test_repeated_request_is_served_from_cache(self):
+        first = self.app.get('/?subreddits=futuregarage+dubstep')
+        second = self.app.get('/?subreddits=Dubstep+futuregarage+dubstep')
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(flock.getLinks.call_count, 1)
+
+    def test_refreshed_links_invalidate_page(self):
+        self.app.get('/?subreddits=futuregarage')
+        flock.setCachedLinks({'futuregarage+hot+week': []}, 'week')
+        response = self.app.get('/?subreddits=futuregarage',
+                                follow_redirects=True)
+
+        self.assertEqual(flock.getLinks.call_count, 2)
+        self.assertIn('No links found', response.data)
+
+    def test_pages_with_flashes_are_not_cached(self):
+        with self.app.session_transaction() as session:
+            session['_flashes'] = [('error', 'Something went wrong')]
+        response = self.app.get('/?subreddits=futuregarage')
+        self.assertIn('Something went wrong', response.data)
+
+        response = self.app.get('/?subreddits=futuregarage')
+        self.assertNotIn('Something went wrong', response.data)
+        self.assertEqual(flock.getLinks.call_count, 2)
+
+    def test_cached_page_is_bypassed_while_flashes_are_pending(self):
+        self.app.get('/?subreddits=futuregarage')
+        with self.app.session_transaction() as session:
+            session['_flashes'] = [('error', 'Something went wrong')]
+        response = self.app.get('/?subreddits=futuregarage')
+
+        self.assertIn('Something went wrong', response.data)
+        self.assertEqual(flock.getLinks.call_count, 2)
+
+
+class StaleWhileRevalidateTestCase(FlockBaseTestCase):
+    def setUp(self):
+        FlockBaseTestCase.setUp(self)
+        self.original_refreshLinksInBackground = flock.refreshLinksInBackground
+        flock.refreshLinksInBackground = mock.MagicMock(name='refreshLinksInBackground')
+        flock.cache.set_many = mock.MagicMock(name='set_many')
+        self.cache_value = flock.parseRedditResponse(self.futuregarage_top)
+
+    def tearDown(self):
+        FlockBaseTestCase.tearDown(self)
+        flock.refreshLinksInBackground = self.original_refreshLinksInBackground
+
+    def test_fresh_entries_are_not_refreshed(self):
+        flock.getRedditResponse = mock.MagicMock(name='getRedditResponse')
+        flock.cache.get = mock.MagicMock(name='get',
+            return_value=flock.encodeCacheEntry(self.cache_value, time.time() + 60))
+
+        response = self.app.get('/?subreddits=futuregarage')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(flock.getRedditResponse.called)
+        self.assertFalse(flock.refreshLinksInBackground.called)
+
+    def test_stale_entries_are_served_and_refreshed(self):
+        flock.getRedditResponse = mock.MagicMock(name='getRedditResponse')
+        flock.cache.get = mock.MagicMock(name='get',
+            return_value=flock.encodeCacheEntry(self.cache_value, time.time() - 60))
+
+        response = self.app.get('/?subreddits=futuregarage', follow_redirects=True)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(self.cache_value[0]['permalink'], response.data)
+        self.assertFalse(flock.getRedditResponse.called)
+        flock.refreshLinksInBackground.assert_called_once_with(['futuregarage'], 'hot', 'week')
+
+    def test_background_refresh_rewrites_entry(self):
+        flock.refreshLinksInBackground = self.original_refreshLinksInBackground
+        flock.getRedditResponse = mock.MagicMock(name='getRedditResponse',
+                                                 return_value=self.futuregarage_top)
+
+        thread = flock.refreshLinksInBackground(['futuregarage'], 'top', 'day')
+        thread.join()
+
+        flock.getRedditResponse.assert_called_once_with(['futuregarage'], 'top', 'day', 100)
+        args, kwargs = flock.cache.set_many.call_args
+        soft_timeout, hard_timeout = flock.getCacheWindow('day')
+        self.assertEqual(kwargs['timeout'], hard_timeout)
+        links, soft_expires, after = flock.decodeCacheEntry(args[0]['futuregarage+top+day'])
+        self.assertAlmostEqual(soft_expires, time.time() + soft_timeout, delta=5)
+        self.assertEqual(flock.refreshing_keys, set())
+
+    def test_cache_windows_are_configurable_per_time(self):
+        self.assertLess(flock.getCacheWindow('day')[0], flock.getCacheWindow('all')[0])
+        for t in flock.supported_times:
+            soft_timeout, hard_timeout = flock.getCacheWindow(t)
+            self.assertLess(soft_timeout, hard_timeout)
+
+
+class WarmerTestCase(FlockBaseTestCase):
+    def setUp(self):
+        FlockBaseTestCase.setUp(self)
+        flock.cache.get = self.original_cache_get
+        flock.cache.delete(flock.RequestFrequency.cache_key)
+        self.frequency = flock.RequestFrequency(flush_interval=0)
+
+    def tearDown(self):
+        flock.cache.delete(flock.RequestFrequency.cache_key)
+        FlockBaseTestCase.tearDown(self)
+
+    def test_request_frequency_is_shared_through_cache(self):
+        self.frequency.record(['futuregarage', 'FutureBeats'], 'hot', 'week')
+        self.frequency.record(['futurebeats'], 'hot', 'week')
+
+        other_worker = flock.RequestFrequency()
+        self.assertEqual(other_worker.top(2), [('futurebeats', 'hot', 'week'),
+                                               ('futuregarage', 'hot', 'week')])
+
+    def test_request_frequency_decays(self):
+        self.frequency.record(['futuregarage', 'futurebeats'], 'hot', 'week')
+        self.frequency.record(['futurebeats'], 'hot', 'week')
+        self.frequency.decay(0.5)
+        self.assertEqual(self.frequency.top(10), [('futurebeats', 'hot', 'week')])
+
+    def test_suggested_playlists_are_read_from_template(self):
+        suggestions = flock.getSuggestedPlaylists()
+        self.assertIn(['chillmusic'], suggestions)
+        self.assertIn(['futuregarage', 'futurebeats'], suggestions)
+
+    def test_warm_cache_fetches_suggestions_and_top_requests(self):
+        self.original_request_frequency = flock.request_frequency
+        flock.request_frequency = self.frequency
+        self.frequency.record(['dubstep'], 'top', 'month')
+        flock.getCachedLinks = mock.MagicMock(name='getCachedLinks', return_value={})
+        flock.fetchLinksOnce = mock.MagicMock(name='fetchLinksOnce', return_value=[])
+        try:
+            warmed = flock.warmCache(10)
+        finally:
+            flock.request_frequency = self.original_request_frequency
+
+        suggestions = flock.getSuggestedPlaylists()
+        self.assertEqual(warmed, len(suggestions) + 1)
+        flock.fetchLinksOnce.assert_any_call(['dubstep'], 'top', 'month')
+        for subreddits in suggestions:
+            flock.fetchLinksOnce.assert_any_call(subreddits, 'hot', 'week')
+
+    def test_warm_cache_skips_fresh_entries(self):
+        entry = flock.CacheEntry([], time.time() + 60, None)
+        flock.getCachedLinks = mock.MagicMock(name='getCachedLinks',
+            return_value={'dubstep+top+month': entry})
+        flock.fetchLinksOnce = mock.MagicMock(name='fetchLinksOnce')
+        self.assertTrue(flock.warmLinks(['dubstep'], 'top', 'month'))
+        self.assertFalse(flock.fetchLinksOnce.called)
+
+
+def makeListing(prefix, count, after=None, subreddit='futuregarage'):
+    children = []
+    for i in range(count):
+        children.append({
+            'kind': 't3',
+            'data': {
+                'id': '%s%d' % (prefix, i),
+                'title': 'Track %s%d' % (prefix, i),
+                'url': 'http://www.youtube.com/watch?v=%s%d' % (prefix, i),
+                'permalink': '/r/%s/comments/%s%d/' % (subreddit, prefix, i),
+                'num_comments': i,
+                'ups': 100 - i,
+                'downs': 0,
+                'author': 'rblstr',
+                'subreddit': subreddit,
+                'created_utc': 1384000000.0 + i,
+                'domain': 'youtube.com'
+            }
+        })
+    return {'data': {'children': children, 'after': after}}
+
+
+class StreamDecodeTestCase(FlockBaseTestCase):
+    def setUp(self):
+        FlockBaseTestCase.setUp(self)
+        self.original_stream_decode = flock.app.config.get('STREAM_DECODE')
+        self.original_chunk_size = flock.app.config.get('STREAM_CHUNK_SIZE')
+        flock.app.config['STREAM_DECODE'] = True
+        flock.app.config['STREAM_CHUNK_SIZE'] = 7
+
+    def tearDown(self):
+        flock.app.config['STREAM_DECODE'] = self.original_stream_decode
+        flock.app.config['STREAM_CHUNK_SIZE'] = self.original_chunk_size
+        FlockBaseTestCase.tearDown(self)
+
+    def streamBody(self, body):
+        flock.http_opener.open.return_value = io.BytesIO(body)
+        return flock.getRedditLinks(['futuregarage'], 'hot', 'week')
+
+    def test_streamed_links_match_parsed_response(self):
+        for listing in [self.futuregarage_hot, self.futuregarage_top]:
+            links, after = self.streamBody(json.dumps(listing))
+            self.assertEqual(links, flock.parseRedditResponse(listing))
+            self.assertEqual(after, listing['data'].get('after'))
+
+    def test_streamed_links_handle_braces_and_escapes_in_strings(self):
+        listing = makeListing('a', 3, after='t3_next')
+        listing['data']['children'][1]['data']['title'] = 'Track {"]}\\ a1'
+        links, after = self.streamBody(json.dumps(listing))
+        self.assertEqual(links, flock.parseRedditResponse(listing))
+        self.assertEqual(links[1]['title'], 'Track {"]}\\ a1')
+        self.assertEqual(after, 't3_next')
+
+    def test_streamed_links_handle_arrays_in_children(self):
+        listing = self.futuregarage_hot
+        for child in listing['data']['children']:
+            child['data']['user_reports'] = []
+            child['data']['preview'] = {'images': [{'resolutions': [[1, 2]]}]}
+        links, after = self.streamBody(json.dumps(listing))
+        self.assertEqual(len(links), 41)
+        self.assertEqual(links, flock.parseRedditResponse(listing))
+        self.assertEqual(after, listing['data'].get('after'))
+
+    def test_streamed_cursor_before_children(self):
+        body = '{"data": {"after": "t3_x", "children": []}}'
+        self.assertEqual(self.streamBody(body), ([], 't3_x'))
+
+    def test_streamed_error_response(self):
+        self.assertIsNone(self.streamBody('{"error": 429}'))
+
+    def test_streamed_invalid_json(self):
+        self.assertIsNone(self.streamBody('{"data": {"children": [{"kind": '))
+        self.assertIsNone(self.streamBody('not json'))
+
+    def test_streamed_buffer_stays_below_body_size(self):
+        flock.app.config['STREAM_CHUNK_SIZE'] = 1024
+        body = json.dumps(makeListing('a', 100))
+        response = io.BytesIO(body)
+        listing = flock.StreamedListing(response, 1024)
+        self.assertEqual(len([child for child in listing]), 100)
+        self.assertTrue(listing.valid)
+        self.assertLess(listing.peak_buffer, len(body) / 4)
+
+    def test_fetch_links_uses_streaming(self):
+        flock.http_opener.open.return_value = io.BytesIO(
+            json.dumps(makeListing('a', 5, after='t3_a4')))
+        flock.cache.set_many = mock.MagicMock(name='set_many')
+        links, after = flock.fetchLinks(['futuregarage'], 'hot', 'week')
+        self.assertEqual([link['id'] for link in links],
+                         ['a0', 'a1', 'a2', 'a3', 'a4'])
+        self.assertEqual(after, 't3_a4')
+
+
+class PaginationTestCase(FlockBaseTestCase):
+    def setUp(self):
+        FlockBaseTestCase.setUp(self)
+        flock.cache.set_many = mock.MagicMock(name='set_many')
+        self.pages = {
+            None: makeListing('a', 40, 't3_a'),
+            't3_a': makeListing('b', 40, 't3_b'),
+            't3_b': makeListing('c', 40, 't3_c'),
+            't3_c': makeListing('d', 40, None)
+        }
+        def page(subreddits, sort, t, limit, after=None):
+            return self.pages[after]
+        flock.getRedditResponse = mock.MagicMock(name='getRedditResponse',
+                                                 side_effect=page)
+
+    def test_pages_are_only_fetched_until_limit_is_reached(self):
+        with flock.app.test_request_context('/'):
+            links = flock.getLinks(['futuregarage'], 'hot', 'week', 70)
+
+        self.assertEqual(len(links), 80)
+        self.assertEqual(flock.getRedditResponse.call_args_list,
+                         [mock.call(['futuregarage'], 'hot', 'week', 100),
+                          mock.call(['futuregarage'], 'hot', 'week', 100, 't3_a')])
+
+    def test_single_page_is_enough_for_small_limits(self):
+        with flock.app.test_request_context('/'):
+            links = flock.getLinks(['futuregarage'], 'hot', 'week', 40)
+
+        self.assertEqual(len(links), 40)
+        self.assertEqual(flock.getRedditResponse.call_count, 1)
+
+    def test_pagination_stops_at_max_pages(self):
+        with flock.app.test_request_context('/'):
+            links = flock.getLinks(['futuregarage'], 'hot', 'week', 1000)
+
+        max_pages = flock.app.config['MAX_PAGES']
+        self.assertEqual(flock.getRedditResponse.call_count, max_pages + 1)
+        self.assertEqual(len(links), 40 * (max_pages + 1))
+
+    def test_pages_are_cached_separately(self):
+        with flock.app.test_request_context('/'):
+            flock.getLinks(['futuregarage'], 'hot', 'week', 70)
+
+        first_page, second_page = [args[0] for args, kwargs
+                                   in flock.cache.set_many.call_args_list]
+        page_key = flock.pageCacheKey(['futuregarage'], 'hot', 'week', 't3_a')
+        self.assertIn(flock.cursorCacheKey(['futuregarage'], 'hot', 'week'),
+                      first_page)
+        self.assertEqual(second_page.keys(), [page_key])
+        links, soft_expires, after = flock.decodeCacheEntry(second_page[page_key])
+        self.assertEqual(after, 't3_b')
+        self.assertEqual(len(links), 40)
+
+    def test_pages_are_fetched_lazily(self):
+        with flock.app.test_request_context('/'):
+            pages = flock.iterRedditPages(['futuregarage'], 'hot', 'week')
+            self.assertFalse(flock.getRedditResponse.called)
+            next(pages)
+            self.assertEqual(flock.getRedditResponse.call_count, 1)
+
+    def test_limit_above_one_page_is_accepted(self):
+        response = self.app.get('/?subreddits=futuregarage&limit=150')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.count('"track"'), 150)
+
+
+class CursorTestCase(FlockBaseTestCase):
+    def setUp(self):
+        FlockBaseTestCase.setUp(self)
+        self.original_cache = flock.cache
+        flock.cache = flock.SimpleCache()
+        def listing(subreddits, sort, t, limit, after=None):
+            page = int(after.rsplit('_', 1)[1]) if after else 0
+            children = []
+            for subreddit in subreddits:
+                children.extend(makeListing('%s%d_' % (subreddit, page), 5,
+                                            subreddit=subreddit)['data']['children'])
+            if page < 5:
+                after = 't3_%s_%d' % ('+'.join(subreddits), page + 1)
+            else:
+                after = None
+            return {'data': {'children': children, 'after': after}}
+        flock.getRedditResponse = mock.MagicMock(name='getRedditResponse',
+                                                 side_effect=listing)
+
+    def tearDown(self):
+        flock.cache = self.original_cache
+        flock.app.config['FETCH_MODE'] = 'combined'
+        FlockBaseTestCase.tearDown(self)
+
+    def getLinkIds(self, subreddits, limit):
+        with flock.app.test_request_context('/'):
+            links = flock.removeDuplicates(
+                flock.getLinks(subreddits, 'hot', 'week', limit))
+        return sorted(link['id'] for link in links)
+
+    def test_warm_requests_paginate_like_cold_ones(self):
+        for mode in ['combined', 'split']:
+            flock.cache.clear()
+            flock.app.config['FETCH_MODE'] = mode
+            cold = self.getLinkIds(['a', 'b'], 30)
+            flock.getRedditResponse.reset_mock()
+            warm = self.getLinkIds(['a', 'b'], 30)
+            self.assertGreaterEqual(len(cold), 30, mode)
+            self.assertEqual(warm, cold, mode)
+            self.assertFalse(flock.getRedditResponse.called, mode)
+
+    def test_selection_without_cursor_is_served_from_cache(self):
+        self.getLinkIds(['a', 'b'], 30)
+        flock.getRedditResponse.reset_mock()
+        with mock.patch('flock.refreshLinksInBackground') as refresh:
+            links = self.getLinkIds(['a'], 30)
+        self.assertEqual(len(links), 5)
+        self.assertFalse(flock.getRedditResponse.called)
+        refresh.assert_called_once_with(['a'], 'hot', 'week')
+
+    def test_selection_paginates_once_its_cursor_is_cached(self):
+        self.getLinkIds(['a'], 5)
+        self.getLinkIds(['b'], 5)
+        with mock.patch('flock.refreshLinksInBackground') as refresh:
+            refresh.side_effect = lambda subreddits, sort, t: \
+                flock.fetchGroups([subreddits], sort, t)
+            self.getLinkIds(['a', 'b'], 30)
+        warm = self.getLinkIds(['a', 'b'], 30)
+        flock.cache.clear()
+        cold = self.getLinkIds(['a', 'b'], 30)
+        self.assertGreaterEqual(len(warm), 30)
+        self.assertEqual(warm, cold)
+
+    def test_cursors_are_not_counted_as_cache_lookups(self):
+        self.app.get('/?subreddits=a+b&limit=5')
+        flock.getRedditResponse.reset_mock()
+        response = self.app.get('/?subreddits=a+b&limit=5')
+        self.assertEqual(response.headers.get('X-Flock-Cache'), 'hits=2; misses=0')
+        self.assertFalse(flock.getRedditResponse.called)
+
+    def test_long_selections_fit_in_memcached_keys(self):
+        # the client checks key lengths before it connects
+        flock.cache = flock.MemcachedCache(['127.0.0.1:1'])
+        subreddits = ['subreddit_number_%02d' % i for i in range(25)]
+        flock.setCachedLinks({}, 'week', {
+            flock.cursorCacheKey(subreddits, 'hot', 'week'): ([], None),
+            flock.pageCacheKey(subreddits, 'hot', 'week', 't3_1'): ([], None),
+        })
+
+
+class PartitionTestCase(FlockBaseTestCase):
+    def setUp(self):
+        FlockBaseTestCase.setUp(self)
+        flock.cache.set_many = mock.MagicMock(name='set_many')
+        listing = makeListing('a', 10, subreddit='futuregarage')
+        listing['data']['children'] += makeListing('b', 5, subreddit='FutureBeats')['data']['children']
+        self.listing = listing
+        flock.getRedditResponse = mock.MagicMock(name='getRedditResponse',
+                                                 return_value=listing)
+
+    def cachedEntries(self):
+        args, kwargs = flock.cache.set_many.call_args
+        return dict((key, flock.decodeCacheEntry(value).links)
+                    for key, value in args[0].iteritems()
+                    if not key.startswith('generation+'))
+
+    def test_parsed_links_keep_their_subreddit(self):
+        links = flock.parseRedditResponse(self.listing)
+        self.assertEqual(links[0]['subreddit'], 'futuregarage')
+
+    def test_each_subreddit_caches_only_its_own_links(self):
+        flock.fetchLinks(['futuregarage', 'futurebeats', 'dubstep'], 'hot', 'week')
+
+        entries = self.cachedEntries()
+        self.assertEqual(len(entries['futuregarage+hot+week']), 10)
+        self.assertEqual(len(entries['futurebeats+hot+week']), 5)
+        self.assertEqual(entries['dubstep+hot+week'], [])
+        for link in entries['futurebeats+hot+week']:
+            self.assertEqual(link['subreddit'], 'FutureBeats')
+
+    def test_partitioned_entries_do_not_duplicate_links(self):
+        flock.fetchLinks(['futuregarage', 'futurebeats'], 'hot', 'week')
+
+        cached_links = sum(len(links) for links in self.cachedEntries().values())
+        self.assertEqual(cached_links, len(flock.parseRedditResponse(self.listing)))
+
+    def test_cache_keys_ignore_case(self):
+        self.assertEqual(flock.linkCacheKey('FutureBeats', 'hot', 'week'),
+                         flock.linkCacheKey('futurebeats', 'hot', 'week'))
+
+    def test_subreddit_without_links_is_a_cache_hit(self):
+        entry = flock.encodeCacheEntry([], time.time() + 60)
+        flock.cache.get_many = mock.MagicMock(name='get_many',
+                                              return_value=[entry, entry])
+
+        with flock.app.test_request_context('/'):
+            links = flock.getLinks(['dubstep'], 'hot', 'week')
+
+        self.assertEqual(links, [])
+        self.assertFalse(flock.getRedditResponse.called)
+
+
+class CacheCodecTestCase(FlockBaseTestCase):
+    def setUp(self):
+        FlockBaseTestCase.setUp(self)
+        self.links = flock.parseRedditResponse(self.futuregarage_hot)
+        self.entry = flock.CacheEntry(self.links, 1384000000.0, 't3_1rhl86')
+
+    def test_compact_codec_round_trips_links(self):
+        codec = flock.CompactCodec()
+        decoded = codec.decodeEntry(codec.encodeEntry(self.entry))
+        self.assertEqual(decoded, self.entry)
+
+    def test_compact_codec_only_compresses_large_values(self):
+        codec = flock.CompactCodec(compress_threshold=1024)
+        self.assertEqual(codec.encodeEntry(self.entry)[:2], 'cz')
+        small_entry = flock.CacheEntry(self.links[:1], 0, None)
+        self.assertEqual(codec.encodeEntry(small_entry)[:2], 'c-')
+        self.assertEqual(codec.decodeEntry(codec.encodeEntry(small_entry)), small_entry)
+
+    def test_compact_codec_is_smaller_than_pickle(self):
+        compact = flock.CompactCodec(compress_threshold=sys.maxint)
+        self.assertLess(len(compact.encodeEntry(self.entry)),
+                        len(flock.PickleCodec().encodeEntry(self.entry)))
+
+    def test_pickled_entries_are_still_decoded(self):
+        value = flock.PickleCodec().encodeEntry(self.entry)
+        self.assertEqual(flock.decodeCacheEntry(value), self.entry)
+
+    def test_legacy_entries_are_misses(self):
+        flock.cache.get = self.original_cache_get
+        legacy_links = [dict(link.asDict()) for link in self.links[:3]]
+        key = flock.linkCacheKey('futuregarage', 'hot', 'week')
+        for value in [pickle.dumps(legacy_links),
+                      pickle.dumps(legacy_links[:2]),
+                      pickle.dumps((1384000000.0, legacy_links)),
+                      'cz-not-zlib']:
+            flock.cache.set(key, value)
+            self.assertEqual(flock.getCachedLinks([key]), {})
+        flock.cache.delete(key)
+
+    def test_legacy_entry_is_refetched(self):
+        flock.cache.get = self.original_cache_get
+        flock.getRedditResponse = mock.MagicMock(name='getRedditResponse',
+                                                 return_value=self.futuregarage_hot)
+        key = flock.linkCacheKey('futuregarage', 'hot', 'week')
+        flock.cache.set(key, pickle.dumps(
+            [dict(link.asDict()) for link in self.links]))
+        try:
+            response = self.app.get('/?subreddits=futuregarage&sort=hot')
+            self.assertEqual(response.status_code, 200)
+            flock.getRedditResponse.assert_any_call(['futuregarage'], 'hot',
+                                                    'week', 100)
+            self.assertEqual(flock.getCachedLinks([key])[key].links,
+                             self.links)
+        finally:
+            flock.cache.clear()
+
+    def test_codec_is_configurable(self):
+        flock.app.config['CACHE_CODEC'] = 'pickle'
+        try:
+            value = flock.encodeCacheEntry(self.links, 0)
+        finally:
+            flock.app.config['CACHE_CODEC'] = 'compact'
+        self.assertEqual(value, flock.PickleCodec().encodeEntry(flock.CacheEntry(self.links, 0, None)))
+        self.assertEqual(flock.encodeCacheEntry(self.links, 0)[0], 'c')
+
+
+class SplitFetchTestCase(FlockBaseTestCase):
+    def setUp(self):
+        FlockBaseTestCase.setUp(self)
+        flock.cache.set_many = mock.MagicMock(name='set_many')
+        flock.app.config['FETCH_MODE'] = 'split'
+        def listing(subreddits, sort, t, limit, after=None):
+            time.sleep(0.2)
+            return makeListing(subreddits[0], 10, subreddit=subreddits[0])
+        flock.getRedditResponse = mock.MagicMock(name='getRedditResponse',
+                                                 side_effect=listing)
+
+    def tearDown(self):
+        FlockBaseTestCase.tearDown(self)
+        flock.app.config['FETCH_MODE'] = 'combined'
+        flock.app.config['FETCH_GROUP_SIZE'] = 1
+
+    def test_subreddits_are_grouped(self):
+        flock.app.config['FETCH_GROUP_SIZE'] = 2
+        self.assertEqual(flock.groupSubreddits(['a', 'b', 'c']), [['a', 'b'], ['c']])
+        flock.app.config['FETCH_MODE'] = 'combined'
+        self.assertEqual(flock.groupSubreddits(['a', 'b', 'c']), [['a', 'b', 'c']])
+
+    def test_each_subreddit_is_fetched_separately(self):
+        with flock.app.test_request_context('/'):
+            links = flock.getLinks(['a', 'b', 'c'], 'hot', 'week')
+
+        self.assertEqual(flock.getRedditResponse.call_count, 3)
+        flock.getRedditResponse.assert_any_call(['b'], 'hot', 'week', 100)
+        self.assertEqual(len(links), 30)
+        self.assertEqual(set(link['id'][0] for link in links), set(['a', 'b', 'c']))
+
+    def test_groups_are_fetched_in_parallel(self):
+        before_call = time.time()
+        with flock.app.test_request_context('/'):
+            flock.getLinks(['a', 'b', 'c', 'd'], 'hot', 'week')
+        self.assertLess(time.time() - before_call, 0.6)
+
+    def test_failed_group_keeps_other_groups(self):
+        def listing(subreddits, sort, t, limit, after=None):
+            if subreddits == ['b']:
+                return None
+            return makeListing(subreddits[0], 10, subreddit=subreddits[0])
+        flock.getRedditResponse.side_effect = listing
+
+        with flock.app.test_request_context('/'):
+            links = flock.getLinks(['a', 'b'], 'hot', 'week')
+            self.assertTrue(flask.g.reddit_failed)
+
+        self.assertEqual(len(links), 10)
 
 
 class SubredditListTestCase(FlockBaseTestCase):
@@ -647,11 +1842,11 @@ class SubredditListTestCase(FlockBaseTestCase):
         FlockBaseTestCase.setUp(self)
 
         flock.getSubredditList = self.original_getSubredditList
-        flock.urllib2.urlopen = mock.MagicMock(return_value=io.StringIO(self.kimono_data))
+        flock.http_opener.open = mock.MagicMock(return_value=io.StringIO(self.kimono_data))
 
     def tearDown(self):
         FlockBaseTestCase.tearDown(self)
-        flock.urllib2.urlopen = self.original_urlopen
+        flock.http_opener.open = self.original_open
 
     def test_subreddits_are_parsed(self):
         subreddit_list = flock.getSubredditList()
@@ -663,31 +1858,31 @@ class SubredditListTestCase(FlockBaseTestCase):
 
         subreddit_list = flock.getSubredditList()
 
-        self.assertTrue(flock.urllib2.urlopen.called)
+        self.assertTrue(flock.http_opener.open.called)
         flock.cache.set.assert_called_with('subreddits',
-                                           pickle.dumps(subreddit_list),
+                                           flock.getCacheCodec().dumps(subreddit_list),
                                            timeout=60*60*24*7)
 
     def test_no_urlopen_when_cache_is_hot(self):
         flock.cache.get = mock.MagicMock(return_value=pickle.dumps(self.subreddit_list))
         subreddit_list = flock.getSubredditList()
 
-        self.assertFalse(flock.urllib2.urlopen.called)
+        self.assertFalse(flock.http_opener.open.called)
 
         self.assertItemsEqual(subreddit_list, self.subreddit_list)
 
     def test_no_kimono_response(self):
-        flock.urllib2.urlopen = mock.MagicMock(side_effect=IOError)
+        flock.http_opener.open = mock.MagicMock(side_effect=IOError)
         subreddit_list = flock.getSubredditList()
         self.assertEqual(subreddit_list, [])
 
     def test_no_kimono_result(self):
-        flock.urllib2.urlopen = mock.MagicMock(return_value=io.StringIO(u'{}'))
+        flock.http_opener.open = mock.MagicMock(return_value=io.StringIO(u'{}'))
         subreddit_list = flock.getSubredditList()
         self.assertEqual(subreddit_list, [])
 
     def test_invalid_kimono_result(self):
-        flock.urllib2.urlopen = mock.MagicMock(return_value=io.StringIO(u'<xml/>'))
+        flock.http_opener.open = mock.MagicMock(return_value=io.StringIO(u'<xml/>'))
         subreddit_list = flock.getSubredditList()
         self.assertEqual(subreddit_list, [])
 
@@ -717,11 +1912,11 @@ class RateLimitTestCase(FlockBaseTestCase):
 
     def test_rate_limit_calls_urlopen_when_timeout_has_passed(self):
         response = flock.rateLimitedRequest('url', 1.0)
-        self.assertEqual(flock.urllib2.urlopen.call_count, 1)
+        self.assertEqual(flock.http_opener.open.call_count, 1)
 
     def test_rate_limit_returns_urlopen_reponse(self):
         urlopen_response = io.StringIO(u'{}')
-        flock.urllib2.urlopen = mock.MagicMock(return_value=urlopen_response)
+        flock.http_opener.open = mock.MagicMock(return_value=urlopen_response)
         response = flock.rateLimitedRequest('url', 1.0)
         self.assertEquals(response, urlopen_response)
 
@@ -733,6 +1928,491 @@ class RateLimitTestCase(FlockBaseTestCase):
         delta = after_call - before_call
         self.assertLess(delta.seconds, 5.0)
 
+    def test_rate_limit_burst_allows_immediate_requests(self):
+        flock.app.config['RATE_LIMIT_BURST'] = 3
+        try:
+            before_call = time.time()
+            for i in range(3):
+                flock.rateLimitedRequest('http://url.com', 5.0)
+            after_call = time.time()
+        finally:
+            flock.app.config['RATE_LIMIT_BURST'] = 1
+        self.assertLess(after_call - before_call, 1.0)
+
+    def test_rate_limit_queues_concurrent_callers(self):
+        finish_times = []
+        def request():
+            flock.rateLimitedRequest('http://url.com', 0.2)
+            finish_times.append(time.time())
+
+        before_call = time.time()
+        threads = [threading.Thread(target=request) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        finish_times.sort()
+        self.assertGreaterEqual(finish_times[-1] - before_call, 0.6)
+        for first, second in zip(finish_times, finish_times[1:]):
+            self.assertGreaterEqual(second - first, 0.15)
+
+    def test_rate_limit_fails_fast_beyond_max_wait(self):
+        flock.app.config['RATE_LIMIT_MAX_WAIT'] = 1.0
+        try:
+            flock.rateLimitedRequest('http://url.com', 5.0)
+            self.assertRaises(flock.RateLimitExceeded,
+                              flock.rateLimitedRequest, 'http://url.com', 5.0)
+        finally:
+            flock.app.config['RATE_LIMIT_MAX_WAIT'] = 10.0
+        self.assertEqual(flock.http_opener.open.call_count, 1)
+
+    def test_rate_limit_records_wait_time(self):
+        flock.rateLimitedRequest('http://url.com', 0.5)
+        flock.rateLimitedRequest('http://url.com', 0.5)
+        stats = flock.rateLimitStats()['url.com']
+        self.assertEqual(stats['requests'], 2)
+        self.assertGreaterEqual(stats['max_wait'], 0.4)
+
+    def test_reddit_request_interval_is_configurable(self):
+        original = flock.rateLimitedRequest
+        flock.rateLimitedRequest = mock.MagicMock(name='rateLimitedRequest')
+        flock.app.config['REDDIT_REQUEST_INTERVAL'] = 0.0
+        try:
+            flock.openRedditListing(['futuregarage'], 'hot', 'week', 100, None)
+            url, interval, headers = flock.rateLimitedRequest.call_args[0]
+        finally:
+            flock.rateLimitedRequest = original
+            flock.app.config['REDDIT_REQUEST_INTERVAL'] = 2.0
+        self.assertEqual(interval, 0.0)
+
+    def test_upstream_urls_are_read_from_settings(self):
+        settings = tempfile.NamedTemporaryFile(suffix='.py', delete=False)
+        settings.write("REDDIT_URL = 'http://127.0.0.1:8001'\n"
+                       "KIMONO_URL = 'http://127.0.0.1:8001/kimono'\n")
+        settings.close()
+        environ = dict(os.environ, FLOCK_SETTINGS=settings.name)
+        try:
+            output = subprocess.check_output(
+                [sys.executable, '-c',
+                 'import flock; print flock.REDDIT_URL; print flock.KIMONO_URL'],
+                env=environ)
+        finally:
+            os.remove(settings.name)
+        self.assertEqual(output.split(), ['http://127.0.0.1:8001',
+                                          'http://127.0.0.1:8001/kimono'])
+
+    def test_shared_slots_are_claimed_once(self):
+        flock.cache.get = self.original_cache_get
+        now = time.time()
+        first = flock.claimSharedSlot('shared.com', 1.0, now, 5.0)
+        second = flock.claimSharedSlot('shared.com', 1.0, now, 5.0)
+        self.assertGreaterEqual(second - first, 1.0)
+
+
+class SingleFlightTestCase(FlockBaseTestCase):
+    def test_concurrent_calls_share_one_result(self):
+        release = threading.Event()
+        def slow_call(*args):
+            release.wait()
+            return ['link']
+        func = mock.MagicMock(name='func', side_effect=slow_call)
+        flight = flock.SingleFlight()
+
+        results = []
+        def call():
+            results.append(flight.do('key', func, 'arg'))
+
+        threads = [threading.Thread(target=call) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(func.call_count, 1)
+        self.assertEqual(results, [['link']] * 5)
+
+    def test_exceptions_are_shared(self):
+        flight = flock.SingleFlight()
+        func = mock.MagicMock(name='func', side_effect=ValueError)
+        self.assertRaises(ValueError, flight.do, 'key', func)
+        self.assertEqual(flight.calls, {})
+
+    def test_concurrent_identical_fetches_hit_reddit_once(self):
+        release = threading.Event()
+        def slow_response(*args):
+            release.wait()
+            return self.futuregarage_top
+        flock.getRedditResponse = mock.MagicMock(name='getRedditResponse',
+                                                 side_effect=slow_response)
+
+        results = []
+        def call():
+            with flock.app.test_request_context('/'):
+                results.append(flock.getLinks(['futuregarage'], 'hot', 'week'))
+
+        threads = [threading.Thread(target=call) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(flock.getRedditResponse.call_count, 1)
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(links == results[0] for links in results))
+
+    def test_shared_flight_waits_for_other_worker(self):
+        flock.cache.get = self.original_cache_get
+        cache_value = flock.parseRedditResponse(self.futuregarage_top)
+        flock.getRedditResponse = mock.MagicMock(name='getRedditResponse')
+        flock.app.config['SINGLE_FLIGHT_SHARED'] = True
+        flight_key = flock.flightCacheKey(['futuregarage'], 'hot', 'week')
+        flock.cache.set(flight_key, 'other-worker')
+
+        cursor_key = flock.cursorCacheKey(['futuregarage'], 'hot', 'week')
+
+        def finish_other_worker():
+            time.sleep(0.2)
+            flock.setCachedLinks({'futuregarage+hot+week': cache_value}, 'week',
+                                 {cursor_key: ([], 't3_next')})
+            flock.cache.set(flight_key, 'done')
+        thread = threading.Thread(target=finish_other_worker)
+        thread.start()
+
+        try:
+            links = flock.fetchLinksOnce(['futuregarage'], 'hot', 'week')
+        finally:
+            thread.join()
+            flock.app.config['SINGLE_FLIGHT_SHARED'] = False
+            flock.cache.delete(flight_key)
+            flock.cache.delete('futuregarage+hot+week')
+            flock.cache.delete(cursor_key)
+
+        self.assertFalse(flock.getRedditResponse.called)
+        self.assertEqual(links, (cache_value, 't3_next'))
+
+    def test_waiting_worker_paginates_like_the_fetching_one(self):
+        def listing(subreddits, sort, t, limit, after=None):
+            page = int(after[len('t3_'):]) if after else 0
+            response = makeListing('p%d_' % page, 5, subreddit='futuregarage')
+            response['data']['after'] = 't3_%d' % (page + 1)
+            return response
+        flock.getRedditResponse = mock.MagicMock(name='getRedditResponse',
+                                                 side_effect=listing)
+        def other_worker(flight_key):
+            flock.fetchLinks(['futuregarage'], 'hot', 'week')
+            flock.cache.set(flight_key, 'done')
+            return None
+
+        original_cache = flock.cache
+        flock.cache = flock.SimpleCache()
+        flock.app.config['SINGLE_FLIGHT_SHARED'] = True
+        try:
+            with flock.app.test_request_context('/'):
+                fetched = flock.getLinks(['futuregarage'], 'hot', 'week', 10)
+                flock.cache.delete(flock.linkCacheKey('futuregarage', 'hot',
+                                                      'week'))
+                flock.getRedditResponse.reset_mock()
+                with mock.patch('flock.acquireSharedFlight',
+                                side_effect=other_worker):
+                    waited = flock.getLinks(['futuregarage'], 'hot', 'week', 10)
+        finally:
+            flock.cache = original_cache
+            flock.app.config['SINGLE_FLIGHT_SHARED'] = False
+
+        self.assertEqual(len(waited), 10)
+        self.assertEqual(waited, fetched)
+        # only the other worker's fetch, the second page is cached
+        self.assertEqual(flock.getRedditResponse.call_count, 1)
+
+    def test_long_selections_fit_in_flight_keys(self):
+        original_cache = flock.cache
+        # the client checks key lengths before it connects
+        flock.cache = flock.MemcachedCache(['127.0.0.1:1'])
+        subreddits = ['subreddit_number_%02d' % i for i in range(25)]
+        try:
+            flock.acquireSharedFlight(flock.flightCacheKey(subreddits, 'hot',
+                                                           'week'))
+        finally:
+            flock.cache = original_cache
+
+    def test_waiting_worker_fetches_when_the_cursor_is_gone(self):
+        flock.cache.get = self.original_cache_get
+        flock.app.config['SINGLE_FLIGHT_SHARED'] = True
+        flight_key = flock.flightCacheKey(['futuregarage'], 'hot', 'week')
+        flock.cache.set(flight_key, 'done')
+        flock.setCachedLinks({'futuregarage+hot+week': []}, 'week')
+        try:
+            links = flock.waitForSharedFlight(flight_key, ['futuregarage'],
+                                              'hot', 'week')
+        finally:
+            flock.app.config['SINGLE_FLIGHT_SHARED'] = False
+            flock.cache.delete(flight_key)
+            flock.cache.delete('futuregarage+hot+week')
+        self.assertIsNone(links)
+
+
+class FixtureRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Replays files from tests/ over keep-alive HTTP/1.1.
+
+    Listings are served as /r/<subreddit>/<sort>.json?t=<t>&limit=<limit>
+    from tests/<subreddit>_<sort>_<t>_<limit>.json. /slow/<path> waits
+    before answering, /drop/<path> closes the connection after answering
+    without saying so.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(self.headers)
+        url = urlparse.urlparse(self.path)
+        path = url.path.strip('/').split('/')
+        if path[0] == 'slow':
+            time.sleep(0.5)
+            path = path[1:]
+        if path[0] == 'drop':
+            self.close_connection = 1
+            path = path[1:]
+
+        if path[0] == 'r':
+            query = urlparse.parse_qs(url.query)
+            fixture = '%s_%s_%s_%s.json' % (path[1], path[2][:-len('.json')],
+                                            query['t'][0], query['limit'][0])
+        else:
+            fixture = path[-1]
+        fixture = os.path.join('tests', fixture)
+        if not os.path.isfile(fixture):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        with open(fixture) as f:
+            body = f.read()
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as gzip_file:
+                gzip_file.write(body)
+            body = buf.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.bytes_sent += len(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           FixtureRequestHandler)
+        self.connections = 0
+        self.requests = []
+        self.bytes_sent = 0
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def handle_error(self, request, client_address):
+        # clients hanging up mid-response are part of the tests
+        if isinstance(sys.exc_info()[1], socket.error):
+            return
+        BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+class FixtureServerTestCase(FlockBaseTestCase):
+    def setUp(self):
+        FlockBaseTestCase.setUp(self)
+        flock.http_opener.open = real_open
+        self.server = FixtureServer()
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        with open('tests/futuregarage_hot_week_100.json') as f:
+            self.fixture = f.read()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        FlockBaseTestCase.tearDown(self)
+
+
+class PooledHTTPTestCase(FixtureServerTestCase):
+    def fetch(self, path):
+        response = flock.makeRequest(self.server.url + path)
+        body = response.read()
+        response.close()
+        return body
+
+    def test_urlopen_is_left_alone(self):
+        opener = urllib2._opener
+        self.assertTrue(opener is None or flock.http_pool not in opener.handlers)
+
+    def test_requests_reuse_one_connection(self):
+        for i in range(3):
+            body = self.fetch('/r/futuregarage/hot.json?t=week&limit=100')
+            self.assertEqual(body, self.fixture)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_gzip_is_negotiated_and_decoded(self):
+        body = self.fetch('/futuregarage_hot_week_100.json')
+        self.assertEqual(body, self.fixture)
+        self.assertIn('gzip', self.server.requests[0]['Accept-Encoding'])
+        self.assertEqual(self.server.requests[0]['User-Agent'], flock.USER_AGENT)
+        self.assertLess(self.server.bytes_sent, len(self.fixture) / 4)
+
+    def test_gzip_body_can_be_read_in_chunks(self):
+        response = flock.makeRequest(self.server.url + '/futuregarage_top_week_100.json')
+        chunks = []
+        while True:
+            chunk = response.read(7)
+            if not chunk:
+                break
+            self.assertLessEqual(len(chunk), 7)
+            chunks.append(chunk)
+        response.close()
+        with open('tests/futuregarage_top_week_100.json') as f:
+            self.assertEqual(''.join(chunks), f.read())
+
+    def test_streamed_listing_from_server(self):
+        flock.REDDIT_URL, original_url = self.server.url, flock.REDDIT_URL
+        flock.app.config['STREAM_DECODE'], original_stream = True, flock.app.config['STREAM_DECODE']
+        try:
+            links, after = flock.getRedditLinks(['futuregarage'], 'hot', 'week')
+            expected = flock.parseRedditResponse(json.loads(self.fixture))
+        finally:
+            flock.REDDIT_URL = original_url
+            flock.app.config['STREAM_DECODE'] = original_stream
+        self.assertEqual(links, expected)
+
+    def test_dropped_idle_connection_is_replaced(self):
+        self.assertEqual(self.fetch('/drop/kimono.json'), self.fetch('/kimono.json'))
+        self.assertEqual(self.server.connections, 2)
+
+    def test_unclosed_early_response_is_not_pooled(self):
+        response = flock.makeRequest(self.server.url + '/kimono.json')
+        response.read(10)
+        response.close()
+        self.fetch('/kimono.json')
+        self.assertEqual(self.server.connections, 2)
+
+    def test_http_errors_are_raised(self):
+        with self.assertRaises(urllib2.HTTPError) as context:
+            flock.makeRequest(self.server.url + '/missing.json')
+        self.assertEqual(context.exception.code, 404)
+
+    def test_read_timeout(self):
+        handler = flock.PooledHTTPHandler(connect_timeout=1.0, read_timeout=0.1)
+        opener = urllib2.build_opener(handler)
+        before = time.time()
+        with self.assertRaises(urllib2.URLError):
+            opener.open(self.server.url + '/slow/kimono.json')
+        self.assertLess(time.time() - before, 0.4)
+
+
+class ConditionalGetTestCase(FixtureServerTestCase):
+    def setUp(self):
+        FixtureServerTestCase.setUp(self)
+        flock.cache.clear()
+        flock.cache.get = self.original_cache_get
+        self.original_urls = flock.REDDIT_URL, flock.KIMONO_URL
+        flock.REDDIT_URL = self.server.url
+        flock.KIMONO_URL = self.server.url + '/kimono.json'
+        self.original_conditional = flock.app.config['CONDITIONAL_GET']
+        flock.app.config['CONDITIONAL_GET'] = True
+        self.original_stats = dict(flock.conditional_stats)
+
+    def tearDown(self):
+        flock.REDDIT_URL, flock.KIMONO_URL = self.original_urls
+        flock.app.config['CONDITIONAL_GET'] = self.original_conditional
+        flock.conditional_stats.update(self.original_stats)
+        flock.cache.clear()
+        FixtureServerTestCase.tearDown(self)
+
+    def fetchLinks(self):
+        # one request per rate limit interval
+        flock.rate_limited_requests = {}
+        return flock.fetchLinks(['futuregarage'], 'hot', 'week')
+
+    def test_unchanged_listing_extends_entries(self):
+        links, after = self.fetchLinks()
+        key = 'futuregarage+hot+week'
+        first_expiry = flock.getCachedLinks([key])[key].soft_expires
+
+        time.sleep(0.01)
+        cached_links, cached_after = self.fetchLinks()
+
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertIn('If-None-Match', self.server.requests[1])
+        self.assertEqual(sorted(link['id'] for link in cached_links),
+                         sorted(link['id'] for link in links))
+        self.assertEqual(cached_after, after)
+        self.assertGreater(flock.getCachedLinks([key])[key].soft_expires,
+                           first_expiry)
+        self.assertEqual(flock.conditional_stats['not_modified'],
+                         self.original_stats['not_modified'] + 1)
+        self.assertGreater(flock.conditional_stats['bytes_saved'],
+                           self.original_stats['bytes_saved'])
+        self.assertGreater(flock.conditional_stats['parse_seconds_saved'],
+                           self.original_stats['parse_seconds_saved'])
+
+    def test_unchanged_listing_without_entries_is_fetched_again(self):
+        links, after = self.fetchLinks()
+        flock.cache.delete('futuregarage+hot+week')
+
+        refetched_links, refetched_after = self.fetchLinks()
+
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertNotIn('If-None-Match', self.server.requests[2])
+        self.assertEqual(refetched_links, links)
+
+    def test_validators_expire_with_their_entries(self):
+        self.fetchLinks()
+        url = '%s/r/futuregarage/hot.json?%s' % (
+            self.server.url, urllib.urlencode({'t': 'week', 'limit': 100}))
+        validators_expire = flock.cache._cache[flock.listingValidatorKey(url)][0]
+        entry_expires = flock.cache._cache['futuregarage+hot+week'][0]
+        self.assertLessEqual(validators_expire, entry_expires)
+        self.assertGreater(validators_expire,
+                           time.time() + flock.getCacheWindow('week')[0])
+
+    def test_unchanged_subreddit_list_is_not_downloaded_again(self):
+        flock.getSubredditList = self.original_getSubredditList
+        subreddit_list = flock.getSubredditList()
+        self.assertTrue(subreddit_list)
+        flock.cache.delete('subreddits')
+
+        self.assertEqual(flock.getSubredditList(), subreddit_list)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertIn('If-None-Match', self.server.requests[1])
+        self.assertTrue(flock.cache.get('subreddits'))
+
+    def test_unconditional_when_disabled(self):
+        flock.app.config['CONDITIONAL_GET'] = False
+        self.fetchLinks()
+        self.fetchLinks()
+        self.assertNotIn('If-None-Match', self.server.requests[1])
+
 
 class KimonoTestCase(unittest.TestCase):
     @mock.patch('flock.cache.get')